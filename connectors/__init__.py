@@ -2,12 +2,15 @@
 # To be used by any connector to an identity provider.
 # Attributes:
 #     orgname: The human readable name of this identity provider.
+#     auth_timeout: Deadline in seconds for an answer of 'auth' during a lookup.
 #     rfid: The rfid as six-digit string.
 #     user: The user object (with real data after authenticating).
 
 
 class IdProvider(object):
 
+    auth_timeout = 5.0
+
     def __init__(self):
         pass
 
@@ -27,11 +30,33 @@ class IdProvider(object):
     # Args:
     #     user: The user who got a beer (user object).
     #     slot: The slot the user chose (int).
+    #     key: Idempotency key of the vend, identical for repeated reports of the same vend (str, optional).
     # Returns:
-    #     True if reporting was successful, False otherwise.
-    def report(self, user, slot):
+    #     True if reporting was successful, None if the vend was rejected for good and must not be reported again, False otherwise.
+    def report(self, user, slot, key=None):
         raise NotImplementedError("Method 'report' must be implemented by class '%s'" % self.__class__.__name__)
 
+    # Tells whether reports are currently sent to the identity provider. Connectors which dismiss requests locally while their API is unhealthy override this,
+    # so that dismissed reports are not counted as failed attempts of the vendings.
+    # Returns:
+    #     True if reports are sent, False otherwise.
+    def is_available(self):
+        return True
+
+    # Reports many vendings at once. Connectors which can send them in a single request override this,
+    # by default every vending is reported on its own until the first one fails (a rejected vending does not stop the others).
+    # Args:
+    #     records: The vendings to report (list of dicts with 'rfid', 'slot', 'timestamp' and 'key').
+    # Returns:
+    #     List with the result of 'report' for every record: True if it was reported successfully, None if it was rejected for good, False otherwise.
+    def report_batch(self, records):
+        results = []
+        for record in records:
+            results.append(self.report(record['rfid'], record['slot'], key=record['key']))
+            if results[-1] is False:
+                break
+        return results + [False]*(len(records) - len(results))
+
 
 # The user object holding data about a machine user
 # Attributes:
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from connectors import User
+
+
+# CreditCache
+# INFO:     Bounded cache of the users (and thus credits) known by the ID providers, shared by the MDB authentication and the telegram bot. Entries are keyed by orgname and rfid,
+#           expire after 'ttl' seconds and the least recently used entry is dropped once 'maxsize' entries are cached.
+# ARGS:     maxsize (int) -> maximum number of cached entries, ttl (float) -> lifetime of an entry in seconds
+# RETURNS:  /
+class CreditCache(object):
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict() # (org, rfid) -> (User user, float expiry)
+
+    # get
+    # INFO:     Returns the cached user of an organisation, if it is cached and not yet expired.
+    # ARGS:     org (str) -> orgname of the ID provider, rfid (str) -> RFID of the user
+    # RETURNS:  User object, None if not cached
+    def get(self, org, rfid):
+        key = (org, str(rfid))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    # put
+    # INFO:     Caches the user as returned by an ID provider, dropping the least recently used entry if the cache is full.
+    # ARGS:     org (str) -> orgname of the ID provider, rfid (str) -> RFID of the user, user (User) -> user to cache
+    # RETURNS:  /
+    def put(self, org, rfid, user):
+        key = (org, str(rfid))
+        with self.lock:
+            self.entries[key] = (user, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # decrement
+    # INFO:     Subtracts vended drinks from the cached credits of a user, keeping the expiry of the entry. Does nothing if the user is not cached.
+    # ARGS:     org (str) -> orgname of the ID provider, rfid (str) -> RFID of the user, amount (int, optional) -> number of vended drinks
+    # RETURNS:  /
+    def decrement(self, org, rfid, amount=1):
+        key = (org, str(rfid))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            (user, expiry) = entry
+            self.entries[key] = (User(rfid=user.rfid, credits=max(0, user.credits - amount), uid=user.uid), expiry)
+
+    # invalidate
+    # INFO:     Removes a user from the cache, so that the next lookup asks the ID provider again.
+    # ARGS:     org (str) -> orgname of the ID provider, rfid (str) -> RFID of the user
+    # RETURNS:  /
+    def invalidate(self, org, rfid):
+        with self.lock:
+            self.entries.pop((org, str(rfid)), None)
+
+
+# the cache shared by all modules
+credit_cache = CreditCache()
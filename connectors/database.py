@@ -4,6 +4,7 @@ import os
 import logging
 from connectors import User, IdProvider
 from modules import CFG, DB
+from connectors.storage import storage
 import configparser
 import urllib.parse, urllib.request, urllib.error
 import json
@@ -11,15 +12,22 @@ import hashlib
 import hmac
 import time
 import binascii
-import sqlite3
+from threading import Lock
 
 
 class DB_ID(IdProvider):
 
     orgname = "DB"
 
+    auth_timeout = 1.0
+
     db_path = os.path.join(DB, "users.db")
 
+    # rfids with special access, shared by all instances and reloaded whenever the database files change
+    rfids = frozenset()
+    rfids_version = None
+    rfids_lock = Lock()
+
     # name
     # INFO:
     # ARGS:
@@ -32,39 +40,72 @@ class DB_ID(IdProvider):
         self.logger.setLevel(self.loglevel)
 
 
-    # name
-    # INFO:
-    # ARGS:
-    # RETURNS:
+    # auth
+    # INFO:     Checks whether rfid has special access. The rfids are kept in memory and only reloaded if the database changed, so a lookup does not depend on the number of users.
+    # ARGS:     rfid (str) -> RFID to be identified
+    # RETURNS:  User object with special credits if rfid is in the database, None otherwise
     def auth(self, rfid):
+        self.reload_rfids()
 
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        db.execute('SELECT * FROM users')
-        users = [item[0] for item in db.fetchall()]
-
-        db_connector.close()
-
-        if str(rfid) in users:
+        if str(rfid) in self.rfids:
             self.logger.info('Found rfid %s in the database for special access.' % str(rfid))
             return User(rfid = int(rfid), credits = 69, uid = 'Database Entry')
         else:
             return None
 
+    # reload_rfids
+    # INFO:     Reloads the rfids with special access if the database or its write-ahead log changed since the last load (by modification time and size).
+    # ARGS:     /
+    # RETURNS:  /
+    def reload_rfids(self):
+        if self.rfids_stamp() == DB_ID.rfids_version:
+            return
 
-    # name
-    # INFO:
-    # ARGS:
-    # RETURNS:
-    def report(self, rfid, slot):
-        try:
-            db_connector = sqlite3.connect(self.db_path)
-            db = db_connector.cursor()
-            db.execute('UPDATE users SET usage = usage + 1 WHERE rfid = %s' % str(rfid))
-            db_connector.commit()
-            db_connector.close()
-            return True
-        except Exception as e:
-            self.logger.exception("report exception: " + e)
-            return False
+        with DB_ID.rfids_lock:
+            # the first read of a connection creates the write-ahead log, so the stamp is taken after reading the schema, but before reading the rfids to notice later writes
+            db_connector = storage.connection(self.db_path)
+            db_connector.execute('PRAGMA schema_version').fetchone()
+            version = self.rfids_stamp()
+            if version == DB_ID.rfids_version:
+                return
+            DB_ID.rfids = frozenset(str(item[0]) for item in db_connector.execute('SELECT rfid FROM users'))
+            DB_ID.rfids_version = version
+            self.logger.debug('Loaded %d rfids with special access from the database.' % len(DB_ID.rfids))
+
+    # rfids_stamp
+    # INFO:     Returns the modification time and size of the database and its write-ahead log, which change with every committed write.
+    # ARGS:     /
+    # RETURNS:  tuple of (mtime, size) per file, None for a missing file
+    def rfids_stamp(self):
+        version = []
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+
+    # report
+    # INFO:     Counts a vend of a user with special access in the database. Returns after the update is committed.
+    # ARGS:     rfid (str) -> RFID of the user, slot (int) -> vended slot, key (str, optional) -> idempotency key of the vend, unused
+    # RETURNS:  True if reporting was successful, False otherwise
+    def report(self, rfid, slot, key=None):
+        return self.report_batch([{'rfid': rfid, 'slot': slot, 'timestamp': None, 'key': key}])[0]
+
+    # report_batch
+    # INFO:     Counts the vends of users with special access in the database. All updates are handed to the storage writer at once, so they are committed together.
+    # ARGS:     records (list) -> vends as dicts with 'rfid', 'slot', 'timestamp' and 'key'
+    # RETURNS:  list with True for every vend that was counted, False otherwise
+    def report_batch(self, records):
+        futures = [storage.write(self.db_path, 'UPDATE users SET usage = usage + 1 WHERE rfid = ?', (str(record['rfid']),)) for record in records]
+        results = []
+        for future in futures:
+            try:
+                future.result()
+                results.append(True)
+            except Exception as e:
+                self.logger.exception("report exception: {}".format(e))
+                results.append(False)
+        return results
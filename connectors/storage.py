@@ -0,0 +1,263 @@
+import sqlite3
+import threading
+import logging
+import queue
+from concurrent.futures import Future
+
+
+# Storage
+# INFO:     Shared access to the SQLite databases of all modules. Every thread gets one long-lived connection per database, so no connection is opened per query and
+#           the statement cache of each connection keeps the parameterized statements prepared. All databases are switched to WAL journaling, so readers do not block the writer.
+# ARGS:     /
+# RETURNS:  /
+class Storage(object):
+
+    # number of prepared statements kept per connection
+    CACHED_STATEMENTS = 64
+
+    # time in ms a connection waits for a lock held by another connection
+    BUSY_TIMEOUT = 5000
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.synchronous = {}
+        self.writer = None
+
+    # configure
+    # INFO:     Sets the synchronous mode for all future connections to a database. Defaults to NORMAL, which is safe in WAL mode but may lose the last transactions on power loss. FULL syncs every commit.
+    # ARGS:     db_path (str) -> path of the database, synchronous (str) -> 'NORMAL' or 'FULL'
+    # RETURNS:  /
+    def configure(self, db_path, synchronous):
+        with self.lock:
+            self.synchronous[db_path] = synchronous
+
+    # connection
+    # INFO:     Returns the connection of the current thread to a database, opening it on first use.
+    # ARGS:     db_path (str) -> path of the database
+    # RETURNS:  sqlite3.Connection
+    def connection(self, db_path):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        db_connector = connections.get(db_path)
+        if db_connector is None:
+            db_connector = sqlite3.connect(db_path, cached_statements=self.CACHED_STATEMENTS)
+            db_connector.execute('PRAGMA journal_mode=WAL')
+            db_connector.execute('PRAGMA synchronous={}'.format(self.synchronous.get(db_path, 'NORMAL')))
+            db_connector.execute('PRAGMA busy_timeout={}'.format(self.BUSY_TIMEOUT))
+            connections[db_path] = db_connector
+        return db_connector
+
+    # query
+    # INFO:     Runs a parameterized SELECT statement and returns all rows.
+    # ARGS:     db_path (str) -> path of the database, sql (str) -> statement with ? placeholders, params (tuple) -> values of the placeholders
+    # RETURNS:  list of row tuples
+    def query(self, db_path, sql, params=()):
+        return self.connection(db_path).execute(sql, params).fetchall()
+
+    # query_one
+    # INFO:     Runs a parameterized SELECT statement and returns the first row.
+    # ARGS:     db_path (str) -> path of the database, sql (str) -> statement with ? placeholders, params (tuple) -> values of the placeholders
+    # RETURNS:  row tuple, None if there is no row
+    def query_one(self, db_path, sql, params=()):
+        return self.connection(db_path).execute(sql, params).fetchone()
+
+    # execute
+    # INFO:     Runs a parameterized writing statement in its own transaction.
+    # ARGS:     db_path (str) -> path of the database, sql (str) -> statement with ? placeholders, params (tuple) -> values of the placeholders
+    # RETURNS:  sqlite3.Cursor of the statement (for lastrowid and rowcount)
+    def execute(self, db_path, sql, params=()):
+        db_connector = self.connection(db_path)
+        with db_connector:
+            return db_connector.execute(sql, params)
+
+    # executemany
+    # INFO:     Runs a parameterized writing statement for many sets of values in a single transaction.
+    # ARGS:     db_path (str) -> path of the database, sql (str) -> statement with ? placeholders, params (iterable) -> values of the placeholders per execution
+    # RETURNS:  sqlite3.Cursor of the statement
+    def executemany(self, db_path, sql, params):
+        db_connector = self.connection(db_path)
+        with db_connector:
+            return db_connector.executemany(sql, params)
+
+    # write
+    # INFO:     Hands a writing statement to the writer thread and returns immediately. The writer groups all statements queued while it commits into one transaction
+    #           per database. Callers which need durability wait on the returned future, all others may ignore it (failures are logged by the writer).
+    # ARGS:     db_path (str) -> path of the database, sql (str) -> statement with ? placeholders, params (tuple or iterable of tuples) -> values of the placeholders,
+    #           many (bool, optional) -> run the statement once per set of values in params
+    # RETURNS:  concurrent.futures.Future, resolved with the number of changed rows once the transaction is committed
+    def write(self, db_path, sql, params=(), many=False):
+        with self.lock:
+            if self.writer is None or not self.writer.is_running:
+                self.writer = Storage_Writer(self)
+                self.writer.start()
+            writer = self.writer
+        return writer.submit(db_path, sql, params, many)
+
+    # stop_writer
+    # INFO:     Commits all pending writes and stops the writer thread. A later write starts a new writer.
+    # ARGS:     timeout (float, optional) -> maximum time to wait for the writer in seconds
+    # RETURNS:  /
+    def stop_writer(self, timeout=5.0):
+        with self.lock:
+            writer = self.writer
+            self.writer = None
+        if writer is not None:
+            writer.exit()
+            writer.join(timeout)
+
+    # close
+    # INFO:     Closes all connections of the current thread.
+    # ARGS:     /
+    # RETURNS:  /
+    def close(self):
+        connections = getattr(self.local, 'connections', {})
+        for db_connector in connections.values():
+            db_connector.close()
+        connections.clear()
+
+
+# Storage_Writer
+# INFO:     Single thread performing all writes of the storage. Whenever the writer is idle, it takes all statements queued so far and commits them in one transaction per database.
+#           A lone statement is committed at once, while statements arriving during a commit wait for it and share the next one, so many concurrent writes cost few syncs of the SD card.
+#           A failing statement is rolled back completely and only fails its own future, the other statements of the transaction are committed.
+#           Statements submitted after the writer stopped are not written, their futures fail with a RuntimeError.
+# ARGS:     storage (Storage) -> storage providing the connections of the writer
+# RETURNS:  /
+class Storage_Writer(threading.Thread):
+
+    # maximum number of statements per commit
+    MAX_BATCH = 256
+
+    def __init__(self, storage):
+        # set-up for logging of storage. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'storage'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        threading.Thread.__init__(self, daemon=True, name='storage-writer')
+        self.storage = storage
+        self.intents = queue.Queue()
+        self.lock = threading.Lock()
+        self.is_running = True
+        self.stopped = False
+        self.writes = 0
+        self.commits = 0
+
+    # run
+    # INFO:     Main loop of the writer. Waits for the first statement and commits it together with all statements queued meanwhile. Pending statements are committed before exiting.
+    # ARGS:     /
+    # RETURNS:  /
+    def run(self):
+        try:
+            self.write_all()
+        finally:
+            self.reject_all()
+            self.storage.close()
+
+    # write_all
+    # INFO:     Commits the queued statements in batches until exit() is called and the queue is empty. A batch holds the statements queued when the writer gets to it, the writer
+    #           does not wait for further ones.
+    # ARGS:     /
+    # RETURNS:  /
+    def write_all(self):
+        while self.is_running or not self.intents.empty():
+            intent = self.intents.get()
+            if intent is None:
+                continue
+            batch = [intent]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    intent = self.intents.get_nowait()
+                except queue.Empty:
+                    break
+                if intent is None:
+                    break
+                batch.append(intent)
+            self.commit(batch)
+
+    # reject_all
+    # INFO:     Marks the writer as stopped and fails the futures of all statements still queued, so that no caller waits for a statement which is never written.
+    # ARGS:     /
+    # RETURNS:  /
+    def reject_all(self):
+        with self.lock:
+            self.stopped = True
+        while True:
+            try:
+                intent = self.intents.get_nowait()
+            except queue.Empty:
+                break
+            if intent is not None:
+                self.logger.error('write dropped, writer stopped ({})'.format(intent[1]))
+                intent[4].set_exception(RuntimeError('storage writer stopped'))
+
+    # submit
+    # INFO:     Queues a writing statement for the next transaction.
+    # ARGS:     db_path (str) -> path of the database, sql (str) -> statement, params (tuple or iterable) -> values of the placeholders, many (bool) -> executemany instead of execute
+    # RETURNS:  concurrent.futures.Future of the statement
+    def submit(self, db_path, sql, params, many):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self.lock:
+            if self.stopped:
+                future.set_exception(RuntimeError('storage writer stopped'))
+            else:
+                self.intents.put((db_path, sql, params, many, future))
+        return future
+
+    # commit
+    # INFO:     Executes the collected statements in one transaction per database and resolves their futures after the commit. Each statement runs in its own savepoint,
+    #           so a failing statement (also one of many sets of values) leaves no changes behind.
+    # ARGS:     batch (list) -> collected statements as (db_path, sql, params, many, future)
+    # RETURNS:  /
+    def commit(self, batch):
+        databases = {}
+        for intent in batch:
+            databases.setdefault(intent[0], []).append(intent)
+        for (db_path, intents) in databases.items():
+            done = []
+            db_connector = None
+            try:
+                db_connector = self.storage.connection(db_path)
+                db_connector.execute('BEGIN')
+                for (_, sql, params, many, future) in intents:
+                    db_connector.execute('SAVEPOINT intent')
+                    try:
+                        if many:
+                            cursor = db_connector.executemany(sql, params)
+                        else:
+                            cursor = db_connector.execute(sql, params)
+                        done.append((future, cursor.rowcount))
+                    except Exception as e:
+                        self.logger.error('write failed: {} ({})'.format(e, sql))
+                        db_connector.execute('ROLLBACK TO intent')
+                        future.set_exception(e)
+                    db_connector.execute('RELEASE intent')
+                db_connector.commit()
+            except Exception as e:
+                self.logger.exception('commit to {} failed: {}'.format(db_path, e))
+                if db_connector is not None and db_connector.in_transaction:
+                    db_connector.rollback()
+                for intent in intents:
+                    if not intent[4].done():
+                        intent[4].set_exception(e)
+                continue
+            self.writes += len(intents)
+            self.commits += 1
+            for (future, rowcount) in done:
+                future.set_result(rowcount)
+
+    # exit
+    # INFO:     Stops the writer once all queued statements are committed.
+    # ARGS:     /
+    # RETURNS:  /
+    def exit(self):
+        self.is_running = False
+        self.intents.put(None)
+
+
+# the storage shared by all modules
+storage = Storage()
@@ -4,6 +4,7 @@ import os
 import logging
 from connectors import User, IdProvider
 from modules import CFG, DB
+from connectors.storage import storage
 import configparser
 import urllib.parse, urllib.request, urllib.error
 import json
@@ -11,12 +12,320 @@ import hashlib
 import hmac
 import time
 import binascii
-import sqlite3
+import http.client
+import socket
+from threading import Lock, Thread
+from collections import deque
+
+
+# generate_nonce
+# INFO:     Generates a nonce as used for requests to the API: 20 random hex characters followed by the current timestamp. Also used as idempotency key of reports.
+# ARGS:     /
+# RETURNS:  nonce (str)
+def generate_nonce():
+    return binascii.hexlify(os.urandom(10)).decode()+str(int(time.time()))
+
+
+# API_Error
+# INFO:     Raised by VCS_ID.send_post_request instead of returning False if the API answers with an error status and the caller asked for it.
+# ARGS:     status (int) -> HTTP status code of the response
+# RETURNS:  /
+class API_Error(Exception):
+
+    def __init__(self, status):
+        Exception.__init__(self, "API responded with status " + str(status))
+        self.status = status
+
+
+# ConnectionPool
+# INFO:     Keeps HTTP(S) connections to the API open between requests, so that every request does not pay a new TCP and TLS handshake. Idle connections are kept per host.
+#           A kept connection which was closed by the server in the meantime is replaced transparently by a new one.
+# ARGS:     connect_timeout (float) -> timeout in seconds for establishing a connection, read_timeout (float) -> timeout in seconds for each read of a response, max_idle (int) -> maximum number of idle connections kept per host
+# RETURNS:  /
+class ConnectionPool(object):
+
+    # exceptions indicating that a kept connection was closed by the server while idle
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+    def __init__(self, connect_timeout=5.0, read_timeout=10.0, max_idle=2):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.lock = Lock()
+        self.idle = {}
+
+    # request
+    # INFO:     Sends a request over a kept connection to the host of url (or a new one if there is none) and reads the complete response.
+    # ARGS:     method (str) -> HTTP method, url (str) -> target URL, body (bytes) -> request body, headers (dict) -> request headers, read_timeout (float, optional) -> overrides the read timeout of the pool
+    # RETURNS:  Tuple (int status, HTTPMessage headers, bytes body) of the response. Raises socket.timeout or OSError if the API could not be reached.
+    def request(self, method, url, body=None, headers={}, read_timeout=None):
+        parsed = urllib.parse.urlsplit(url)
+        host = (parsed.scheme, parsed.hostname, parsed.port)
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+
+        while True:
+            (conn, reused) = self.acquire(host)
+            conn.sock.settimeout(self.read_timeout if read_timeout is None else read_timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp_raw = resp.read()
+            except self.STALE_CONNECTION_ERRORS:
+                conn.close()
+                # only a kept connection may have gone stale, retry once with a new connection
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(host, conn)
+            return (resp.status, resp.headers, resp_raw)
+
+    # acquire
+    # INFO:     Takes an idle connection to host from the pool, or opens a new one with the connect timeout.
+    # ARGS:     host (tuple) -> (scheme, hostname, port)
+    # RETURNS:  Tuple (HTTPConnection connection, bool reused)
+    def acquire(self, host):
+        with self.lock:
+            if self.idle.get(host):
+                return (self.idle[host].pop(), True)
+        (scheme, hostname, port) = host
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(hostname, port, timeout=self.connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(hostname, port, timeout=self.connect_timeout)
+        conn.connect()
+        return (conn, False)
+
+    # release
+    # INFO:     Puts a connection back into the pool after its response was read completely. Closes it if the pool for host is full.
+    # ARGS:     host (tuple) -> (scheme, hostname, port), conn (HTTPConnection) -> connection to release
+    # RETURNS:  /
+    def release(self, host, conn):
+        with self.lock:
+            connections = self.idle.setdefault(host, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    # close
+    # INFO:     Closes all idle connections.
+    # ARGS:     /
+    # RETURNS:  /
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
+
+
+# NonceStore
+# INFO:     Remembers the nonces of API responses for as long as a replay of the response could pass the timestamp verification. Nonces are kept in memory, grouped into partitions of 'partition' seconds, and whole partitions expire at once.
+#           All nonces are also written to the database, so that they survive a restart. Rows of expired partitions are deleted, so the table stays bounded.
+# ARGS:     db_path (str) -> path of the nonce database, retention (int) -> time in seconds a nonce has to be remembered, partition (int) -> width of a partition in seconds
+# RETURNS:  /
+class NonceStore(object):
+
+    def __init__(self, db_path, retention, partition):
+        self.db_path = db_path
+        self.retention = retention
+        self.partition = partition
+        self.lock = Lock()
+        self.nonces = set()
+        self.partitions = deque() # (partition number, set of nonces), oldest first
+        self.loaded = False
+
+    # add
+    # INFO:     Adds a nonce to the store if it is not yet known. Expired partitions are dropped beforehand. Loads the remembered nonces from the database on first use.
+    # ARGS:     nonce (str) -> nonce to add, now (float, optional) -> current time
+    # RETURNS:  True if the nonce was unknown, False if it is known
+    def add(self, nonce, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not self.loaded:
+                self.load(now)
+            self.expire(now)
+            if nonce in self.nonces:
+                return False
+            self.remember(nonce, now)
+            storage.write(self.db_path, "INSERT OR IGNORE INTO nonces (nonce, timestamp) VALUES (?, ?)", (nonce, int(now)))
+            return True
+
+    # remember
+    # INFO:     Adds a nonce to the partition of its timestamp in memory. A nonce older than all partitions (e.g. after the clock was set back) is added to the oldest one,
+    #           so it expires together with it instead of staying in memory forever.
+    # ARGS:     nonce (str) -> nonce to add, timestamp (float) -> time the nonce was received
+    # RETURNS:  /
+    def remember(self, nonce, timestamp):
+        number = int(timestamp // self.partition)
+        if not self.partitions or self.partitions[-1][0] < number:
+            self.partitions.append((number, set()))
+        for (partition_number, partition_nonces) in reversed(self.partitions):
+            if partition_number <= number:
+                partition_nonces.add(nonce)
+                break
+        else:
+            self.partitions[0][1].add(nonce)
+        self.nonces.add(nonce)
+
+    # expire
+    # INFO:     Drops all partitions whose nonces are older than the retention time, in memory and in the database.
+    # ARGS:     now (float) -> current time
+    # RETURNS:  /
+    def expire(self, now):
+        expired = False
+        while self.partitions and (self.partitions[0][0] + 1) * self.partition + self.retention <= now:
+            (partition_number, partition_nonces) = self.partitions.popleft()
+            self.nonces.difference_update(partition_nonces)
+            expired = True
+        if expired:
+            storage.write(self.db_path, "DELETE FROM nonces WHERE timestamp < ?", (int(now - self.retention - self.partition),))
+
+    # load
+    # INFO:     Deletes all expired nonces in the database and loads the remaining ones into memory.
+    # ARGS:     now (float) -> current time
+    # RETURNS:  /
+    def load(self, now):
+        storage.write(self.db_path, "DELETE FROM nonces WHERE timestamp < ?", (int(now - self.retention - self.partition),)).result()
+        for (nonce, timestamp) in storage.query(self.db_path, "SELECT nonce, timestamp FROM nonces ORDER BY timestamp"):
+            self.remember(nonce, int(timestamp))
+        self.loaded = True
+
+
+# CircuitBreaker
+# INFO:     Tracks the outcome and latency of the recent requests to the API. If too many of them fail, the breaker opens and requests are dismissed immediately instead of waiting for a timeout.
+#           While open, a background thread probes the API with increasing cooldown and closes the breaker again as soon as a probe succeeds.
+#           The read timeout for requests is derived from the latency percentile of the recent successful requests.
+# ARGS:     window (int) -> number of recent requests considered, min_requests (int) -> minimum number of requests before the breaker can open, error_threshold (float) -> error rate at which the breaker opens,
+#           cooldown (float) -> initial time in seconds between probes, cooldown_max (float) -> maximum time between probes,
+#           timeout_percentile (float) -> latency percentile the timeout is derived from, timeout_factor (float) -> factor applied to the percentile, timeout_min (float) -> minimum timeout in seconds
+# RETURNS:  /
+class CircuitBreaker(object):
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+
+    def __init__(self, window=20, min_requests=4, error_threshold=0.5, cooldown=5.0, cooldown_max=60.0, timeout_percentile=0.95, timeout_factor=3.0, timeout_min=1.0):
+        # set-up for logging of breaker. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'breaker'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.cooldown_max = cooldown_max
+        self.timeout_percentile = timeout_percentile
+        self.timeout_factor = timeout_factor
+        self.timeout_min = timeout_min
+        self.timeout_max = 10.0
+
+        self.lock = Lock()
+        self.outcomes = deque(maxlen=window) # (bool success, float latency)
+        self.state = self.CLOSED
+        self.probe = None
+
+    # allow
+    # INFO:     Whether requests should be sent to the API right now.
+    # ARGS:     /
+    # RETURNS:  True if the breaker is closed, False if it is open
+    def allow(self):
+        return self.state == self.CLOSED
+
+    # record
+    # INFO:     Records the outcome of a request. Opens the breaker if the error rate of the recent requests reaches the threshold.
+    # ARGS:     success (bool) -> whether the API answered properly, latency (float) -> duration of the request in seconds
+    # RETURNS:  /
+    def record(self, success, latency):
+        with self.lock:
+            self.outcomes.append((success, latency))
+            if self.state != self.CLOSED or len(self.outcomes) < self.min_requests:
+                return
+            errors = sum(1 for (outcome, duration) in self.outcomes if not outcome)
+            if errors < self.error_threshold * len(self.outcomes):
+                return
+            self.state = self.OPEN
+        self.logger.error("{} of the last {} requests failed, dismissing requests until the API recovers".format(errors, len(self.outcomes)))
+        Thread(target=self.run_probes, daemon=True).start()
+
+    # timeout
+    # INFO:     Returns the read timeout for the next request, the latency percentile of the recent successful requests times timeout_factor, within [timeout_min, timeout_max]. Without enough successful requests, timeout_max is returned.
+    # ARGS:     /
+    # RETURNS:  timeout in seconds (float)
+    def timeout(self):
+        with self.lock:
+            latencies = sorted(duration for (outcome, duration) in self.outcomes if outcome)
+        if len(latencies) < self.min_requests:
+            return self.timeout_max
+        percentile = latencies[min(len(latencies) - 1, int(self.timeout_percentile * len(latencies)))]
+        return min(self.timeout_max, max(self.timeout_min, self.timeout_factor * percentile))
+
+    # set_probe
+    # INFO:     Sets the function used to probe the API while the breaker is open.
+    # ARGS:     function (function) -> sends a request to the API bypassing the breaker, returns True if the API answered properly
+    # RETURNS:  /
+    def set_probe(self, function):
+        self.probe = function
+
+    # run_probes
+    # INFO:     Runs in a background thread while the breaker is open. Probes the API with exponentially increasing cooldown and closes the breaker after the first successful probe.
+    # ARGS:     /
+    # RETURNS:  /
+    def run_probes(self):
+        cooldown = self.cooldown
+        while True:
+            time.sleep(cooldown)
+            try:
+                success = self.probe is not None and self.probe()
+            except Exception as e:
+                self.logger.exception("probe exception")
+                success = False
+            if success:
+                break
+            self.logger.info("API did not recover, next probe in {} s".format(cooldown))
+            cooldown = min(2*cooldown, self.cooldown_max)
+
+        with self.lock:
+            self.outcomes.clear()
+            self.state = self.CLOSED
+        self.logger.warning("API recovered, sending requests again")
+
 
 class VCS_ID(IdProvider):
 
     orgname = "VCS"
 
+    # maximum number of vends sent in one batch report request
+    REPORT_BATCH_SIZE = 50
+
+    # status codes of a batch report which mean that the API has no batch endpoint
+    BATCH_UNSUPPORTED = (404, 405, 501)
+
+    # status codes with which the API rejects a reported vend for good. All other errors are retried, as they may be caused by the configuration or the state of the API
+    REJECTED = (400, 409, 422)
+
+    # status codes which point to a wrong secret or URL in the configuration rather than to the vend
+    MISCONFIGURED = (401, 403, 404)
+
+    # responses are accepted if their timestamp differs at most this many seconds from the local time
+    TIMESTAMP_WINDOW = 30
+
+    # connections to the API and its health are shared by all instances
+    pool = ConnectionPool()
+    breaker = CircuitBreaker()
+
+    # nonces of responses are shared by all instances. A replayed response can pass the timestamp verification up to two windows after the original was received, so nonces are kept that long
+    nonces = NonceStore(os.path.join(DB, "vcs_nonces.db"), retention = 2*TIMESTAMP_WINDOW, partition = TIMESTAMP_WINDOW)
+
     # name
     # INFO:
     # ARGS:
@@ -30,6 +339,7 @@ class VCS_ID(IdProvider):
 
         # read config
         self.read_cfg(os.path.join(CFG, "vcs.cfg"))
+        self.breaker.set_probe(self.probe)
 
     # name
     # INFO:
@@ -48,25 +358,92 @@ class VCS_ID(IdProvider):
             self.logger.exception("auth exception")
             return None
 
-    # name
-    # INFO:
-    # ARGS:
-    # RETURNS:
-    def report(self, rfid, slot):
+    # report
+    # INFO:     Reports a vend to the API. The key is sent along, so that the API can recognise a repeated report of the same vend.
+    # ARGS:     rfid (str) -> RFID of the user, slot (int) -> vended slot, key (str, optional) -> idempotency key of the vend
+    # RETURNS:  True if reporting was successful, None if the API rejected the vend (see REJECTED), False otherwise
+    def report(self, rfid, slot, key=None):
         try:
-            response = self.send_post_request({"rfid":rfid, "slot":slot}, self.report_url)
+            data = {"rfid":rfid, "slot":slot}
+            if key is not None:
+                data['key'] = key
+            response = self.send_post_request(data, self.report_url, raise_errors = True)
             if response is False:
                 self.logger.critical("CRITICAL: Reporting was unsuccessful of rfid " + str(rfid) + " and slot " + str(slot))
                 return False
             else:
                 self.logger.info("RFID was known and successfully reported")
                 return True
+        except API_Error as e:
+            if e.status in self.REJECTED:
+                self.logger.critical("CRITICAL: Report of rfid " + str(rfid) + " and slot " + str(slot) + " was rejected: " + str(e))
+                return None
+            if e.status in self.MISCONFIGURED:
+                self.logger.critical("CRITICAL: Reporting was refused with status " + str(e.status) + ", check api secret and report_url in vcs.cfg. Vends are kept and retried")
+            self.logger.critical("CRITICAL: Reporting was unsuccessful of rfid " + str(rfid) + " and slot " + str(slot) + ": " + str(e))
+            return False
         except Exception as e:
             self.logger.exception("report exception")
             return False
 
 
 
+    # report_batch
+    # INFO:     Reports many vends to the API in a single signed request. The API either accepts or rejects the whole batch. Falls back to single reports if no batch endpoint
+    #           is configured, or if the API answers that it has none. In the latter case, the endpoint is not tried again until the next start. If the API rejects a batch
+    #           (see REJECTED), its vends are reported on their own, so that only the rejected ones are dropped.
+    # ARGS:     records (list) -> vends to report, dicts with 'rfid', 'slot', 'timestamp' (time of the vend) and 'key' (idempotency key)
+    # RETURNS:  List with True for every record that was reported successfully, None for every record the API rejected, False otherwise
+    def report_batch(self, records):
+        results = []
+        for start in range(0, len(records), self.REPORT_BATCH_SIZE):
+            if self.report_batch_url is None:
+                return results + IdProvider.report_batch(self, records[start:])
+
+            chunk = records[start:start+self.REPORT_BATCH_SIZE]
+            try:
+                reports = [{"rfid":record['rfid'], "slot":record['slot'], "vend_timestamp":record['timestamp'], "key":record['key']} for record in chunk]
+                response = self.send_post_request({"reports":reports}, self.report_batch_url, raise_errors = True)
+                if response is False:
+                    self.logger.critical("CRITICAL: Reporting of a batch of " + str(len(chunk)) + " vends was unsuccessful")
+                    success = False
+                else:
+                    self.logger.info("Batch of " + str(len(chunk)) + " vends successfully reported")
+                    success = True
+            except API_Error as e:
+                if e.status in self.BATCH_UNSUPPORTED:
+                    self.logger.warning("API has no batch endpoint (status " + str(e.status) + "), reporting every vend on its own")
+                    self.report_batch_url = None
+                    return results + IdProvider.report_batch(self, records[start:])
+                if e.status in self.REJECTED:
+                    self.logger.warning("Batch of " + str(len(chunk)) + " vends was rejected (status " + str(e.status) + "), reporting them on their own")
+                    chunk_results = IdProvider.report_batch(self, chunk)
+                    results += chunk_results
+                    if False in chunk_results:
+                        results += [False]*(len(records) - len(results))
+                        break
+                    continue
+                if e.status in self.MISCONFIGURED:
+                    self.logger.critical("CRITICAL: Batch reporting was refused with status " + str(e.status) + ", check api secret and report_batch_url in vcs.cfg. Vends are kept and retried")
+                self.logger.critical("CRITICAL: Reporting of a batch of " + str(len(chunk)) + " vends was unsuccessful: " + str(e))
+                success = False
+            except Exception as e:
+                self.logger.exception("report batch exception")
+                success = False
+            results += [success]*len(chunk)
+            # do not send the remaining chunks if the API is failing
+            if not success:
+                results += [False]*(len(records) - len(results))
+                break
+        return results
+
+    # is_available
+    # INFO:     Reports are only sent while the circuit breaker lets requests pass.
+    # ARGS:     /
+    # RETURNS:  True if the API is considered healthy, False otherwise
+    def is_available(self):
+        return self.breaker.allow()
+
     def info(self):
         try:
             response = self.send_post_request(None, self.info_url)
@@ -88,48 +465,80 @@ class VCS_ID(IdProvider):
 
     # name
     # INFO:
-    # ARGS:     data -> (dict) body of the POST request, url -> (string) target URL for POST request
+    # ARGS:     data -> (dict) body of the POST request, url -> (string) target URL for POST request, raise_errors -> (bool, optional) raise API_Error on an error status instead of returning False
     # RETURNS:
-    def send_post_request(self, data, url):
-        if data is None: data = {}
-        data['timestamp'] = int(time.time());
-        data['nonce'] = binascii.hexlify(os.urandom(10)).decode()+str(int(time.time()));
-        body = json.dumps(data).encode('utf8')
-        headers = {'X-SIGNATURE': hmac.new(self.api_secret, body, hashlib.sha512).hexdigest(), 'Content-Type': 'application/json'}
-        req = urllib.request.Request(url, data = body, headers = headers)
+    def send_post_request(self, data, url, raise_errors = False):
+        # while the API is unhealthy, dismiss requests immediately
+        if not self.breaker.allow():
+            self.logger.info("API is unhealthy, dismissing request to " + url)
+            return False
+
+        (body, headers) = self.sign_request(data)
 
         try:
-            resp = urllib.request.urlopen(req)
-            http_code = resp.getcode()
+            started = time.time()
+            try:
+                (http_code, resp_headers, resp_raw) = self.pool.request('POST', url, body = body, headers = headers, read_timeout = self.breaker.timeout())
+            except OSError:
+                self.breaker.record(False, time.time() - started)
+                raise
+            self.breaker.record(http_code < 500, time.time() - started)
             self.logger.debug("API responded with status " + str(http_code))
-            if http_code is not 200: 
+            if http_code >= 400:
+                self.logger.info("API responded with status " + str(http_code) + ", dismissing")
+                if raise_errors:
+                    raise API_Error(http_code)
+                return False
+            elif http_code != 200:
                 self.logger.error("This success status code is not implemented.")
                 return False
             else:
-                resp_raw = resp.read()
                 resp_json = json.loads(resp_raw.decode('utf8'))
-                if (self.verify_signature(resp.getheader('X-SIGNATURE'), resp_raw) and self.verify_timestamp(resp_json['timestamp']) and self.verify_nonce(resp_json['nonce'])):
+                if (self.verify_signature(resp_headers.get('X-SIGNATURE'), resp_raw) and self.verify_timestamp(resp_json['timestamp']) and self.verify_nonce(resp_json['nonce'])):
                     self.logger.debug("Verification of response successful.")
                     return resp_json
                 else:
                     self.logger.error("Verification of response failed.")
                     return False
-            
-        except urllib.error.HTTPError as e:
-            http_code = e.code
-            self.logger.info("API responded with status " + str(http_code) + ", dismissing")
+
+        except API_Error:
+            raise
+        except socket.timeout:
+            self.logger.error("API did not respond in time, dismissing")
+            return False
+        except OSError as e:
+            self.logger.error("API could not be reached: {}".format(e))
             return False
         except Exception as e:
             self.logger.exception("Unexpected exception")
             return False
-        
-
-
-
-
 
 
 
+    # sign_request
+    # INFO:     Adds timestamp and nonce to the data of a request, encodes it and signs it with the API secret.
+    # ARGS:     data -> (dict) body of the POST request, may be None
+    # RETURNS:  Tuple (bytes body, dict headers) of the request
+    def sign_request(self, data):
+        if data is None: data = {}
+        data['timestamp'] = int(time.time());
+        data['nonce'] = generate_nonce();
+        body = json.dumps(data).encode('utf8')
+        headers = {'X-SIGNATURE': hmac.new(self.api_secret, body, hashlib.sha512).hexdigest(), 'Content-Type': 'application/json'}
+        return (body, headers)
+
+    # probe
+    # INFO:     Used by the circuit breaker to check whether the API recovered. Sends an info request bypassing the breaker, any answer without server error counts as recovered.
+    # ARGS:     /
+    # RETURNS:  True if the API answered, False otherwise
+    def probe(self):
+        (body, headers) = self.sign_request(None)
+        try:
+            (http_code, resp_headers, resp_raw) = self.pool.request('POST', self.info_url, body = body, headers = headers, read_timeout = self.breaker.timeout_max)
+        except OSError as e:
+            self.logger.debug("probe failed: {}".format(e))
+            return False
+        return http_code < 500
 
     def verify_signature(self, signature, body):
         self.logger.debug("Request has signature: "+signature)
@@ -143,7 +552,7 @@ class VCS_ID(IdProvider):
 
     
     def verify_timestamp(self, timestamp):
-        timedelta = 30 #sec
+        timedelta = self.TIMESTAMP_WINDOW
         self.logger.debug("Request has timestamp: "+str(timestamp))
         if (timestamp < time.time() + timedelta and timestamp > time.time() - timedelta):
             self.logger.debug('Timestamp is within acceptance interval. Verification of timestamp successful.')
@@ -156,18 +565,11 @@ class VCS_ID(IdProvider):
 
     def verify_nonce(self, nonce):
         self.logger.debug('Request has nonce: '+str(nonce))
-        db_connector = sqlite3.connect(os.path.join(DB, "vcs_nonces.db"))
-        db = db_connector.cursor()
-        db.execute('SELECT * FROM nonces WHERE nonce = ?', (nonce,))
-        if (db.fetchone() == None):
-            db.execute("INSERT INTO nonces (nonce, timestamp) VALUES (?, ?)", (str(nonce), str(int(time.time()))))
-            db_connector.commit()
+        if self.nonces.add(str(nonce)):
             self.logger.debug("Nonce was unknown. Verification of nonce successful.")
-            db_connector.close()
             return True
         else:
             self.logger.error("Nonce was known. Verification of nonce failed.")
-            db_connector.close()
             return False
 
 
@@ -184,6 +586,10 @@ class VCS_ID(IdProvider):
         self.auth_url = str(config['api']['auth_url'])
         self.report_url = str(config['api']['report_url'])
         self.info_url = str(config['api']['info_url'])
+        self.report_batch_url = config['api'].get('report_batch_url', fallback=None) or None
+        self.pool.connect_timeout = config['api'].getfloat('connect_timeout', fallback=5.0)
+        self.pool.read_timeout = config['api'].getfloat('read_timeout', fallback=10.0)
+        self.breaker.timeout_max = self.pool.read_timeout
 
 
 
@@ -3,16 +3,23 @@ import logging
 import time
 import os.path
 import signal
-from threading import Thread
+from threading import Thread, Lock
 import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from modules.rfid_reader import RFID_Reader
 from modules.telegram_bot import Telegram_Bot
 from modules.mdb_handler import MDB_Handler
+from modules.report_worker import Report_Worker
+from modules.vend_history import Vend_History
+from modules.migrations import migrate_all
+from modules.event_bus import Event_Bus
 
 from connectors import User
 from connectors.database import DB_ID
 from connectors.vcs import VCS_ID
+from connectors.credit_cache import credit_cache
+from connectors.storage import storage
 ID_PROVIDERS = (VCS_ID, DB_ID)
 
 # general settings
@@ -23,6 +30,16 @@ DB = os.path.join(PATH, "/database/")
 
 class Main(Thread):
 
+    # types of events handled by the main loop, see event_queue
+    EVENT_RFID = 'RFID'
+    EVENT_SHUTDOWN = 'SHUTDOWN'
+
+    # a lookup stops waiting for the remaining ID providers as soon as one of them reports at least this many credits
+    LOOKUP_SUFFICIENT_CREDITS = 10
+
+    # number of concurrent lookups per ID provider
+    LOOKUP_WORKERS = 2
+
     # __init__
     # INFO:     Sets up logging and threads of this program.
     # ARGS:     -
@@ -38,11 +55,19 @@ class Main(Thread):
         # setting of global minimum logging level
         logging.disable(logging.NOTSET)
 
-        # start services
+        # create or upgrade all databases before any module accesses them
+        migrate_all()
+
+        # single wakeup source of the main loop: all RFID taps and shutdown requests are queued here as (type, data)
+        self.event_queue = queue.Queue()
+
+        # start services, callbacks into the event queue are set before the threads start so that no event is missed
         logging.info('starting threads')
         self.tbot = Telegram_Bot()
+        self.tbot.set_shutdown_callback(self.request_shutdown)
         self.tbot.start()
         self.rfid = RFID_Reader()
+        self.rfid.set_detected_callback(self.queue_rfid)
         self.rfid.start()
         self.mdbh = MDB_Handler()
         self.mdbh.start()
@@ -57,24 +82,42 @@ class Main(Thread):
         Thread.__init__(self, daemon=True)
         self.is_running = False
 
-        # Set up queue and default user data
-        self.vending_queue = queue.Queue()
+        # Set up default user data
         self.current_uid = 0
         self.current_credits = 0
         self.current_user = User()
         self.current_org = 'undefined'
-
-        # set up callback functions for the MDB reader
-        self.mdbh.set_dispensed_callback(self.queue_vending)
+        self.current_tapped = None
+        self.current_session = None
+        # the credits of the current user are set by this thread and booked by the MDB reader
+        self.credits_lock = Lock()
+
+        # set up callback functions for the MDB reader. Dispensed vends are booked on the credits by the MDB reader itself, then reported and recorded by workers of its
+        # event bus, the fill status separately, as it may notify the admins via Telegram
+        self.mdbh.set_vended_callback(self.book_vending)
+        self.mdbh.events.subscribe(Event_Bus.DISPENSED, self.queue_vending)
+        self.mdbh.events.subscribe(Event_Bus.DISPENSED, self.update_fillstatus)
         self.mdbh.set_available_callback(self.credits_available)
 
-        # initialize ID providers
+        # initialize ID providers and a bounded worker pool per provider used to query them concurrently. A lookup which outlives its deadline keeps its worker
+        # until the request ends, with separate pools such lookups of a slow provider do not delay the other providers
         self.providers = {}
+        self.lookup_pools = {}
         for connector in ID_PROVIDERS:
             self.providers[connector.orgname] = connector()
+            self.lookup_pools[connector.orgname] = ThreadPoolExecutor(max_workers=self.LOOKUP_WORKERS, thread_name_prefix='lookup-' + connector.orgname)
+        self.last_lookup = {'org': None, 'durations': {}}
+
+        # vends are reported by a separate thread, so that a slow report does not delay the next authentication
+        self.reporter = Report_Worker(self.providers)
+        self.reporter.start()
+
+        # local history of all vends, its statistics are shown by the telegram bot
+        self.history = Vend_History()
+        self.tbot.set_stats_callback(self.history.get_stats)
 
     # run
-    # INFO:     Main thread of the program. Checks vending queue and rfid queue and coordinates authentication with the APIs
+    # INFO:     Main thread of the program. Blocks on the event queue and coordinates authentication with the APIs as soon as an event arrives.
     # ARGS:     -
     # RETURNS:  -
     def run(self):
@@ -83,54 +126,47 @@ class Main(Thread):
         try:
             while self.is_running:
 
-                if self.tbot.shutdown:
-                    self.stop(reason = "Internal Signal")
-                    return
-
-                # first queue: vending
-                if not self.vending_queue.empty():
-                    self.logger.debug('vending queue non-empty, processing queue')
-                    try:
-                        # get vending information and report vend to the organisation of the user
-                        (slot_id, rfid, org) = self.vending_queue.get()
-                        if self.providers[org].report(rfid, slot_id):
-                            self.logger.debug("report of vending for {} successful".format(org))
-                        else:
-                            self.logger.error("report of vending for {} failed".format(org))
+                # block until the next event, there is no polling interval
+                (event, data) = self.event_queue.get()
 
-                    except Exception as e:
-                        self.logger.exception("exception: {}".format(e))
-                        continue
+                if event == self.EVENT_SHUTDOWN:
+                    self.stop(reason = data)
+                    return
 
-                # second queue: RFID reader
-                if not self.rfid.rfid_queue.empty():
-                    self.logger.debug('rfid queue non-empty, processing queue')
+                # rfid event: look up the rfid in all authentication APIs
+                elif event == self.EVENT_RFID:
+                    self.logger.debug('processing rfid event')
                     try:
-                        # get rfid from queue and look it up in all authentication APIs
-                        self.current_uid = self.rfid.rfid_queue.get()
+                        self.current_uid = data
+                        self.current_tapped = time.monotonic()
                         # look up the rfid as id: False if unknown, array of (credits, user, org) if rfid is known. If rfid is known, enable vending
                         id = self.uid_lookup(self.current_uid)
                         if id is not False:
-                            (self.current_credits, self.current_user, self.current_org) = id
+                            with self.credits_lock:
+                                (self.current_credits, self.current_user, self.current_org) = id
                             self.logger.info("rfid {} was found in {} with {} credits".format(self.current_uid, self.current_org, self.current_credits))
                             if self.current_credits > 0:
-                                self.mdbh.open_session = True # This allows the MDB reader to proceed with the vend
+                                # This allows the MDB reader to proceed with the vend
+                                with self.credits_lock:
+                                    self.current_session = self.mdbh.request_session(rfid=self.current_uid, org=self.current_org, tapped=self.current_tapped)
                             else:
                                 # send display request to the MDB reader and reset user data
-                                self.mdbh.display_queue.put({'top': 'Kein Guthaben', 'bot': ':\'(', 'duration': 3})
-                                (self.current_credits, self.current_user, self.current_org) = (0, User(), 'undefined')
+                                self.mdbh.display.show('Kein Guthaben', ':\'(', 3)
+                                with self.credits_lock:
+                                    (self.current_credits, self.current_user, self.current_org, self.current_session) = (0, User(), 'undefined', None)
                         else:
-                            self.mdbh.display_queue.put({'top': 'Legi/Benutzer', 'bot': 'unbekannt', 'duration': 3})
+                            self.mdbh.display.show('Legi/Benutzer', 'unbekannt', 3)
                             self.logger.info("rfid {} was unknown, dismissing".format(self.current_uid))
-                            (self.current_credits, self.current_user, self.current_org) = (0, User(), 'undefined')
+                            with self.credits_lock:
+                                (self.current_credits, self.current_user, self.current_org, self.current_session) = (0, User(), 'undefined', None)
                             self.mdbh.open_session = False
 
                     except Exception as e:
                         self.logger.exception("exception: {}".format(e))
                         continue
 
-                # sleep to limit loop frequency
-                time.sleep(0.2)
+                else:
+                    self.logger.error("Encountered unexpected event: " + str(event))
 
         except KeyboardInterrupt:  # on CTRL-C, stop all threads and shut down
             self.stop('KeyboardInterrupt')
@@ -143,17 +179,27 @@ class Main(Thread):
 
         self.logger.error("SHUTDOWN INITIALISED BY " + reason)
 
-        # stop all threads manually and wait for threads to finish
+        # stop all threads manually and wait for threads to finish. The vends published by the MDB reader are handled before the report worker stops, so that all of them are in the outbox
         self.is_running = False
+        self.logger.info("mdb metrics: {}".format(self.mdbh.get_metrics()))
         self.mdbh.exit()
         if self.mdbh.isAlive():
             self.mdbh.join(5.0)
+        self.mdbh.events.exit()
+        self.logger.info("event metrics: {}".format(self.mdbh.events.get_metrics()))
+        self.logger.info("report metrics: {}".format(self.reporter.get_metrics()))
+        self.reporter.exit()
+        if self.reporter.isAlive():
+            self.reporter.join(5.0)
         self.rfid.exit()
         if self.rfid.isAlive():
             self.rfid.join(5.0)
         self.tbot.exit()
         if self.tbot.isAlive():
             self.tbot.join(5.0)
+        for lookup_pool in self.lookup_pools.values():
+            lookup_pool.shutdown(wait=False)
+        storage.stop_writer()
 
         # end the script gracefully
         self.logger.info("SHUTDOWN FINALISED")
@@ -164,23 +210,59 @@ class Main(Thread):
     # ARGS:     slot_id (int) -> ID of the slot that was requested.
     # RETURNS:  Available credits (int) of the user.
     def credits_available(self, slot_id):
-        if self.current_credits > 0:
-            return self.current_credits
+        with self.credits_lock:
+            if self.current_credits > 0:
+                return self.current_credits
         return 0
 
+    # book_vending
+    # INFO:     Is set as vended callback of the MDB reader and called by its thread as soon as a vend was dispensed, so that a following vend request or lookup already sees
+    #           the new credits. The vend is booked for the user of its session. The credits of the current user are only decremented if the vend belongs to the current session.
+    # ARGS:     session (dict) -> session of the vend, as requested in run, slot_id (int) -> ID of the slot that was vended
+    # RETURNS:  -
+    def book_vending(self, session, slot_id):
+        with self.credits_lock:
+            if session['id'] == self.current_session:
+                self.current_credits -= 1
+        credit_cache.decrement(session['org'], session['rfid'])
+
     # queue_vending
-    # INFO:     Appends a vend event to the vending queue to be reported to the corresponding API on the next iteration of the main loop.
-    # ARGS:     slot_id (int) -> ID of the slot that was requested.
+    # INFO:     Subscribed to the DISPENSED events of the MDB reader. Hands a vend to the report worker to be reported to the corresponding API and records it in the local history.
+    # ARGS:     event (dict) -> DISPENSED event with the session (as requested in run) and the slot that was requested
+    # RETURNS:  -
+    def queue_vending(self, event):
+        session = event['session']
+        self.reporter.queue_report(event['slot'], session['rfid'], session['org'])
+        self.history.record(event['slot'], session['org'], latency=None if session['tapped'] is None else time.monotonic() - session['tapped'])
+
+    # update_fillstatus
+    # INFO:     Subscribed to the DISPENSED events of the MDB reader. Decrements the fill status of the slot in the telegram bot.
+    # ARGS:     event (dict) -> DISPENSED event with the slot that was requested
     # RETURNS:  -
-    def queue_vending(self, slot_id):
-        self.current_credits -= 1
-        self.vending_queue.put((slot_id, self.current_uid, self.current_org))
-        self.tbot.update_fillstatus_callback(slot_id)
+    def update_fillstatus(self, event):
+        self.tbot.update_fillstatus_callback(event['slot'])
+
+    # queue_rfid
+    # INFO:     Is set as callback of the RFID reader. Appends a detected rfid to the event queue, which wakes up the main loop immediately.
+    # ARGS:     rfid (str) -> UID of the RFID tag as read by the RFID reader
+    # RETURNS:  -
+    def queue_rfid(self, rfid):
+        self.event_queue.put((self.EVENT_RFID, rfid))
+
+    # request_shutdown
+    # INFO:     Can be called from any thread to make the main loop shut down all threads.
+    # ARGS:     reason (str) -> title for the shutdown reason
+    # RETURNS:  -
+    def request_shutdown(self, reason='Internal Signal'):
+        self.event_queue.put((self.EVENT_SHUTDOWN, reason))
 
     # uid_lookup
-    # INFO:     looks up 'rfid' from RFID reader in all identification providers and returns info on user, available credits and the authenticating organisation
+    # INFO:     looks up 'rfid' from RFID reader in all identification providers concurrently and returns info on user, available credits and the authenticating organisation
+    #           answers are taken from and stored in the shared credit cache
     #           if multiple identification providers recognize 'rfid', the match with the highest amount of credits is chosen and returned
+    #           each identification provider has to answer within its auth_timeout, otherwise its answer is dismissed. Once a match has LOOKUP_SUFFICIENT_CREDITS, the remaining providers are not waited for
     #           if no identification provides recognize 'rfid', False is returned
+    #           the answering organisation and the duration of each provider's answer are kept in last_lookup
     # ARGS:     rfid (int) -> RFID to be identified as read by RFID reader
     # RETURNS:  Array (int credits, User user, str org) with relevant info on the user if rfid is known, False otherwise
     def uid_lookup(self, rfid):
@@ -189,31 +271,82 @@ class Main(Thread):
         user = None
         org = None
         best_result = (credits, user, org)
+        durations = {}
 
-        # if there already is a vending in progress, dismiss
-        if not self.vending_queue.empty():
-            self.logger.error('vending still in progress, dismissing rfid authentication')
-            return False
-
+        # providers with a cached answer are not asked again
+        uncached = []
         for id_provider in list(self.providers.values()):
-            # try to authenticate user with this id provider
-            user = id_provider.auth(rfid)
-            # if a valid user is found, update best_result if this org increases the user's available credits
-            if user is not None:
-                org = id_provider.orgname
-                credits = user.credits
-                self.logger.debug('rfid %s matched from %s with %d credits', rfid, org, credits)
-                if best_result[0] is None or best_result[0] < credits:
-                    best_result = (credits, user, org)
+            user = credit_cache.get(id_provider.orgname, rfid)
+            if user is None:
+                uncached.append(id_provider)
+                continue
+            self.logger.debug('rfid %s matched from %s with %d credits in cache', rfid, id_provider.orgname, user.credits)
+            durations[id_provider.orgname] = 0.0
+            if best_result[0] is None or best_result[0] < user.credits:
+                best_result = (user.credits, user, id_provider.orgname)
+        if best_result[0] is not None and best_result[0] >= self.LOOKUP_SUFFICIENT_CREDITS:
+            uncached = []
+
+        # start authentication with all remaining id providers at once, each with its own deadline
+        started = time.time()
+        pending = {}
+        for id_provider in uncached:
+            future = self.lookup_pools[id_provider.orgname].submit(self.timed_auth, id_provider, rfid)
+            pending[future] = (id_provider, started + id_provider.auth_timeout)
+
+        while pending:
+            # wait for the next answer, but at most until the earliest deadline
+            timeout = max(0, min(deadline for (id_provider, deadline) in pending.values()) - time.time())
+            done, not_done = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                (id_provider, deadline) = pending.pop(future)
+                (user, duration) = future.result()
+                durations[id_provider.orgname] = duration
+                # if a valid user is found, update best_result if this org increases the user's available credits
+                if user is not None:
+                    org = id_provider.orgname
+                    credits = user.credits
+                    credit_cache.put(org, rfid, user)
+                    self.logger.debug('rfid %s matched from %s with %d credits after %.3f s', rfid, org, credits, duration)
+                    if best_result[0] is None or best_result[0] < credits:
+                        best_result = (credits, user, org)
+
+            # dismiss all providers which missed their deadline
+            for future, (id_provider, deadline) in list(pending.items()):
+                if deadline <= time.time():
+                    pending.pop(future)
+                    future.cancel()
+                    self.logger.warning('%s did not answer within %.1f s, dismissing', id_provider.orgname, id_provider.auth_timeout)
+
+            # the best result so far is good enough, do not wait for the remaining providers
+            if pending and best_result[0] is not None and best_result[0] >= self.LOOKUP_SUFFICIENT_CREDITS:
+                self.logger.debug('rfid %s has sufficient credits, not waiting for %s', rfid, ', '.join(id_provider.orgname for (id_provider, deadline) in pending.values()))
+                break
+
+        self.last_lookup = {'org': best_result[2], 'durations': durations}
 
         # return False if the user is unknown or the result with the highest number of available credits if user is known
         if best_result[1] is None:
             self.logger.info('rfid %s had no match', rfid)
             return False
         else:
-            self.logger.info('rfid %s matched from %s with %d credits as best result', best_result[1].rfid, best_result[2], best_result[0])
+            self.logger.info('rfid %s matched from %s with %d credits as best result, answered after %.3f s', best_result[1].rfid, best_result[2], best_result[0], durations[best_result[2]])
             return best_result
 
+    # timed_auth
+    # INFO:     Runs the authentication of 'rfid' with one identification provider and measures its duration. Executed in the lookup pool of the provider.
+    # ARGS:     id_provider (IdProvider) -> identification provider to ask, rfid (int) -> RFID to be identified
+    # RETURNS:  Tuple (User user, float duration), user is None if unknown or on error
+    def timed_auth(self, id_provider, rfid):
+        started = time.time()
+        try:
+            user = id_provider.auth(rfid)
+        except Exception as e:
+            self.logger.exception("auth exception of {}: {}".format(id_provider.orgname, e))
+            user = None
+        return (user, time.time() - started)
+
 
 
 # MAIN EXECUTION
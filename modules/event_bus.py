@@ -0,0 +1,114 @@
+import logging
+import time
+import queue
+from threading import Thread, Lock
+
+
+# Event_Bus
+# INFO:     In-process bus between the MDB handler and the rest of the program. Publishing only appends the event to the queue of every subscriber and never blocks, so the
+#           publishing thread does not wait for disk or network. Every subscriber is run by its own worker thread, which handles its events in the order they were published.
+#           A slow subscriber thus delays neither the publisher nor the other subscribers.
+# ARGS:     /
+# RETURNS:  /
+class Event_Bus(object):
+
+    # event types published by MDB_Handler, see there for the data of the events
+    VEND_APPROVED = 'VEND_APPROVED'
+    DISPENSED = 'DISPENSED'
+    SESSION_ENDED = 'SESSION_ENDED'
+
+    def __init__(self):
+        # set-up for logging of events. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'events'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        self.lock = Lock()
+        self.subscribers = {} # event type -> list of Subscriber
+
+    # subscribe
+    # INFO:     Starts a worker thread which calls function for every published event of the given type. Can be called from any thread.
+    # ARGS:     type (str) -> event type, function (function) -> subscriber, called with the event (dict with 'type', 'timestamp' and the data of the event)
+    # RETURNS:  Subscriber, the worker thread of the subscription
+    def subscribe(self, type, function):
+        subscriber = Subscriber(type, function)
+        subscriber.start()
+        with self.lock:
+            self.subscribers[type] = self.subscribers.get(type, []) + [subscriber]
+        return subscriber
+
+    # publish
+    # INFO:     Hands an event to all subscribers of its type without waiting for them.
+    # ARGS:     type (str) -> event type, **data -> data of the event
+    # RETURNS:  /
+    def publish(self, type, **data):
+        event = dict(data, type=type, timestamp=time.time())
+        # the lists of subscribers are replaced on subscribe, never changed, so they are read without the lock
+        for subscriber in self.subscribers.get(type, ()):
+            subscriber.events.put(event)
+
+    # get_metrics
+    # INFO:     Returns the number of pending, handled and failed events of every subscriber.
+    # ARGS:     /
+    # RETURNS:  dict subscriber name -> dict with the metrics
+    def get_metrics(self):
+        with self.lock:
+            subscribers = [subscriber for subscribers in self.subscribers.values() for subscriber in subscribers]
+        return {subscriber.name: {'pending': subscriber.events.qsize(), 'handled': subscriber.handled, 'failed': subscriber.failed} for subscriber in subscribers}
+
+    # exit
+    # INFO:     Shuts down all subscribers after they handled the events published so far.
+    # ARGS:     timeout (float, optional) -> seconds to wait for each subscriber
+    # RETURNS:  /
+    def exit(self, timeout=5.0):
+        with self.lock:
+            subscribers = [subscriber for subscribers in self.subscribers.values() for subscriber in subscribers]
+        for subscriber in subscribers:
+            subscriber.exit()
+        for subscriber in subscribers:
+            if subscriber.is_alive():
+                subscriber.join(timeout)
+
+
+# Subscriber
+# INFO:     Worker thread of a subscription to the event bus. Calls its function for every queued event, exceptions of the function are logged and do not stop the thread.
+# ARGS:     type (str) -> event type, function (function) -> subscriber
+# RETURNS:  /
+class Subscriber(Thread):
+
+    def __init__(self, type, function):
+        self.logger = logging.getLogger('events')
+
+        Thread.__init__(self, daemon=True, name='{} {}'.format(type, getattr(function, '__qualname__', function)))
+        self.is_running = False
+        self.type = type
+        self.function = function
+        self.events = queue.Queue()
+        self.handled = 0
+        self.failed = 0
+
+    # run
+    # INFO:     Main thread of this class. Blocks on the event queue and calls the function for every event until exit() is called.
+    # ARGS:     /
+    # RETURNS:  /
+    def run(self):
+        self.is_running = True
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            try:
+                self.function(event)
+                self.handled += 1
+            except Exception as e:
+                self.failed += 1
+                self.logger.exception("exception in {}: {}".format(self.name, e))
+        self.is_running = False
+
+    # exit
+    # INFO:     Stops this thread once the events queued so far are handled.
+    # ARGS:     /
+    # RETURNS:  /
+    def exit(self):
+        self.events.put(None)
@@ -0,0 +1,138 @@
+import os
+import sys
+import argparse
+import csv
+import io
+import json
+import time
+from datetime import datetime, timedelta
+
+from modules import DB
+from connectors.storage import storage
+
+
+# sources of an export: database, query and columns. The date range is applied to the indexed timestamp column, if there is one
+SOURCES = {
+    'vends':   {'db_path': os.path.join(DB, "history.db"), 'table': 'vends', 'columns': ('id', 'timestamp', 'slot', 'org', 'latency'), 'timestamp': 'timestamp'},
+    'reports': {'db_path': os.path.join(DB, "tbot.db"), 'table': 'reports', 'columns': ('timestamp', 'ID', 'text'), 'timestamp': 'timestamp'},
+    'usage':   {'db_path': os.path.join(DB, "users.db"), 'table': 'users', 'columns': ('rfid', 'name', 'usage'), 'timestamp': None},
+}
+
+FORMATS = ('csv', 'jsonl')
+
+# number of rows fetched from the database at once, bounds the memory of an export
+FETCH_SIZE = 500
+
+
+# parse_date
+# INFO:     Converts a date as YYYY-MM-DD (local time) into a timestamp
+# ARGS:     date (str) -> date to convert, end (bool, optional) -> return the end of the day instead of its start
+# RETURNS:  timestamp (float), None if date is None
+def parse_date(date, end=False):
+    if date is None:
+        return None
+    day = datetime.strptime(date, '%Y-%m-%d')
+    if end:
+        day += timedelta(days=1)
+    return time.mktime(day.timetuple())
+
+
+# rows
+# INFO:     Generator over the rows of a source, fetched in chunks of FETCH_SIZE. Date filters are range conditions on the indexed timestamp column.
+# ARGS:     source (str) -> key of SOURCES, start (float, optional) -> first timestamp to include, end (float, optional) -> first timestamp to exclude
+# RETURNS:  generator of dicts with the columns of the source
+def rows(source, start=None, end=None):
+    definition = SOURCES[source]
+    if not os.path.exists(definition['db_path']):
+        raise FileNotFoundError('database {} of {} does not exist'.format(definition['db_path'], source))
+    query = 'SELECT {} FROM {}'.format(', '.join(definition['columns']), definition['table'])
+    conditions = []
+    params = []
+    if definition['timestamp'] is not None:
+        if start is not None:
+            conditions.append('{} >= ?'.format(definition['timestamp']))
+            params.append(start)
+        if end is not None:
+            conditions.append('{} < ?'.format(definition['timestamp']))
+            params.append(end)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY {}'.format(definition['timestamp'])
+    cursor = storage.connection(definition['db_path']).execute(query, params)
+    try:
+        while True:
+            chunk = cursor.fetchmany(FETCH_SIZE)
+            if not chunk:
+                break
+            for row in chunk:
+                yield dict(zip(definition['columns'], row))
+    finally:
+        cursor.close()
+
+
+# to_csv
+# INFO:     Generator formatting rows as CSV lines, starting with a header line
+# ARGS:     rows (iterable) -> dicts as yielded by rows(), columns (tuple) -> column names
+# RETURNS:  generator of str
+def to_csv(rows, columns):
+    line = io.StringIO()
+    writer = csv.DictWriter(line, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+    if line.getvalue():
+        yield line.getvalue()
+
+
+# to_jsonl
+# INFO:     Generator formatting rows as JSON lines
+# ARGS:     rows (iterable) -> dicts as yielded by rows(), columns (tuple) -> column names, unused
+# RETURNS:  generator of str
+def to_jsonl(rows, columns):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+# export
+# INFO:     Streams a source in the given format into a text file. Only FETCH_SIZE rows are held in memory at once.
+# ARGS:     source (str) -> key of SOURCES, format (str) -> 'csv' or 'jsonl', output (file) -> writable text file, start (float, optional) -> first timestamp to include,
+#           end (float, optional) -> first timestamp to exclude
+# RETURNS:  number of exported rows (int)
+def export(source, format, output, start=None, end=None):
+    if source not in SOURCES:
+        raise ValueError('unknown source {}'.format(source))
+    if format not in FORMATS:
+        raise ValueError('unknown format {}'.format(format))
+    count = 0
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+    formatter = to_csv if format == 'csv' else to_jsonl
+    for line in formatter(counted(rows(source, start, end)), SOURCES[source]['columns']):
+        output.write(line)
+    return count
+
+
+# main executable, run from the root of the repository as: python -m modules.export <source> [--format ...] [--from ...] [--to ...] [--output ...]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exports the vend history, the usage of special users or the problem reports.')
+    parser.add_argument('source', choices=sorted(SOURCES))
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--from', dest='start', help='first day to export (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='end', help='last day to export (YYYY-MM-DD)')
+    parser.add_argument('--output', '-o', help='output file, stdout if omitted')
+    args = parser.parse_args()
+
+    output = sys.stdout if args.output is None else open(args.output, 'w', newline='', encoding='utf8')
+    try:
+        count = export(args.source, args.format, output, start=parse_date(args.start), end=parse_date(args.end, end=True))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        storage.close()
+    print('{} row(s) exported'.format(count), file=sys.stderr)
@@ -0,0 +1,121 @@
+import json
+import logging
+import time
+from threading import Lock
+
+from connectors.storage import storage
+
+
+# Inventory_Ledger
+# INFO:     Append-only ledger of all changes of the slot contents (vends, refills and changes of the maximum amount). The fill levels are computed incrementally from the events
+#           in memory, the ledger only appends one row per event. Every SNAPSHOT_INTERVAL events the fill levels are saved as a snapshot, so a restart only replays the events
+#           after the newest snapshot. If the ledger is empty, it is seeded from the legacy automat table. The tables are created by modules/migrations.py.
+# ARGS:     db_path (str) -> path of the database holding the ledger (tbot.db)
+# RETURNS:  /
+class Inventory_Ledger(object):
+
+    # event types
+    VEND = 'VEND'       # one drink was dispensed from a slot
+    SET = 'SET'         # the amount of a slot was set by an admin
+    REFILL = 'REFILL'   # all slots were filled to their maximum amount
+    MAX = 'MAX'         # the maximum amount of a slot was set by an admin
+
+    # number of events between two snapshots
+    SNAPSHOT_INTERVAL = 200
+
+    def __init__(self, db_path):
+        # set-up for logging of inventory. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'inventory'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        self.db_path = db_path
+        self.lock = Lock()
+        self.levels = {} # slot -> {'amount': int, 'max_amount': int}
+        self.since_snapshot = 0
+        self.last_write = None
+
+        self.load()
+
+    # load
+    # INFO:     Rebuilds the fill levels from the newest snapshot and the events after it. Waits for pending events of this ledger to be committed beforehand.
+    # ARGS:     /
+    # RETURNS:  /
+    def load(self):
+        with self.lock:
+            if self.last_write is not None:
+                self.last_write.result()
+            snapshot = storage.query_one(self.db_path, 'SELECT event_id, levels FROM inventory_snapshots ORDER BY event_id DESC LIMIT 1')
+            if snapshot is None:
+                event_id = 0
+                self.levels = {item[0]: {'amount': item[1], 'max_amount': item[2]} for item in storage.query(self.db_path, 'SELECT slot, amount, max_amount FROM automat')}
+            else:
+                event_id = snapshot[0]
+                self.levels = {int(slot): level for (slot, level) in json.loads(snapshot[1]).items()}
+
+            events = storage.query(self.db_path, 'SELECT type, slot, amount FROM inventory_events WHERE id > ? ORDER BY id', (event_id,))
+            for (type, slot, amount) in events:
+                self.apply(type, slot, amount)
+            self.since_snapshot = len(events)
+            if snapshot is None:
+                self.snapshot()
+            self.logger.info('fill levels loaded from snapshot at event {} and {} later event(s)'.format(event_id, len(events)))
+
+    # apply
+    # INFO:     Applies an event to the fill levels in memory. Amounts never drop below 0.
+    # ARGS:     type (str) -> event type, slot (int) -> affected slot (None for REFILL), amount (int) -> new amount (SET) or new maximum amount (MAX)
+    # RETURNS:  /
+    def apply(self, type, slot, amount):
+        if type == self.REFILL:
+            for level in self.levels.values():
+                level['amount'] = level['max_amount']
+        elif slot not in self.levels:
+            self.logger.error('event {} for unknown slot {} ignored'.format(type, slot))
+        elif type == self.VEND:
+            self.levels[slot]['amount'] = max(0, self.levels[slot]['amount'] - 1)
+        elif type == self.SET:
+            self.levels[slot]['amount'] = amount
+        elif type == self.MAX:
+            self.levels[slot]['max_amount'] = amount
+        else:
+            self.logger.error('unknown event type {} ignored'.format(type))
+
+    # record
+    # INFO:     Applies an event to the fill levels and appends it to the ledger without waiting for the disk. Takes a snapshot every SNAPSHOT_INTERVAL events.
+    # ARGS:     type (str) -> event type, slot (int, optional) -> affected slot, amount (int, optional) -> new amount or maximum amount, by (str, optional) -> origin of the event
+    # RETURNS:  /
+    def record(self, type, slot=None, amount=None, by=None):
+        with self.lock:
+            self.apply(type, slot, amount)
+            self.last_write = storage.write(self.db_path, 'INSERT INTO inventory_events (timestamp, type, slot, amount, by) VALUES (?, ?, ?, ?, ?)',
+                                            (int(time.time()), type, slot, amount, None if by is None else str(by)))
+            self.since_snapshot += 1
+            if self.since_snapshot >= self.SNAPSHOT_INTERVAL:
+                self.snapshot()
+
+    # snapshot
+    # INFO:     Saves the current fill levels along with the id of the newest event. As the storage writer commits in order, the newest event is the last one recorded. Expects the lock to be held.
+    # ARGS:     /
+    # RETURNS:  /
+    def snapshot(self):
+        self.last_write = storage.write(self.db_path, 'INSERT OR REPLACE INTO inventory_snapshots (event_id, timestamp, levels) VALUES ((SELECT COALESCE(MAX(id), 0) FROM inventory_events), ?, ?)',
+                                        (int(time.time()), json.dumps(self.levels)))
+        self.since_snapshot = 0
+
+    # get
+    # INFO:     Returns the fill level of a slot.
+    # ARGS:     slot (int) -> slot of the automat
+    # RETURNS:  dict with 'amount' and 'max_amount', None if the slot is unknown
+    def get(self, slot):
+        with self.lock:
+            level = self.levels.get(slot)
+            return None if level is None else dict(level)
+
+    # get_levels
+    # INFO:     Returns the fill levels of all slots.
+    # ARGS:     /
+    # RETURNS:  dict slot -> dict with 'amount' and 'max_amount'
+    def get_levels(self):
+        with self.lock:
+            return {slot: dict(level) for (slot, level) in self.levels.items()}
@@ -2,10 +2,240 @@ import binascii
 import sys
 import logging
 import serial
-from threading import Thread
+from threading import Thread, Lock
 import time
 import struct
-import queue
+import itertools
+import functools
+import heapq
+from collections import deque, namedtuple
+from enum import Enum
+
+from modules.event_bus import Event_Bus
+
+
+# MDB_State
+# INFO:     States of the MDB reader as defined by the MDB protocol.
+class MDB_State(Enum):
+    RESET = 'RESET'
+    DISABLED = 'DISABLED'
+    ENABLED = 'ENABLED'
+    SESSION = 'SESSION'
+
+
+# MDB_Substate
+# INFO:     Substates of the SESSION state that correspond to the position within the vend process. The substates are not part of the standard MDB protocol,
+#           but are added to reduce complexity. Outside of a session, the substate is None.
+class MDB_Substate(Enum):
+    SELECT = 'SELECT'                   # the session was opened, the user selects a slot
+    VEND_CANCEL = 'VEND CANCEL'         # the vend was denied or cancelled
+    VEND_APPROVED = 'VEND APPROVED'     # the vend was approved, waiting for the drink to be released
+    SESSION_CANCEL = 'SESSION CANCEL'   # the end of the session is requested from the vending machine
+    SESSION_END = 'SESSION END'         # the session ends with the next poll
+
+
+# entry of the transition table of MDB_Handler: name of the command for the log, fixed reply and the state and substate to proceed to (None to keep them),
+# or an action (method taking the frame) that replies and proceeds itself. The complete frame of the fixed reply is added when the table is compiled
+Transition = namedtuple('Transition', ('name', 'reply', 'state', 'substate', 'action', 'frame'), defaults=(None,))
+
+
+# MDB2PC_Parser
+# INFO:     Incremental parser of the data received from the MDB2PC interface. Received bytes are appended to a persistent buffer and every complete frame
+#           (FRAME_BEGIN, payload, FRAME_STOP) is returned in order, however the data is split up by the serial port. Inside a frame, the DLE byte (0x10) is escaped
+#           by doubling it, so only DLE ETX (FRAME_STOP) ends a frame. Payloads are returned unescaped, as the MDB reader sent them, which is the form of the MDB
+#           constants of MDB_Handler. The buffer is searched with bytearray.find and the scan of an incomplete frame resumes where it stopped, so no work is done per
+#           byte in Python.
+#           Single bytes between frames (ACK and NAK of the interface) are counted, malformed frames are dropped.
+# ARGS:     -
+# RETURNS:  /
+class MDB2PC_Parser(object):
+
+    FRAME_START = 0x02
+    FRAME_BEGIN = b'\x02\x00'
+    DLE = b'\x10'
+    ESCAPED_DLE = b'\x10\x10'
+    ETX = 0x03
+    ACK = b'\x06'
+    NAK = b'\x15'
+
+    # longest frame in wire form, a frame without FRAME_STOP is dropped after this many bytes
+    MAX_FRAME_LENGTH = 256
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0 # position of the scan for FRAME_STOP, 0 if no frame is started
+        self.acks = 0
+        self.naks = 0
+        self.dropped = 0
+
+    # feed
+    # INFO:     Appends received bytes to the buffer.
+    # ARGS:     data (bytes) -> bytes read from the serial port
+    # RETURNS:  /
+    def feed(self, data):
+        self.buffer += data
+
+    # skip
+    # INFO:     Discards the bytes before a possible frame start, counting the ACKs and NAKs among them.
+    # ARGS:     end (int) -> number of bytes to discard
+    # RETURNS:  /
+    def skip(self, end):
+        self.acks += self.buffer.count(self.ACK, 0, end)
+        self.naks += self.buffer.count(self.NAK, 0, end)
+        del self.buffer[:end]
+
+    # frames
+    # INFO:     Generator over the complete frames in the buffer. Consumed bytes are removed from the buffer before a frame is returned, an incomplete frame stays in
+    #           the buffer until the next call.
+    # ARGS:     /
+    # RETURNS:  generator of unescaped payloads (bytes)
+    def frames(self):
+        buffer = self.buffer
+        while True:
+            if self.position == 0:
+                start = buffer.find(self.FRAME_START)
+                if start < 0:
+                    self.skip(len(buffer))
+                    return
+                self.skip(start)
+                if len(buffer) < len(self.FRAME_BEGIN):
+                    return
+                if buffer[1] != self.FRAME_BEGIN[1]:
+                    del buffer[:1]
+                    self.dropped += 1
+                    continue
+                self.position = len(self.FRAME_BEGIN)
+
+            dle = buffer.find(self.DLE, self.position)
+            if dle < 0 or dle + 1 == len(buffer):
+                # FRAME_STOP not yet received
+                self.position = len(buffer) if dle < 0 else dle
+                if self.position > self.MAX_FRAME_LENGTH:
+                    del buffer[:1]
+                    self.position = 0
+                    self.dropped += 1
+                    continue
+                return
+            if buffer[dle + 1] == self.DLE[0]:
+                # escaped DLE inside the payload
+                self.position = dle + 2
+            elif buffer[dle + 1] == self.ETX:
+                frame = bytes(buffer[len(self.FRAME_BEGIN):dle]).replace(self.ESCAPED_DLE, self.DLE)
+                del buffer[:dle + 2]
+                self.position = 0
+                yield frame
+            else:
+                # unescaped DLE inside the payload, resynchronise at the next frame start
+                del buffer[:1]
+                self.position = 0
+                self.dropped += 1
+
+
+# compile_display
+# INFO:     Compiles a display text into the complete frame of a display request to the MDB reader: both lines are centred and cut to 16 characters and the duration is
+#           limited to 0.1 to 25 s, see MDB documentation for formatting. DLE bytes in the payload are escaped. The frames of the recently shown texts are cached,
+#           so a text shown repeatedly is compiled only once.
+# ARGS:     top (str) -> top line, bot (str) -> bottom line, duration (float) -> seconds the text is shown
+# RETURNS:  tuple (bytes frame, float duration) with the frame ready to be written and the limited duration
+@functools.lru_cache(maxsize=64)
+def compile_display(top, bot, duration):
+    lines = [str(top), str(bot)]
+    duration = int(duration)
+
+    # Max duration is 25s, min duration is 0.1s
+    if duration > 25: duration = 25
+    if duration < 0.1: duration = 0.1
+
+    # Build text lines (max 16 chars) by centering the individual lines
+    for line in range(0,len(lines)):
+        if len(lines[line]) < 16:
+            missing = 16 - len(lines[line])
+            added_in_front = int(missing/2)
+            added_in_back = missing - added_in_front
+            lines[line] = added_in_front*' '+lines[line]+added_in_back*' '
+        if len(lines[line]) > 16:
+            lines[line] = lines[line][0:16]
+
+    # encode lines into bytes. Check encoding for issues with Umlauts
+    data = MDB_Handler.MDB_DISPLAY_REQUEST + bytes([int(duration*10)]) + lines[0].encode('utf8') + lines[1].encode('utf8')
+    return (MDB_Handler.MDB2PC_FRAME_BEGIN + data.replace(MDB2PC_Parser.DLE, MDB2PC_Parser.ESCAPED_DLE) + MDB_Handler.MDB2PC_FRAME_STOP, duration)
+
+
+# MDB_Display
+# INFO:     Schedules the texts shown on the display of the vending machine. Texts requested by other threads wait in a priority queue until they are shown or expire.
+#           On a poll, the MDB handler asks for the frame to send along with the text of its current state (default display or session prompt): the pending text or the
+#           state's text with the highest priority replaces the shown one once it ran out, or at once if its priority is at least as high. A text which is still shown
+#           is not sent again, the poll is only acknowledged.
+# ARGS:     -
+# RETURNS:  /
+class MDB_Display(object):
+
+    # priorities of the texts
+    DEFAULT = 0     # shown when the vending machine is idle
+    SESSION = 1     # prompts during a vending session
+    NOTICE = 2      # messages requested by other threads
+
+    # seconds a requested text waits to be shown before it is dropped
+    EXPIRY = 10
+
+    # a text is considered shown until roughly one poll interval before its duration ends
+    POLL_INTERVAL = 0.9
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = [] # heap of (-priority, sequence, expiry, (top, bot, duration))
+        self.sequence = itertools.count()
+        self.frame = None # frame of the shown text
+        self.priority = self.DEFAULT
+        self.shown_until = 0
+        self.sent = 0
+        self.skipped = 0
+        self.expired = 0
+
+    # show
+    # INFO:     Requests a text to be shown on the display. Can be called from any thread, returns at once.
+    # ARGS:     top (str) -> top line, bot (str) -> bottom line, duration (float) -> seconds the text is shown, priority (int, optional) -> priority of the text,
+    #           expiry (float, optional) -> seconds the text may wait to be shown, EXPIRY by default, now (float, optional) -> current time
+    # RETURNS:  -
+    def show(self, top, bot, duration, priority=NOTICE, expiry=None, now=None):
+        expiry = (time.time() if now is None else now) + (self.EXPIRY if expiry is None else expiry)
+        with self.lock:
+            heapq.heappush(self.pending, (-priority, next(self.sequence), expiry, (top, bot, duration)))
+
+    # next_frame
+    # INFO:     Selects the text to show on a poll and returns its frame, if it has to be sent.
+    # ARGS:     top (str) -> top line, bot (str) -> bottom line, duration (float) -> seconds the text is shown, priority (int) -> priority of this text of the current state,
+    #           now (float, optional) -> current time
+    # RETURNS:  frame (bytes) to be sent, None if the shown text does not change
+    def next_frame(self, top, bot, duration, priority, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.pending and self.pending[0][2] <= now:
+                heapq.heappop(self.pending)
+                self.expired += 1
+            # the pending text with the highest priority is preferred to the text of the current state, unless the latter has a higher priority
+            if self.pending and -self.pending[0][0] >= priority and self.replaces(-self.pending[0][0], now):
+                (priority, sequence, expiry, (top, bot, duration)) = heapq.heappop(self.pending)
+                priority = -priority
+            elif not self.replaces(priority, now):
+                return None
+
+            (frame, duration) = compile_display(top, bot, duration)
+            if frame == self.frame and self.shown_until > now:
+                self.skipped += 1
+                return None
+            self.frame = frame
+            self.priority = priority
+            self.shown_until = now + duration - self.POLL_INTERVAL
+            self.sent += 1
+            return frame
+
+    # replaces
+    # INFO:     Checks whether a text of the given priority may replace the shown text. Expects the lock to be held.
+    # ARGS:     priority (int) -> priority of the new text, now (float) -> current time
+    # RETURNS:  True if the shown text ran out or has no higher priority, False otherwise
+    def replaces(self, priority, now):
+        return self.shown_until <= now or priority >= self.priority
 
 
 class MDB_Handler(Thread):
@@ -13,10 +243,15 @@ class MDB_Handler(Thread):
     # Timeout in seconds
     TIMEOUT = 12
 
+    # Maximum time in seconds a read of the serial port blocks without receiving anything
+    READ_TIMEOUT = 1.0
+
+    # number of recent frames the latency metrics are computed from
+    LATENCY_WINDOW = 1000
+
     # MDB2PC Constants
     MDB2PC_NAK = b'\x15'
     MDB2PC_ACK = b'\x06'
-    MDB2PC_FRAME_START = b'\x02'
     MDB2PC_FRAME_BEGIN = b'\x02\x00'
     MDB2PC_FRAME_STOP = b'\x10\x03'
 
@@ -24,10 +259,10 @@ class MDB_Handler(Thread):
     MDB_ACK = b''
     MDB_JUST_RESET = b'\x00'
     MDB_POLL = b'\x12'
-    MDB_RESET = b'\x10\x10'
+    MDB_RESET = b'\x10'
     MDB_READER_ENABLE = b'\x14\x01'
     MDB_OUT_OF_SEQUENCE = b'\x0B'
-    MDB_READER_SETUP_CONFIG = b'\x11\x00\x03\x10\x10\x02\x01'
+    MDB_READER_SETUP_CONFIG = b'\x11\x00\x03\x10\x02\x01'
     MDB_READER_CONFIG_RESPONSE = b'\x01\x01\x02\xF4\x01\x02\x02\x00'
     MDB_READER_MINMAX_PRICES = b'\x11\x01\x03\xe8\x00\x05'
     MBD_READER_EXT_FEATURES = b'\x17\x00SIE000'
@@ -43,8 +278,15 @@ class MDB_Handler(Thread):
     MDB_VEND_DENIED = b'\x06'
     MDB_VEND_APPROVED = b'\x05\xff\xff'
 
+    # Commands are identified by their first two bytes (command and subcommand), the transition table is keyed by this prefix
+    COMMAND_LENGTH = 2
+
+    # Names of the fixed replies for the log
+    REPLIES = {MDB_ACK: 'ACK', MDB_JUST_RESET: 'Just Reset', MDB_READER_CONFIG_RESPONSE: 'Reader Config Response',
+               MDB_EXT_FEATURES_RESPONSE: 'Extended Features Response', MDB_CANCEL_REQUEST: 'Cancel Request'}
+
     # __init__
-    # INFO:     Sets up logging of this class and opens the serial connection to the MDB reader.
+    # INFO:     Sets up logging and the event bus of this class and opens the serial connection to the MDB reader.
     # ARGS:     -
     # RETURNS:  -
     def __init__(self):
@@ -58,28 +300,47 @@ class MDB_Handler(Thread):
         self.is_running = False
 
         # Open up the serial connection and set up initial variables
-        self.ser = serial.Serial('/dev/ttyS0', 115200, timeout=0.1) # find port with 'python -m serial.tools.list_ports'
+        self.ser = serial.Serial('/dev/ttyS0', 115200, timeout=self.READ_TIMEOUT) # find port with 'python -m serial.tools.list_ports'
+        self.parser = MDB2PC_Parser()
         self.open_session = False
-        self.state = "RESET"
+        self.state = MDB_State.RESET
         self.substate = None
-        self.display_queue = queue.Queue()
-        self.display_timeout = 0
-        self.dispensed_callback = None
+        self.transitions = self.compile_transitions()
+        self.commands = self.transitions[(self.state, self.substate)]
+        self.display = MDB_Display()
         self.available_callback = None
+        self.vended_callback = None
+        self.session_ids = itertools.count(1)
+        self.requested_session = None # info of the session to open, see request_session
+        self.session = None # info of the current session
+        self.vends = 0 # number of drinks dispensed in the current session
         self.last_amount = 0 # amount of credits left for user
 
-        self.default_display = {'top': 'VCS-Bierautomat', 'bot': 'Legi einscannen', 'duration': 1}
+        # the default display text is shown for the maximum duration, it is only sent again when it ran out or was replaced
+        self.default_display = ('VCS-Bierautomat', 'Legi einscannen', 25)
+
+        # events of the vends are published here, so that no subscriber is called in the middle of an exchange with the MDB reader:
+        #   VEND_APPROVED (session, slot) -> a vend was approved, the drink is not yet released
+        #   DISPENSED (session, slot) -> the drink was released
+        #   SESSION_ENDED (session, vends) -> the session was closed or aborted by a reset, with the number of dispensed drinks
+        self.events = Event_Bus()
+
+        # metrics: time from the receipt of a frame to the written reply
+        self.received = None
+        self.frames = 0
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
 
     # exit
-    # INFO:     Can be triggered from main thread to shut this thread down.
+    # INFO:     Can be triggered from main thread to shut this thread down. Wakes up the thread if it is waiting for data from the MDB reader.
     # ARGS:     -
     # RETURNS:  -
     def exit(self):
         self.logger.info("SHUTDOWN")
         self.is_running = False
+        self.ser.cancel_read()
 
     # run
-    # INFO:     Main thread of this class. Checks if new data was received from the MDB reader and processes it according to the current state of operation.
+    # INFO:     Main thread of this class. Waits for data from the MDB reader and processes every frame according to the current state of operation (see dispatch) as soon as it is complete.
     # ARGS:     -
     # RETURNS:  -
     def run(self):
@@ -87,433 +348,332 @@ class MDB_Handler(Thread):
         self.is_running = True
 
         while self.is_running:
-            # Sleep to prevent timing issues with the MDB reader
-            time.sleep(0.1)
-
-            # Read data from MDB reader
-            data = self.poll_data()
-
-            # Process data according to current state
-            if data is not None:
-
-                # Only if the vending machine is polling and there is a display event requested, the display text can be send
-                if data == self.MDB_POLL and self.display_queue.empty() is False:
-                    self.send_display_order(self.display_queue.get(), priority = True)
-
-                elif self.state == "RESET":
-                    self.handle_data_reset(data)
-
-                elif self.state == "DISABLED":
-                    self.handle_data_disabled(data)
-
-                elif self.state == "ENABLED":
-                    self.handle_data_enabled(data)
-
-                elif self.state == "SESSION":
-                    self.handle_data_session(data)
-
-                else:
-                    self.logger.error("Encountered unexpected state: " + str(self.state))
-                    self.send_data(self.MDB_JUST_RESET)
-                    self.logger.debug("OUT: Just reset")
+            # Block until the MDB reader sent data and process every received frame according to current state
+            for data in self.poll_frames():
+                self.dispatch(data)
 
         # Force notifying the MDB reader about a shutdown of this thread
         self.__del__()
 
     # set_dispensed_callback
-    # INFO:     Is set by the main class to link to a function handling the reporting of a vend to the APIs.
-    # ARGS:     function (function) -> callback
+    # INFO:     Subscribes a function handling the reporting of a vend to the DISPENSED events. It is called by a worker of the event bus, not by this thread.
+    # ARGS:     function (function) -> callback, called with the slot of the vend
     # RETURNS:  -
     def set_dispensed_callback(self, function):
-        self.dispensed_callback = function
+        self.events.subscribe(Event_Bus.DISPENSED, lambda event: function(event['slot']))
+
+    # set_vended_callback
+    # INFO:     Is set by the main class to book a vend on the credits of the user as soon as it is dispensed. It is called in the middle of an exchange with the MDB reader,
+    #           before the vend is published, so it must return at once without accessing disk or network.
+    # ARGS:     function (function) -> callback, called with the session (dict, see request_session) and the vended slot (int)
+    # RETURNS:  -
+    def set_vended_callback(self, function):
+        self.vended_callback = function
 
     # set_available_callback
-    # INFO:     Is set by the main class to link to a function returning the amount of credits the current user has left.
+    # INFO:     Is set by the main class to link to a function returning the amount of credits the current user has left. It is called in the middle of an exchange with the
+    #           MDB reader, so it must return at once without accessing disk or network.
     # ARGS:     function (function) -> callback
     # RETURNS:  -
     def set_available_callback(self, function):
         self.available_callback = function
 
-    # poll_data
-    # INFO:     Reads the MDB reader and preprocesses the data frame for further use in this class.
+    # poll_frames
+    # INFO:     Reads everything the MDB reader sent so far and returns the complete frames for further use in this class. If nothing was sent, blocks until the first byte
+    #           arrives (at most READ_TIMEOUT). Every frame is acknowledged to the MDB2PC interface. Frames arriving back to back are all returned in order, incomplete frames
+    #           are kept for the next call.
     # ARGS:     -
-    # RETURNS:  Either data (bytearray) if the reader sent a frame, or None otherwise.
-    def poll_data(self):
-        # Read only first byte to see whether the reader actually sent a frame.
-        s = self.ser.read(1)
-        if s == self.MDB2PC_NAK:
-            self.logger.debug("MDB2PC: [IN] NAK")
-        if s == self.MDB2PC_ACK:
-            self.logger.debug("MDB2PC: [IN] ACK")
-        if s == self.MDB2PC_FRAME_START:
-            # Read the complete data frame and crop to the frame contents
-            s = s + self.ser.read(10)
-            start = s.find(self.MDB2PC_FRAME_BEGIN) + 2
-            end = s.find(self.MDB2PC_FRAME_STOP, start)
-            data = s[start:end]
+    # RETURNS:  generator of data (bytes), the payloads of the received frames
+    def poll_frames(self):
+        (acks, naks) = (self.parser.acks, self.parser.naks)
+        self.parser.feed(self.ser.read(self.ser.in_waiting or 1))
+        received = time.perf_counter()
+        for data in self.parser.frames():
+            self.received = received
+            self.frames += 1
             self.logger.debug("MDB2PC: [IN] MDB Frame " + str(binascii.hexlify(data)))
             self.ser.write(self.MDB2PC_ACK)
             self.logger.debug("MDB2PC: [OUT] ACK")
-            return data
-        return None
+            yield data
+        if self.parser.acks != acks:
+            self.logger.debug("MDB2PC: [IN] ACK")
+        if self.parser.naks != naks:
+            self.logger.debug("MDB2PC: [IN] NAK")
 
     # send_data
-    # INFO:     Inserts data sent to the MDB reader into the data frame.
+    # INFO:     Inserts data sent to the MDB reader into the data frame, escaping its DLE bytes, and sends it.
     # ARGS:     data (bytearray) -> Data to be sent to the MDB reader
     # RETURNS:  -
     def send_data(self, data):
-        self.ser.write(self.MDB2PC_FRAME_BEGIN + data + self.MDB2PC_FRAME_STOP)
+        self.send_frame(self.frame(data))
+
+    # frame
+    # INFO:     Builds the frame of a payload for the MDB reader, escaping the DLE bytes of the payload.
+    # ARGS:     data (bytes) -> payload of the frame
+    # RETURNS:  frame (bytes) including FRAME_BEGIN and FRAME_STOP
+    def frame(self, data):
+        return self.MDB2PC_FRAME_BEGIN + data.replace(MDB2PC_Parser.DLE, MDB2PC_Parser.ESCAPED_DLE) + self.MDB2PC_FRAME_STOP
+
+    # send_frame
+    # INFO:     Writes a complete frame to the MDB reader. The first reply to a received frame records the latency of the answer for the metrics.
+    # ARGS:     frame (bytes) -> frame including FRAME_BEGIN and FRAME_STOP
+    # RETURNS:  -
+    def send_frame(self, frame):
+        self.ser.write(frame)
         self.ser.flush()
-
-    # handle_data_reset
-    # INFO:     Processes the data sent from the MDB reader if the current state is RESET. It follows the general MDB protocol to start up the vending machine into the DISABLED state.
+        if self.received is not None:
+            self.latencies.append(time.perf_counter() - self.received)
+            self.received = None
+
+    # request_session
+    # INFO:     Is called by the main class once a user is authorised: the next poll opens a vending session. All events of the session carry its info along with its id,
+    #           so that subscribers handle them for the user of this session, even if another user was authorised meanwhile.
+    # ARGS:     **info -> info of the session, e.g. the user
+    # RETURNS:  id (int) of the session
+    def request_session(self, **info):
+        self.requested_session = dict(info, id=next(self.session_ids))
+        self.open_session = True
+        return self.requested_session['id']
+
+    # get_metrics
+    # INFO:     Returns the current metrics of this thread: number of received frames, the time from the receipt of the recent frames to their written reply and the number
+    #           of sent and skipped (unchanged) display texts.
+    # ARGS:     -
+    # RETURNS:  dict with the metrics, latencies in seconds (None if no frame was answered yet)
+    def get_metrics(self):
+        latencies = sorted(self.latencies)
+        return {
+            'frames': self.frames,
+            'latency_mean': sum(latencies)/len(latencies) if latencies else None,
+            'latency_p99': latencies[int(0.99*(len(latencies) - 1))] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+            'display_sent': self.display.sent,
+            'display_skipped': self.display.skipped,
+        }
+
+    # compile_transitions
+    # INFO:     Compiles the MDB protocol into the transition table used by dispatch. Every entry is keyed by (state, substate, command prefix) and either answers the frame
+    #           with a fixed reply and an optional change of state, or calls an action for exchanges that depend on the vend. Commands without an entry are answered with
+    #           Out Of Sequence. A Reset of the vending machine is accepted in every state, a Session Complete in every substate of a session.
+    # ARGS:     -
+    # RETURNS:  transitions (dict) -> (MDB_State, MDB_Substate) -> command prefix (bytes) -> Transition
+    def compile_transitions(self):
+        ack = lambda name: Transition(name, self.MDB_ACK, None, None, None)
+        reset = Transition('Reset', self.MDB_ACK, MDB_State.RESET, None, None)
+        cancel = Transition('Vend Cancel', self.MDB_CANCEL_REQUEST, None, MDB_Substate.SESSION_END, None)
+        complete = Transition('Session Complete', self.MDB_ACK, None, MDB_Substate.SESSION_END, None)
+
+        protocol = {
+            # RESET: the first poll is answered with Just Reset, which starts the setup of the reader
+            (MDB_State.RESET, None): {
+                self.MDB_POLL: Transition('Poll', self.MDB_JUST_RESET, MDB_State.DISABLED, None, None),
+                self.MDB_RESET: ack('Reset'),
+            },
+            # DISABLED: the vending machine reads the configuration of the reader and enables it
+            (MDB_State.DISABLED, None): {
+                self.MDB_POLL: ack('Poll'),
+                self.MDB_RESET: reset,
+                self.MDB_READER_SETUP_CONFIG: Transition('Setup Config', self.MDB_READER_CONFIG_RESPONSE, None, None, None),
+                self.MDB_READER_MINMAX_PRICES: ack('MinMax Prices'),
+                self.MDB_READER_ENABLE: Transition('Reader Enable', self.MDB_ACK, MDB_State.ENABLED, None, None),
+                self.MBD_READER_EXT_FEATURES: Transition('Extended Features', self.MDB_EXT_FEATURES_RESPONSE, None, None, None),
+            },
+            # ENABLED: polls either open a session or show the default display text
+            (MDB_State.ENABLED, None): {
+                self.MDB_POLL: Transition('Poll', None, None, None, self.poll_enabled),
+                self.MDB_READER_ENABLE: ack('Reader Enable'),
+                self.MDB_RESET: reset,
+            },
+            # SESSION, SELECT: the user selects a slot until the session times out
+            (MDB_State.SESSION, MDB_Substate.SELECT): {
+                self.MDB_POLL: Transition('Poll', None, None, None, self.poll_select),
+                self.MDB_VEND_REQUEST: Transition('Vend Request', None, None, None, self.vend_request),
+                self.MDB_VEND_CANCEL: cancel, # User put in coins
+                self.MDB_RESET: reset,
+                self.MDB_SESSION_COMPLETE: complete,
+            },
+            # SESSION, VEND CANCEL: the vend was stopped either by the program or the user. No vend should be reported, as no drink was released.
+            (MDB_State.SESSION, MDB_Substate.VEND_CANCEL): {
+                self.MDB_POLL: ack('Poll'),
+                self.MDB_VEND_CANCEL: cancel,
+                self.MDB_RESET: reset,
+                self.MDB_SESSION_COMPLETE: complete,
+            },
+            # SESSION, VEND APPROVED: the user has sufficient credits and the vend can be performed
+            (MDB_State.SESSION, MDB_Substate.VEND_APPROVED): {
+                self.MDB_POLL: ack('Poll'),
+                self.MDB_VEND_SUCCESFUL: Transition('Vend Success', None, None, None, self.vend_success),
+                self.MDB_VEND_CANCEL: cancel,
+                self.MDB_RESET: reset,
+                self.MDB_SESSION_COMPLETE: complete,
+            },
+            # SESSION, SESSION CANCEL: either due to successfull vend or a cancellation, the return to the ENABLED state is negotiated with the vending machine
+            (MDB_State.SESSION, MDB_Substate.SESSION_CANCEL): {
+                self.MDB_POLL: Transition('Poll', self.MDB_CANCEL_REQUEST, None, MDB_Substate.SESSION_END, None),
+                self.MDB_RESET: reset,
+                self.MDB_SESSION_COMPLETE: ack('Session Complete'),
+            },
+            # SESSION, SESSION END: after the closing of the session is negotiated, the next poll performs the switch to the ENABLED state
+            (MDB_State.SESSION, MDB_Substate.SESSION_END): {
+                self.MDB_POLL: Transition('Poll', None, None, None, self.end_session),
+                self.MDB_RESET: reset,
+                self.MDB_SESSION_COMPLETE: ack('Session Complete'),
+            },
+        }
+
+        transitions = {}
+        for ((state, substate), commands) in protocol.items():
+            transitions[(state, substate)] = {command[:self.COMMAND_LENGTH]: transition if transition.action is not None else transition._replace(frame=self.frame(transition.reply))
+                                              for (command, transition) in commands.items()}
+        return transitions
+
+    # dispatch
+    # INFO:     Processes a frame sent from the MDB reader according to the current state and substate. The commands of the current state are kept in self.commands,
+    #           so a frame costs a single lookup of its command prefix. Fixed replies are sent as the frames prepared by compile_transitions.
     # ARGS:     data (bytearray) -> the preprocessed data sent from the MDB reader
     # RETURNS:  -
-    def handle_data_reset(self, data):
-        self.logger.debug("STATE: RESET")
-
-        if data == self.MDB_POLL:  # POLL
-            self.logger.debug("IN: Poll")
-            self.send_data(self.MDB_JUST_RESET)
-            self.logger.debug('OUT: Just Reset')
-            self.state = "DISABLED"
-            self.logger.info("PROCEED TO: DISABLED")
-
-        elif data == self.MDB_RESET:  # RESET
-            self.logger.debug("IN: Reset")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-
-        else:
+    def dispatch(self, data):
+        transition = self.commands.get(data[:self.COMMAND_LENGTH])
+        if transition is None:
             self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
             self.send_data(self.MDB_OUT_OF_SEQUENCE)
             self.logger.debug("OUT: Out Of Sequence")
+            return
 
-    # handle_data_disabled
-    # INFO:     Processes the data sent from the MDB reader if the current state is DISABLED. It follows the general MDB protocol, sending general information about the MDB reader to the vending machine to finalise preparation for the ENABLED state.
+        self.logger.debug("IN: %s", transition.name)
+        if transition.action is not None:
+            transition.action(data)
+            return
+        self.send_frame(transition.frame)
+        self.logger.debug("OUT: %s", self.REPLIES.get(transition.reply))
+        if transition.state is not None or transition.substate is not None:
+            self.proceed(transition.state, transition.substate)
+
+    # proceed
+    # INFO:     Changes the state and/or the substate and selects the commands of the new state. Changing the state also sets the substate, which is None outside of a session.
+    # ARGS:     state (MDB_State) -> new state, None to keep the state; substate (MDB_Substate) -> new substate, None to keep it if the state is kept
+    # RETURNS:  -
+    def proceed(self, state, substate=None):
+        if state is not None:
+            if self.state == MDB_State.SESSION and state != MDB_State.SESSION:
+                self.events.publish(Event_Bus.SESSION_ENDED, session=self.session, vends=self.vends)
+            self.state = state
+            self.substate = substate
+            self.commands = self.transitions[(self.state, self.substate)]
+            self.logger.info("PROCEED TO: " + self.describe_state())
+        elif substate is not None:
+            self.substate = substate
+            self.commands = self.transitions[(self.state, self.substate)]
+            self.logger.debug("PROCEED TO: %s", self.substate.value)
+
+    # describe_state
+    # INFO:     Formats the current state and substate for the log.
+    # ARGS:     -
+    # RETURNS:  description (str)
+    def describe_state(self):
+        if self.substate is None:
+            return self.state.name
+        return self.state.name + " " + self.substate.name.replace('_', ' ')
+
+    # poll_enabled
+    # INFO:     Answers a poll in the ENABLED state. If the open_session flag is set to True, the vending machine should start a vending session. Otherwise, the default display text is displayed.
     # ARGS:     data (bytearray) -> the preprocessed data sent from the MDB reader
     # RETURNS:  -
-    def handle_data_disabled(self, data):
-        self.logger.debug("STATE: DISABLED")
-
-        if data == self.MDB_POLL:
-            self.logger.debug("IN: Poll")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-
-        elif data == self.MDB_RESET:
-            self.logger.debug("IN: Reset")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-            self.state = "RESET"
-            self.logger.info("PROCEED TO: RESET")
-
-        elif data == self.MDB_READER_SETUP_CONFIG:
-            self.logger.debug("IN: Setup Config")
-            self.send_data(self.MDB_READER_CONFIG_RESPONSE)
-            self.logger.debug("OUT: Reader Config Response")
-
-        elif data == self.MDB_READER_MINMAX_PRICES:
-            self.logger.debug("IN: MinMax Prices")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-
-        elif data == self.MDB_READER_ENABLE:
-            self.logger.debug("IN: Reader Enable")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-            self.state = "ENABLED"
-            self.logger.info("PROCEED TO: ENABLED")
-
-        elif data == self.MBD_READER_EXT_FEATURES:
-            self.logger.debug("IN: Extended Features")
-            self.send_data(self.MDB_EXT_FEATURES_RESPONSE)
-            self.logger.debug("OUT: Extended Features Response")
-
+    def poll_enabled(self, data):
+        if self.open_session:
+            self.open_session = False
+            # the session was requested by request_session, or by setting the open_session flag
+            self.session = self.requested_session if self.requested_session is not None else {'id': next(self.session_ids)}
+            self.requested_session = None
+            self.vends = 0
+            self.timer = time.time()
+            self.last_amount = self.available_callback(0)
+            self.send_data(self.MDB_OPEN_SESSION)
+            self.logger.debug("OUT: Open Session")
+            self.proceed(MDB_State.SESSION, MDB_Substate.SELECT)
         else:
-            self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
-            self.send_data(self.MDB_OUT_OF_SEQUENCE)
-            self.logger.debug("OUT: Out Of Sequence")
+            self.send_display(*self.default_display, priority=MDB_Display.DEFAULT)
 
-    # handle_data_enabled
-    # INFO:     Processes the data sent from the MDB reader if the current state is ENABLED. It follows the general MDB protocol to initiate the SESSION state used for vending.
+    # poll_select
+    # INFO:     Answers a poll while the user selects a slot. As long as the timeout is not reached, a new display text is shown on the vending machine. After the timeout, the session is cancelled.
     # ARGS:     data (bytearray) -> the preprocessed data sent from the MDB reader
     # RETURNS:  -
-    def handle_data_enabled(self, data):
-        self.logger.debug("STATE: ENABLED")
-
-        if data == self.MDB_POLL:
-            self.logger.debug("IN: Poll")
-            # if the open_session flag is set to True, the vending machine should start a vending session. Otherwise, the default display text is displayed.
-            if self.open_session:
-                self.open_session = False
-                self.timer = time.time()
-                self.last_amount = self.available_callback(0)
-                self.send_data(self.MDB_OPEN_SESSION)
-                self.logger.debug("OUT: Open Session")
-                self.state = "SESSION"
-                self.substate = None
-                self.logger.info("PROCEED TO: SESSION")
-            else:
-                self.send_display_order(self.default_display)
-
-        elif data == self.MDB_READER_ENABLE:
-            self.logger.debug("IN: Reader Enable")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-
-        elif data == self.MDB_RESET:
-            self.logger.debug("IN: Reset")
-            self.send_data(self.MDB_ACK)
-            self.logger.debug("OUT: ACK")
-            self.state = "RESET"
-            self.logger.info("PROCEED TO: RESET")
-
+    def poll_select(self, data):
+        if time.time() - self.timer > self.TIMEOUT:
+            self.proceed(None, MDB_Substate.SESSION_CANCEL)
         else:
-            self.logger.info("IN Unhandled Frame " + str(binascii.hexlify(data)))
-            self.send_data(self.MDB_OUT_OF_SEQUENCE)
-            self.logger.debug("OUT: Out Of Sequence")
+            self.send_display('Slot aussuchen', 'Guthaben: ' + str(self.last_amount), 5, priority=MDB_Display.SESSION)
 
-    # handle_data_session
-    # INFO:     Processes the data sent from the MDB reader if the current state is SESSION. It follows the general MDB protocol to handle the vending including any cancellation processes. The SESSION state is divided into multiple substates that correspond to the position within the vend process. The substates are not part of the standard MDB protocol, but are added to reduce complexity.
+    # vend_request
+    # INFO:     A vend is requested (a selection button was pressed). Reads the amount of credits of the user via callback and either approves or denies the vend.
     # ARGS:     data (bytearray) -> the preprocessed data sent from the MDB reader
     # RETURNS:  -
-    def handle_data_session(self, data):
-
-        # If the program entered the SESSION state just yet, the substate is set to None.
-        if self.substate == None:
-            self.logger.debug("STATE: SESSION")
-
-            # As long as the timeout is not reached, a new display text is shown on the vending machine. After the timeout, the session is cancelled
-            if data == self.MDB_POLL:
-                self.logger.debug("IN: Poll")
-                if time.time() - self.timer > self.TIMEOUT:
-                    self.substate = "SESSION CANCEL"
-                else:
-                    self.send_display_order({'top': 'Slot aussuchen','bot': 'Guthaben: ' + str(self.last_amount), 'duration': 5})
-
-            # If a vend is requested (a selection button was pressed), read the amount of credits of user via callback and either approve or cancel vend
-            elif data[0:2] == self.MDB_VEND_REQUEST:
-                self.logger.debug("IN: Vend Request")
-                self.slot = struct.unpack('>H', data[4:6])[0]
-                self.last_amount = self.available_callback(self.slot)
-                if self.last_amount:
-                    self.logger.info("Request Approved, " + str(self.last_amount - 1) + " credits left")
-                    self.send_data(self.MDB_VEND_APPROVED)
-                    self.logger.debug("OUT: Vend Approved")
-                    self.substate = "VEND APPROVED"
-                else:
-                    self.logger.info("Request Denied")
-                    self.send_data(self.MDB_VEND_DENIED)
-                    self.logger.debug("OUT: Vend Denied")
-                    self.substate = "VEND CANCEL"
-
-            elif data[0:2] == self.MDB_VEND_CANCEL: # User put in coins
-                self.logger.debug("IN: Vend Cancel")
-                self.send_data(self.MDB_CANCEL_REQUEST)
-                self.logger.debug("OUT: Cancel Request")
-                self.substate = "SESSION END"
-
-            elif data == self.MDB_RESET:
-                self.logger.debug("IN: Reset")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.state = "RESET"
-                self.logger.info("PROCEED TO: RESET")
-
-            elif data == self.MDB_SESSION_COMPLETE:
-                self.logger.debug("IN: Session Complete")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.substate = "SESSION END"
-
-            else:
-                self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
-                self.send_data(self.MDB_OUT_OF_SEQUENCE)
-                self.logger.debug("OUT: Out Of Sequence")
-
-        # A VEND CANCEL substate indicates the vend was stopped either by the program or the user. No vend should be reported, as no drink was released.
-        elif self.substate == "VEND CANCEL":
-            self.logger.debug("STATE: VEND CANCEL")
-
-            if data == self.MDB_POLL:
-                self.logger.debug("IN: Poll")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-
-            elif data[0:2] == self.MDB_VEND_CANCEL: # User put in coins
-                self.logger.debug("IN: Vend Cancel")
-                self.send_data(self.MDB_CANCEL_REQUEST)
-                self.logger.debug("OUT: Cancel Request")
-                self.substate = "SESSION END"
-
-            elif data == self.MDB_RESET:  # RESET
-                self.logger.debug("IN: Reset")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.state = "RESET"
-                self.logger.info("PROCEED TO: RESET")
-                self.substate = None
-
-            elif data == self.MDB_SESSION_COMPLETE:
-                self.logger.debug("IN: Session Complete")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.substate = "SESSION END"
-
-            else:
-                self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
-                self.send_data(self.MDB_OUT_OF_SEQUENCE)
-                self.logger.debug("OUT: Out Of Sequence")
-
-        # A VEND APPROVED substate indicates the user has sufficient credits and the vend can be performed
-        elif self.substate == "VEND APPROVED":
-            self.logger.debug("STATE: VEND APPROVED")
-
-            if data == self.MDB_POLL:
-                self.logger.debug("IN: Poll")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-
-            # The drink was released, report vend to APIs
-            elif data[0:2] == self.MDB_VEND_SUCCESFUL:
-                self.logger.debug("IN: Vend Success")
-                self.dispensed_callback(self.slot)
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.substate = "SESSION CANCEL"
-
-            elif data[0:2] == self.MDB_VEND_CANCEL: # User put in coins
-                self.logger.debug("IN: Vend Cancel")
-                self.send_data(self.MDB_CANCEL_REQUEST)
-                self.logger.debug("OUT: Cancel Request")
-                self.substate = "SESSION END"
-
-            elif data == self.MDB_RESET:
-                self.logger.debug("IN: Reset")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.state = "RESET"
-                self.logger.info("PROCEED TO: RESET")
-                self.substate = None
-
-            elif data == self.MDB_SESSION_COMPLETE:
-                self.logger.debug("IN: Session Complete")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-                self.substate = "SESSION END"
-
-            else:
-                self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
-                self.send_data(self.MDB_OUT_OF_SEQUENCE)
-                self.logger.debug("OUT: Out Of Sequence")
-
-        # Either due to successfull vend or a cancellation, the SESSION CANCEL substate negotiates the return to the ENABLED state to the vending machine.
-        elif self.substate == "SESSION CANCEL":
-            self.logger.debug("STATE: SESSION CANCEL")
-
-            if data == self.MDB_POLL:
-                self.logger.debug("IN: Poll")
-                self.send_data(self.MDB_CANCEL_REQUEST)
-                self.logger.debug("OUT: Cancel Request")
-                self.substate = "SESSION END"
-
-            # Sending MDB_SESSION_COMPLETE forces the vending machine to stop its session, leading to it polling.
-            elif data == self.MDB_SESSION_COMPLETE:
-                self.logger.debug("IN: Session Complete")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-
-            else:
-                self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
-                self.send_data(self.MDB_OUT_OF_SEQUENCE)
-                self.logger.debug("OUT: Out Of Sequence")
-
-        # After the closing of the session is negotiated, the SESSION END substate performs the switch to the ENABLED state
-        elif self.substate == "SESSION END":
-            self.logger.debug("STATE: SESSION END")
-
-            if data == self.MDB_POLL:
-                self.logger.debug("IN: Poll")
-                self.send_data(self.MDB_END_SESSION)
-                self.logger.debug("OUT: End Session")
-                self.state = "ENABLED"
-                self.logger.info("PROCEED TO: ENABLED")
-                self.substate = None
-                self.display_queue.put({'top': 'VCS', 'bot': '<3', 'duration': 3})
-
-            elif data == self.MDB_SESSION_COMPLETE:
-                self.logger.debug("IN: Session Complete")
-                self.send_data(self.MDB_ACK)
-                self.logger.debug("OUT: ACK")
-
-            else:
-                self.logger.info("IN: Unhandled Frame " + str(binascii.hexlify(data)))
-                self.send_data(self.MDB_OUT_OF_SEQUENCE)
-                self.logger.debug("OUT: Out Of Sequence")
-
-
-
-
-    # send_display_order
-    # INFO:     Queues a display request to show text on the vending machine's display. The request consists of two lines of text and a duration for which the text should be shown. If the priority flag is set to True, the text is displayed even if another text's duration is not yet reached.
-    # ARGS:     request (array) -> content of the display request: top line, bottom line and duration; priority (bool, optional) whether to overwrite existing text
+    def vend_request(self, data):
+        self.slot = struct.unpack('>H', data[4:6])[0]
+        self.last_amount = self.available_callback(self.slot)
+        if self.last_amount:
+            self.logger.info("Request Approved, " + str(self.last_amount - 1) + " credits left")
+            self.send_data(self.MDB_VEND_APPROVED)
+            self.logger.debug("OUT: Vend Approved")
+            self.events.publish(Event_Bus.VEND_APPROVED, session=self.session, slot=self.slot)
+            self.proceed(None, MDB_Substate.VEND_APPROVED)
+        else:
+            self.logger.info("Request Denied")
+            self.send_data(self.MDB_VEND_DENIED)
+            self.logger.debug("OUT: Vend Denied")
+            self.proceed(None, MDB_Substate.VEND_CANCEL)
+
+    # vend_success
+    # INFO:     The drink was released. Books the vend on the credits of the user right away, so that a following vend request sees the new credits, and publishes the vend
+    #           after the reply, to be reported to the APIs by the subscribers.
+    # ARGS:     data (bytearray) -> the preprocessed data sent from the MDB reader
     # RETURNS:  -
-    def send_display_order(self, request, priority = False):
-
-        # Check if previous text is not finished or the new display request is not prioritized. If so, just send ACK and nothing happens.
-        if priority is False and self.display_timeout > time.time():
+    def vend_success(self, data):
+        self.send_data(self.MDB_ACK)
+        self.logger.debug("OUT: ACK")
+        self.vends += 1
+        if self.vended_callback is not None:
+            self.vended_callback(self.session, self.slot)
+        self.events.publish(Event_Bus.DISPENSED, session=self.session, slot=self.slot)
+        self.proceed(None, MDB_Substate.SESSION_CANCEL)
+
+    # end_session
+    # INFO:     Ends the session and returns to the ENABLED state.
+    # ARGS:     data (bytearray) -> the preprocessed data sent from the MDB reader
+    # RETURNS:  -
+    def end_session(self, data):
+        self.send_data(self.MDB_END_SESSION)
+        self.logger.debug("OUT: End Session")
+        self.proceed(MDB_State.ENABLED)
+        self.display.show('VCS', '<3', 3)
+
+    # send_display
+    # INFO:     Answers a poll with a display request: a pending text of the display or, if none is pending, the given text of the current state. If the shown text does not
+    #           change, the poll is only acknowledged.
+    # ARGS:     top (str) -> top line, bot (str) -> bottom line, duration (float) -> seconds the text is shown, priority (int) -> priority of the text, see MDB_Display
+    # RETURNS:  -
+    def send_display(self, top, bot, duration, priority):
+        frame = self.display.next_frame(top, bot, duration, priority)
+        if frame is None:
             self.send_data(self.MDB_ACK)
             self.logger.debug("OUT: ACK")
-            return
-
-        # Preprocess array contents
-        lines = [str(request['top']), str(request['bot'])]
-        duration = int(request['duration'])
-
-        # Max duration is 25s, min duration is 0.1s
-        if duration > 25: duration = 25
-        if duration < 0.1: duration = 0.1
-
-        # Save timeout of current text. Shorten it by almost one second, as this is roughly the time between POLLs of the MDB reader
-        self.display_timeout = time.time() + duration - 0.9
-        
-        # Build text lines (max 16 chars) by centering the individual lines
-        for line in range(0,len(lines)):
-            if len(lines[line]) < 16:
-                missing = 16 - len(lines[line])
-                added_in_front = int(missing/2)
-                added_in_back = missing - added_in_front
-                lines[line] = added_in_front*' '+lines[line]+added_in_back*' '
-            if len(lines[line]) > 16:
-                lines[line] = lines[line][0:16]
-
-        # Build the data to be sent to the MDB reader, see MDB documentation for formatting
-        duration_byte = bytearray(1)
-        duration_byte[0] = int(duration*10)
-        duration_byte = bytes(duration_byte)
-
-        # encode lines into bytes. Check encoding for issues with Umlauts
-        line1 = bytes(lines[0].encode('utf8'))
-        line2 = bytes(lines[1].encode('utf8'))
-
-        # Send display request to MDB reader
-        self.send_data(self.MDB_DISPLAY_REQUEST + duration_byte + line1 + line2)
-        self.logger.debug("OUT: Display Request")
-
-
-
+        else:
+            self.send_frame(frame)
+            self.logger.debug("OUT: Display Request")
 
     # __del__
     # INFO:     Informs the vending machine about the shutdown and gracefully kills the connection to the MDB reader.
     # ARGS:     -
     # RETURNS:  -
     def __del__(self):
+        # the connection is already closed if run() called this before the garbage collection
+        if not self.ser.isOpen():
+            return
         # send session_complete after poll
         self.logger.debug("Closing connection!")
-        frame = self.poll_data()
+        frame = None
         while frame is None:
-            frame = self.poll_data()
+            frame = next(self.poll_frames(), None)
         if frame == self.MDB_POLL:
             self.logger.debug("IN: Poll")
             self.send_data(self.MDB_JUST_RESET)
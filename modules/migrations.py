@@ -0,0 +1,182 @@
+import os.path
+import logging
+import sqlite3
+
+from modules import DB
+from connectors.storage import storage
+
+
+# fts5_available
+# INFO:     Checks whether the SQLite library was built with the FTS5 extension, by creating a full-text table in an in-memory database.
+# ARGS:     /
+# RETURNS:  True if FTS5 is available, False otherwise
+def fts5_available():
+    db_connector = sqlite3.connect(':memory:')
+    try:
+        db_connector.execute('CREATE VIRTUAL TABLE probe USING fts5(text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        db_connector.close()
+
+
+# unkeyed_reports
+# INFO:     Checks whether the reports table lacks its integer key, as in databases copied from the former tbot.db_default.
+# ARGS:     db_connector (sqlite3.Connection) -> connection to the database being migrated
+# RETURNS:  True if the table has no report_id column, False otherwise
+def unkeyed_reports(db_connector):
+    return 'report_id' not in [row[1] for row in db_connector.execute('PRAGMA table_info(reports)')]
+
+
+# capabilities of the SQLite library in use. Older libraries (e.g. of Raspberry Pi OS) lack them, the steps using them have alternative statements.
+# UPSERT needs SQLite 3.24, the full-text index of the reports needs FTS5.
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+SQLITE_FTS5 = fts5_available()
+
+# versioned schemas of all databases. Each step is applied once, in a single transaction, and its number is stored as PRAGMA user_version of the database.
+# All statements are idempotent, so databases copied from the former *.db_default files (version 0, tables already present) are upgraded the same way as new ones.
+# A tuple (capability, statements, alternative) in a step stands for its statements if the capability is available and for the alternative statements otherwise.
+# The capability may also be a function, which is called with the connection when the step reaches the tuple.
+MIGRATIONS = {
+    'tbot.db': [
+        # 1: tables of the telegram bot
+        ["CREATE TABLE IF NOT EXISTS admins (`ID` TEXT, `name` TEXT NOT NULL DEFAULT 'Unbekannt')",
+         "CREATE TABLE IF NOT EXISTS blacklist (`ID` TEXT UNIQUE, `timestamp` INTEGER NOT NULL, `by` TEXT NOT NULL DEFAULT 0)",
+         # reports have an explicit integer key, which VACUUM keeps unlike the implicit rowid, so that the full-text index can refer to it
+         "CREATE TABLE IF NOT EXISTS reports (`report_id` INTEGER PRIMARY KEY, `timestamp` INTEGER NOT NULL, `ID` TEXT NOT NULL, `text` TEXT)",
+         # a reports table copied from the former tbot.db_default has no key, it is rebuilt with its rowids as keys
+         (unkeyed_reports,
+          ["DROP TABLE IF EXISTS reports_keyed",
+           "CREATE TABLE reports_keyed (`report_id` INTEGER PRIMARY KEY, `timestamp` INTEGER NOT NULL, `ID` TEXT NOT NULL, `text` TEXT)",
+           "INSERT INTO reports_keyed (report_id, timestamp, ID, text) SELECT rowid, timestamp, ID, text FROM reports",
+           "DROP TABLE reports",
+           "ALTER TABLE reports_keyed RENAME TO reports"], []),
+         "CREATE TABLE IF NOT EXISTS users (`ID` TEXT NOT NULL UNIQUE, `rfid` TEXT NOT NULL, PRIMARY KEY(`ID`))",
+         "CREATE TABLE IF NOT EXISTS automat (`slot` INTEGER NOT NULL UNIQUE, `amount` INTEGER, `max_amount` INTEGER, PRIMARY KEY(`slot`))",
+         "INSERT OR IGNORE INTO automat (slot, amount, max_amount) VALUES (1, 0, 50), (2, 0, 50), (3, 0, 50), (4, 0, 50), (5, 0, 50), (6, 0, 50)"],
+        # 2: inventory ledger, see Inventory_Ledger
+        ["CREATE TABLE IF NOT EXISTS inventory_events (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp INTEGER NOT NULL, type TEXT NOT NULL, slot INTEGER, amount INTEGER, by TEXT)",
+         "CREATE TABLE IF NOT EXISTS inventory_snapshots (event_id INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, levels TEXT NOT NULL)"],
+        # 3: indexes for the exports and the admin checks (blacklist.ID is indexed by its UNIQUE constraint)
+        ["CREATE INDEX IF NOT EXISTS reports_timestamp ON reports (timestamp)",
+         "CREATE INDEX IF NOT EXISTS admins_id ON admins (ID)"],
+        # 4: full-text index over the problem reports, kept up to date by triggers, and an index for the search by reporter. Without FTS5, reports are searched without index
+        [(SQLITE_FTS5,
+         ["CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5(text, content='reports', content_rowid='report_id', prefix='2 3')",
+         "CREATE TRIGGER IF NOT EXISTS reports_fts_insert AFTER INSERT ON reports BEGIN "
+         "INSERT INTO reports_fts (rowid, text) VALUES (NEW.report_id, NEW.text); "
+         "END",
+         "CREATE TRIGGER IF NOT EXISTS reports_fts_delete AFTER DELETE ON reports BEGIN "
+         "INSERT INTO reports_fts (reports_fts, rowid, text) VALUES ('delete', OLD.report_id, OLD.text); "
+         "END",
+         "CREATE TRIGGER IF NOT EXISTS reports_fts_update AFTER UPDATE ON reports BEGIN "
+         "INSERT INTO reports_fts (reports_fts, rowid, text) VALUES ('delete', OLD.report_id, OLD.text); "
+         "INSERT INTO reports_fts (rowid, text) VALUES (NEW.report_id, NEW.text); "
+         "END",
+         "INSERT INTO reports_fts (reports_fts) VALUES ('rebuild')"], []),
+         "CREATE INDEX IF NOT EXISTS reports_id_timestamp ON reports (ID, timestamp)"],
+    ],
+    'users.db': [
+        # 1: users with special access, see DB_ID
+        ["CREATE TABLE IF NOT EXISTS users (`rfid` TEXT NOT NULL UNIQUE, `name` TEXT, `usage` INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(`rfid`))"],
+    ],
+    'vcs_nonces.db': [
+        # 1: nonces of the API responses, see NonceStore
+        ["CREATE TABLE IF NOT EXISTS nonces (`nonce` TEXT NOT NULL UNIQUE, `timestamp` INTEGER NOT NULL, PRIMARY KEY(`nonce`))"],
+        # 2: expired nonces are deleted by timestamp
+        ["CREATE INDEX IF NOT EXISTS nonces_timestamp ON nonces (timestamp)"],
+    ],
+    'outbox.db': [
+        # 1: vends which are not yet reported, see Vend_Outbox
+        ["CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, timestamp INTEGER NOT NULL, slot INTEGER NOT NULL, "
+         "rfid TEXT NOT NULL, org TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"],
+        # 2: vends which were rejected or failed too often, kept for inspection
+        ["CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, timestamp INTEGER NOT NULL, slot INTEGER NOT NULL, "
+         "rfid TEXT NOT NULL, org TEXT NOT NULL, attempts INTEGER NOT NULL, reason TEXT NOT NULL, dropped INTEGER NOT NULL)"],
+    ],
+    'history.db': [
+        # 1: vend history and its hourly rollups, see Vend_History
+        ["CREATE TABLE IF NOT EXISTS vends (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp REAL NOT NULL, slot INTEGER NOT NULL, org TEXT NOT NULL, latency REAL)",
+         "CREATE INDEX IF NOT EXISTS vends_timestamp ON vends (timestamp)",
+         "CREATE TABLE IF NOT EXISTS vends_hourly (hour INTEGER NOT NULL, slot INTEGER NOT NULL, org TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, "
+         "latency_count INTEGER NOT NULL DEFAULT 0, latency_sum REAL NOT NULL DEFAULT 0, latency_max REAL, PRIMARY KEY (hour, slot, org))",
+         (SQLITE_UPSERT,
+         ["CREATE TRIGGER IF NOT EXISTS vends_rollup AFTER INSERT ON vends BEGIN "
+         "INSERT INTO vends_hourly (hour, slot, org, count, latency_count, latency_sum, latency_max) "
+         "VALUES (CAST(NEW.timestamp / 3600 AS INTEGER), NEW.slot, NEW.org, 1, NEW.latency IS NOT NULL, COALESCE(NEW.latency, 0), NEW.latency) "
+         "ON CONFLICT (hour, slot, org) DO UPDATE SET "
+         "count = count + 1, "
+         "latency_count = latency_count + excluded.latency_count, "
+         "latency_sum = latency_sum + excluded.latency_sum, "
+         "latency_max = MAX(COALESCE(latency_max, excluded.latency_max), COALESCE(excluded.latency_max, latency_max)); "
+         "END"],
+         # without UPSERT, the row of the hour is created first if it is missing and then updated
+         ["CREATE TRIGGER IF NOT EXISTS vends_rollup AFTER INSERT ON vends BEGIN "
+         "INSERT OR IGNORE INTO vends_hourly (hour, slot, org) VALUES (CAST(NEW.timestamp / 3600 AS INTEGER), NEW.slot, NEW.org); "
+         "UPDATE vends_hourly SET "
+         "count = count + 1, "
+         "latency_count = latency_count + (NEW.latency IS NOT NULL), "
+         "latency_sum = latency_sum + COALESCE(NEW.latency, 0), "
+         "latency_max = MAX(COALESCE(latency_max, NEW.latency), COALESCE(NEW.latency, latency_max)) "
+         "WHERE hour = CAST(NEW.timestamp / 3600 AS INTEGER) AND slot = NEW.slot AND org = NEW.org; "
+         "END"])],
+    ],
+}
+
+logger = logging.getLogger('migrations')
+logger.setLevel(logging.INFO)
+
+
+# statements
+# INFO:     Returns the statements of a migration step for the SQLite library in use, see MIGRATIONS.
+# ARGS:     step (list) -> statements and (capability, statements, alternative) tuples of the step, db_connector (sqlite3.Connection) -> connection to the database being migrated
+# RETURNS:  generator of statements (str)
+def statements(step, db_connector):
+    for entry in step:
+        if isinstance(entry, tuple):
+            (available, main, alternative) = entry
+            if callable(available):
+                available = available(db_connector)
+            yield from (main if available else alternative)
+        else:
+            yield entry
+
+
+# migrate
+# INFO:     Creates or upgrades a database to the newest version of its schema. Each pending step runs in its own transaction together with the update of the version,
+#           so an interrupted migration is repeated on the next start.
+# ARGS:     db_path (str) -> path of the database, name (str) -> key of the schema in MIGRATIONS
+# RETURNS:  version (int) of the database after the migration
+def migrate(db_path, name):
+    db_connector = storage.connection(db_path)
+    version = db_connector.execute('PRAGMA user_version').fetchone()[0]
+    steps = MIGRATIONS[name]
+    if version > len(steps):
+        logger.warning('{} has version {}, which is newer than the known schema ({})'.format(db_path, version, len(steps)))
+    for (number, step) in enumerate(steps[version:], start=version + 1):
+        db_connector.execute('BEGIN')
+        try:
+            for statement in statements(step, db_connector):
+                db_connector.execute(statement)
+            db_connector.execute('PRAGMA user_version = {}'.format(number))
+            db_connector.commit()
+        except Exception:
+            db_connector.rollback()
+            raise
+        logger.info('{} migrated to version {}'.format(os.path.basename(db_path), number))
+        version = number
+    return version
+
+
+# migrate_all
+# INFO:     Creates or upgrades all databases of the program. Is called at startup, before any module accesses a database.
+# ARGS:     directory (str, optional) -> directory of the databases
+# RETURNS:  /
+def migrate_all(directory=DB):
+    if not SQLITE_UPSERT:
+        logger.warning('SQLite {} has no UPSERT, the vend statistics are rolled up without it'.format(sqlite3.sqlite_version))
+    if not SQLITE_FTS5:
+        logger.warning('SQLite {} has no FTS5, problem reports are searched without full-text index'.format(sqlite3.sqlite_version))
+    for name in MIGRATIONS:
+        migrate(os.path.join(directory, name), name)
@@ -0,0 +1,195 @@
+import logging
+import time
+from threading import Thread, Event
+from collections import deque
+
+from modules.vend_outbox import Vend_Outbox
+from connectors.credit_cache import credit_cache
+
+
+class Report_Worker(Thread):
+
+    # number of outbox entries reported per batch
+    BATCH_SIZE = 50
+
+    # backoff in seconds of an organisation after a failed report (doubled after every further failure)
+    BACKOFF_START = 1
+    BACKOFF_MAX = 60
+
+    # number of recent reports the latency metrics are computed from
+    LATENCY_WINDOW = 100
+
+    # __init__
+    # INFO:     Sets up logging, the outbox and the metrics of this class.
+    # ARGS:     providers (dict) -> ID providers by their orgname, used to report the vends, outbox (Vend_Outbox, optional) -> outbox to report from
+    # RETURNS:  /
+    def __init__(self, providers, outbox=None):
+        # set-up for logging of report. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'report'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        Thread.__init__(self, daemon=True)
+        self.is_running = False
+        self.wakeup = Event()
+
+        self.providers = providers
+        self.outbox = outbox if outbox is not None else Vend_Outbox()
+
+        # backoff of the organisations whose last report failed: current backoff in seconds and time.monotonic() of the next attempt
+        self.backoffs = {}
+        self.retries = {}
+
+        # metrics
+        self.reported = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+    # run
+    # INFO:     Main thread of this class. Reports all vends in the outbox to the organisation of the user, independently of the main loop. After a failed report, the vends of
+    #           that organisation are retried with exponential backoff. A new vend wakes up this thread at once, but only the organisations which are not backing off are reported.
+    # ARGS:     /
+    # RETURNS:  /
+    def run(self):
+        self.is_running = True
+
+        while self.is_running:
+            self.wakeup.clear()
+            try:
+                self.drain()
+                timeout = self.next_retry()
+            except Exception as e:
+                self.logger.exception("exception: {}".format(e))
+                timeout = self.BACKOFF_MAX
+
+            # sleep until a new vend is queued, or until the next backoff is over
+            self.wakeup.wait(timeout)
+
+    # queue_report
+    # INFO:     Records a vend in the outbox and wakes up this thread to report it. Returns once the entry is committed, so that the vend survives a crash. Can be called from any thread.
+    # ARGS:     slot_id (int) -> ID of the slot that was vended, rfid (str) -> RFID of the user, org (str) -> orgname of the ID provider of the user
+    # RETURNS:  /
+    def queue_report(self, slot_id, rfid, org):
+        self.outbox.add(slot_id, rfid, org)
+        self.wakeup.set()
+
+    # drain
+    # INFO:     Reports the outbox in batches until it is empty, skipping the organisations which are backing off. If a report to an organisation fails, the remaining entries
+    #           of that organisation are left for its next attempt after the backoff, entries of other organisations are still reported. Entries rejected by their organisation
+    #           are given up right away (see Vend_Outbox). An organisation whose ID provider is not available is not asked, and no attempt is counted for its entries.
+    # ARGS:     /
+    # RETURNS:  True if the outbox was emptied, False if entries are left for a later attempt
+    def drain(self):
+        now = time.monotonic()
+        failed_orgs = {org for (org, retry) in self.retries.items() if retry > now}
+        while self.is_running:
+            batch = self.outbox.pending(self.BATCH_SIZE, exclude_orgs=failed_orgs)
+            if not batch:
+                break
+
+            # the vends of each organisation in the batch are reported together
+            records = {}
+            for entry in batch:
+                records.setdefault(entry['org'], []).append(entry)
+
+            reported = []
+            rejected = []
+            failed = []
+            for (org, entries) in records.items():
+                if org in self.providers and not self.providers[org].is_available():
+                    self.logger.debug("{} is not available, {} vend(s) wait".format(org, len(entries)))
+                    failed_orgs.add(org)
+                    continue
+                for (entry, success) in zip(entries, self.report(org, entries)):
+                    if success:
+                        reported.append(entry['id'])
+                    elif success is None:
+                        rejected.append(entry['id'])
+                    elif org not in failed_orgs:
+                        # the later entries were possibly not even tried, only the attempt of the oldest failed entry is counted
+                        failed.append(entry['id'])
+                        failed_orgs.add(org)
+
+            self.outbox.remove(reported)
+            self.outbox.rejected(rejected)
+            self.outbox.failed(failed)
+
+        # organisations which failed now back off (longer after every further failure), the others report at once again
+        for org in failed_orgs:
+            if self.retries.get(org, 0) <= now:
+                self.backoffs[org] = self.BACKOFF_START if org not in self.backoffs else min(2*self.backoffs[org], self.BACKOFF_MAX)
+                self.retries[org] = now + self.backoffs[org]
+                self.logger.warning("retrying failed reports of {} in {} s, {} vend(s) pending".format(org, self.backoffs[org], self.outbox.count()))
+        for org in set(self.retries) - failed_orgs:
+            del self.backoffs[org]
+            del self.retries[org]
+        return self.is_running and not failed_orgs
+
+    # next_retry
+    # INFO:     Returns the time until the backoff of the next organisation is over.
+    # ARGS:     /
+    # RETURNS:  time in seconds (float), None if no organisation is backing off
+    def next_retry(self):
+        if not self.retries:
+            return None
+        return max(0, min(self.retries.values()) - time.monotonic())
+
+    # report
+    # INFO:     Reports outbox entries of one organisation to its ID provider in a single batch, along with their idempotency keys.
+    # ARGS:     org (str) -> orgname of the ID provider, entries (list) -> outbox entries of this organisation
+    # RETURNS:  List with True for every entry that was reported successfully, None for every entry that was rejected, False otherwise
+    def report(self, org, entries):
+        if org not in self.providers:
+            self.logger.error("{} vend(s) have unknown organisation {}".format(len(entries), org))
+            return [False]*len(entries)
+
+        started = time.time()
+        try:
+            results = self.providers[org].report_batch(entries)
+        except Exception as e:
+            self.logger.exception("report exception: {}".format(e))
+            results = [False]*len(entries)
+        self.latencies.append(time.time() - started)
+
+        # after a report the API knows the new credits, the cached ones are dropped
+        for (entry, success) in zip(entries, results):
+            if success:
+                credit_cache.invalidate(org, entry['rfid'])
+
+        reported = results.count(True)
+        rejected = results.count(None)
+        self.reported += reported
+        self.rejected += rejected
+        self.failed += len(entries) - reported - rejected
+        if reported > 0:
+            self.logger.debug("report of {} vending(s) for {} successful, oldest {:.3f} s after vending".format(reported, org, time.time() - entries[0]['timestamp']))
+        if reported + rejected < len(entries):
+            self.logger.error("report of {} vending(s) for {} failed, oldest with rfid {} and slot {} ({} previous attempts)".format(len(entries) - reported - rejected, org, entries[0]['rfid'], entries[0]['slot'], entries[0]['attempts']))
+        return results
+
+    # get_metrics
+    # INFO:     Returns the current metrics of this thread: number of vends in the outbox, number of successfully reported, rejected and unsuccessfully reported vends and latency of the recent report requests.
+    # ARGS:     /
+    # RETURNS:  dict with the metrics, latencies in seconds (None if nothing was reported yet)
+    def get_metrics(self):
+        latencies = list(self.latencies)
+        return {
+            'queue_depth': self.outbox.count(),
+            'reported': self.reported,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'latency_last': latencies[-1] if latencies else None,
+            'latency_mean': sum(latencies)/len(latencies) if latencies else None,
+            'latency_max': max(latencies) if latencies else None,
+        }
+
+    # exit
+    # INFO:     Shuts down this thread. Vends still in the outbox are reported after the next start.
+    # ARGS:     /
+    # RETURNS:  /
+    def exit(self):
+        self.logger.info("SHUTDOWN")
+        self.is_running = False
+        self.wakeup.set()
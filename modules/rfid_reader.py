@@ -1,22 +1,100 @@
 import os
 import configparser
-from threading import Thread
+from threading import Thread, Lock
 import logging
 import queue
 import binascii
 import time
 import evdev
 import asyncio
+import select
+from collections import deque
 
 from modules import CFG, DB
 
 # Name of the RFID reader. Find via devices=[evdev.InputDevice(path) for path in evdev.list_devices()]; for device in devices: print(device.path, device.name, device.phys)
 RFID_USB_NAME = 'OEM RFID Device (Keyboard)' 
 
+# Directory of the stable symlinks to the input devices, named after their USB ids
+BY_ID_PATH = '/dev/input/by-id'
+
+
+# Keystroke_Decoder
+# INFO:     Decodes the keystrokes of the RFID reader in a single pass. Each key code is translated with a precomputed table (KEY_ENTER -> newline, KEY_SPACE -> space, KEY_<name> -> <name>)
+#           and appended to a bytearray, while a state machine over the key codes tracks how much of the terminator (ENTER, E, N, D, ENTER) was typed. Each keystroke costs O(1).
+# ARGS:     /
+# RETURNS:  /
+class Keystroke_Decoder(object):
+
+    # key sequence the RFID reader ends its output with, even if the RFID tag was removed prematurely
+    TERMINATOR = ('KEY_ENTER', 'KEY_E', 'KEY_N', 'KEY_D', 'KEY_ENTER')
+
+    def __init__(self):
+        # key code -> characters, names of aliased codes are taken from their first name
+        self.table = [b''] * (max(evdev.ecodes.keys) + 1)
+        for (code, names) in evdev.ecodes.keys.items():
+            name = names if isinstance(names, str) else names[0]
+            if name == 'KEY_ENTER':
+                self.table[code] = b'\n'
+            elif name == 'KEY_SPACE':
+                self.table[code] = b' '
+            else:
+                self.table[code] = name.replace('KEY_', '').encode('ascii')
+
+        # transitions of the terminator state machine (state = number of matched terminator keys), built like the automaton of the Knuth-Morris-Pratt algorithm
+        terminator = [evdev.ecodes.ecodes[name] for name in self.TERMINATOR]
+        self.transitions = [{terminator[0]: 1}]
+        fallback = 0
+        for (state, code) in enumerate(terminator[1:], start=1):
+            self.transitions.append(dict(self.transitions[fallback]))
+            self.transitions[state][code] = state + 1
+            fallback = self.transitions[fallback].get(code, 0)
+        self.final = len(terminator)
+
+        self.data = bytearray()
+        self.state = 0
+
+    # reset
+    # INFO:     Discards all keystrokes decoded so far.
+    # ARGS:     /
+    # RETURNS:  /
+    def reset(self):
+        self.data.clear()
+        self.state = 0
+
+    # is_partial
+    # INFO:     Tells whether keystrokes of an incomplete output were decoded.
+    # ARGS:     /
+    # RETURNS:  True if there is an incomplete output, False otherwise
+    def is_partial(self):
+        return len(self.data) > 0
+
+    # feed
+    # INFO:     Decodes one keystroke. Once the terminator was typed, returns the decoded output (including the terminator, as '\nEND\n') and starts over.
+    # ARGS:     code (int) -> key code of a key press
+    # RETURNS:  decoded output (str) if it is complete, None otherwise
+    def feed(self, code):
+        if code < len(self.table):
+            self.data += self.table[code]
+        self.state = self.transitions[self.state].get(code, 0)
+        if self.state < self.final:
+            return None
+        data = self.data.decode('ascii')
+        self.reset()
+        return data
 
 
 class RFID_Reader(Thread):
 
+    # time in s a read waits for a card before returning, so that the thread regularly gets control back
+    READ_TIMEOUT = 1.0
+
+    # time in s between two keystrokes after which an incomplete output (e.g. a card removed too early) is discarded
+    CHAR_TIMEOUT = 0.5
+
+    # time in s between two searches for the RFID reader while it is missing
+    RESCAN_INTERVAL = 1.0
+
     # __init__
     # INFO:     Sets up logging and basic variables of this class.
     # ARGS:     /
@@ -30,34 +108,29 @@ class RFID_Reader(Thread):
 
         Thread.__init__(self, daemon=True)
         self.rfid_queue = queue.Queue()
+        self.detected_callback = None
         self.is_running = False
+        self.decoder = Keystroke_Decoder()
+        self.completed = deque() # decoded outputs which were read along with a previous one
+
+        # self-pipe, written by exit() to wake up a waiting read immediately. Closed by the thread when it ends
+        (self.wakeup_fd, self.wakeup_write_fd) = os.pipe()
+        self.wakeup_lock = Lock()
+        os.set_blocking(self.wakeup_fd, False)
+        os.set_blocking(self.wakeup_write_fd, False)
 
         # read stamp for rfid validation from config file
         self.read_cfg(os.path.join(CFG, "rfid.cfg"))
 
-        # set up RFID device by identification of its name
-        devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-        if RFID_USB_NAME not in [device.name for device in devices]:
-            self.logger.error('RFID reader not found in devices. Try finding it with sudo and set up its permissions via udev rule')
-            self.reader = None
-            return
-        
-        path = devices[[device.name for device in devices].index(RFID_USB_NAME)].path
-        self.logger.info('Found RFID reader at '+path)
-        try:
-            self.reader = evdev.InputDevice(path)
-        except Exception as e:
-            self.logger.error('Could not open RFID reader.')
-            self.reader = None
-            return
-
-        # get exclusive read on device via EVIOCGRAB
-        self.reader.grab()
-        self.flush()
-        self.logger.info('Successfully connected, grabbed and flushed the RFID reader. Listening.')
+        # set up RFID device, if it is missing it is searched for again by the thread
+        self.reader = None
+        self.last_scan = 0
+        self.listing = None # input devices at the last search, all of them are only opened again once they changed
+        self.missing = False
+        self.attach()
 
     # run
-    # INFO:     Main thread of this class. Continuosly checks RFID reader for RFID tags, and if one is found, queues the corresponding UID for the main class.
+    # INFO:     Main thread of this class. Continuosly waits for RFID tags on the RFID reader, and if one is found, queues the corresponding UID for the main class.
     # ARGS:     /
     # RETURNS:  /
     def run(self):
@@ -65,43 +138,193 @@ class RFID_Reader(Thread):
 
         while self.is_running:
             try:
-                # read the rfid reader and validate the raw data
+                # reattach the rfid reader after it was unplugged or if it was missing at startup
+                if self.reader is None and time.monotonic() >= self.last_scan + self.RESCAN_INTERVAL:
+                    self.attach()
+
+                # wait for the next output of the rfid reader and validate it
                 raw_data = self.poll()
+                if raw_data is None:
+                    continue
                 self.logger.debug('Processing raw data from rfid reader.')
                 rfid = self.validate(raw_data)
                 if rfid is not False:
-                    # if a valid rfid was found, queue it in the main class
+                    # if a valid rfid was found, hand it to the main class via callback or queue
                     self.logger.debug('detected rfid: '+str(rfid))
-                    self.rfid_queue.put(rfid)
-
-                # sleep to prevent hogging resources
-                time.sleep(0.1)
+                    if self.detected_callback is not None:
+                        self.detected_callback(rfid)
+                    else:
+                        self.rfid_queue.put(rfid)
 
             except Exception as e:
                 self.logger.exception("exception: {}".format(e))
                 continue
 
+        # the device is released by this thread, so that it is never closed while being read. The pipe is forgotten before it is closed, so that a later exit()
+        # does not write to a reused file descriptor
+        self.detach()
+        with self.wakeup_lock:
+            (wakeup_fd, wakeup_write_fd) = (self.wakeup_fd, self.wakeup_write_fd)
+            (self.wakeup_fd, self.wakeup_write_fd) = (None, None)
+        os.close(wakeup_fd)
+        os.close(wakeup_write_fd)
+
+    # set_detected_callback
+    # INFO:     Is set by the main class to be notified immediately about every valid rfid. If no callback is set, rfids are put into rfid_queue instead.
+    # ARGS:     function (function) -> callback, called with the rfid (str)
+    # RETURNS:  /
+    def set_detected_callback(self, function):
+        self.detected_callback = function
+
     # poll
-    # INFO:     Reads the RFID reader which is connected as a keyboard. Due to it being a keyboard, it registers all events as keystrokes, which a filtered and processed with the evdev package.
+    # INFO:     Reads the RFID reader which is connected as a keyboard. Due to it being a keyboard, it registers all events as keystrokes, which are filtered with the evdev package and decoded by the keystroke decoder.
+    #           Waits with select for the reader and the wakeup pipe, so that exit() interrupts it immediately. Returns None if no card was read within READ_TIMEOUT, an incomplete output is discarded after CHAR_TIMEOUT.
     # ARGS:     /
-    # RETURNS:  preprocessed data string of the RFID reader output
+    # RETURNS:  preprocessed data string of the RFID reader output, None if there was none
     def poll(self):
-        # flush all input prior to reading
-        self.flush()
-        self.logger.debug('Started polling ...')
-        data = ''
-        # continuosly read the RFID reader's keystrokes
-        for event in self.reader.read_loop():
-            # only register keystrokes, and filter out Shift, append to data string
-            if event.type is evdev.ecodes.EV_KEY and event.value is 1 and event.code is not evdev.ecodes.ecodes['KEY_LEFTSHIFT']:
-                data += evdev.ecodes.keys[event.code]
-            # the RFID reader ends its output with the "\nEND\n", even if the RFID tag was removed prematurely. Thus this signal is used for termination of the read loop. Then all newlines and spaces are replaced by their real equivalents, in addition to removing all KEY_ prefixes to convert into real string.
-            if data.endswith('KEY_ENTERKEY_EKEY_NKEY_DKEY_ENTER'):
-                self.logger.debug('Found end of reader output.')
-                data = data.replace('KEY_ENTER', '\n')
-                data = data.replace('KEY_SPACE', ' ')
-                data = data.replace('KEY_', '')
-                return data
+        deadline = time.monotonic() + self.READ_TIMEOUT
+        while self.is_running:
+            # outputs of back-to-back taps may arrive with a single read
+            if self.completed:
+                return self.completed.popleft()
+
+            if self.decoder.is_partial():
+                timeout = self.CHAR_TIMEOUT
+            else:
+                if self.reader is None:
+                    deadline = min(deadline, self.last_scan + self.RESCAN_INTERVAL)
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+            fds = [self.wakeup_fd] if self.reader is None else [self.reader.fd, self.wakeup_fd]
+            readable = select.select(fds, [], [], timeout)[0]
+
+            if not readable:
+                if self.decoder.is_partial():
+                    self.logger.info('Discarded incomplete output of the RFID reader.')
+                    self.decoder.reset()
+                    continue
+                return None
+            if self.wakeup_fd in readable:
+                try:
+                    os.read(self.wakeup_fd, 64)
+                except BlockingIOError:
+                    pass
+                continue
+
+            # only register keystrokes, and filter out Shift. The RFID reader ends its output with "\nEND\n", even if the RFID tag was removed prematurely, which completes the decoded data.
+            try:
+                events = list(self.reader.read())
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                # the device was unplugged (ENODEV), it is searched for again by run()
+                self.logger.error('Lost the RFID reader: {}'.format(e))
+                self.detach()
+                self.decoder.reset()
+                self.last_scan = 0
+                return None
+            for event in events:
+                if event.type == evdev.ecodes.EV_KEY and event.value == 1 and event.code != evdev.ecodes.KEY_LEFTSHIFT:
+                    data = self.decoder.feed(event.code)
+                    if data is not None:
+                        self.logger.debug('Found end of reader output.')
+                        self.completed.append(data)
+        return None
+
+    # discover
+    # INFO:     Searches the RFID reader. The configured device path and the stable links in /dev/input/by-id are tried first. All input devices are only opened if they did not lead
+    #           to the reader, and only on the first search or if the devices changed since the last one. Every device which is not the RFID reader is closed again right away.
+    #           Logs the time the search took.
+    # ARGS:     /
+    # RETURNS:  evdev.InputDevice of the RFID reader, None if it was not found
+    def discover(self):
+        started = time.perf_counter()
+        stable_paths = self.stable_paths()
+        all_paths = evdev.list_devices()
+        listing = (frozenset(stable_paths), frozenset(all_paths))
+        candidates = stable_paths + all_paths if listing != self.listing else stable_paths
+        self.listing = listing
+
+        checked = set()
+        opened = 0
+        for path in candidates:
+            if os.path.realpath(path) in checked:
+                continue
+            checked.add(os.path.realpath(path))
+            try:
+                device = evdev.InputDevice(path)
+            except OSError:
+                continue
+            opened += 1
+            if self.is_rfid_reader(device):
+                self.logger.info('Found RFID reader at {} ({}, {}) in {:.1f} ms, {} device(s) opened'.format(path, device.path, device.phys, (time.perf_counter() - started) * 1000, opened))
+                return device
+            device.close()
+        self.logger.debug('RFID reader not found in {:.1f} ms, {} device(s) opened'.format((time.perf_counter() - started) * 1000, opened))
+        return None
+
+    # stable_paths
+    # INFO:     Lists the paths of input devices which do not change between boots: the configured device path and the keyboard links in /dev/input/by-id.
+    # ARGS:     /
+    # RETURNS:  list of paths (str)
+    def stable_paths(self):
+        paths = [self.device_path] if self.device_path else []
+        if os.path.isdir(BY_ID_PATH):
+            paths += sorted(os.path.join(BY_ID_PATH, name) for name in os.listdir(BY_ID_PATH) if name.endswith('-event-kbd'))
+        return paths
+
+    # is_rfid_reader
+    # INFO:     Recognises the RFID reader by its name and, if configured, its physical path (which tells apart identical readers on different USB ports).
+    # ARGS:     device (evdev.InputDevice) -> device to check
+    # RETURNS:  True if the device is the RFID reader
+    def is_rfid_reader(self, device):
+        return device.name == RFID_USB_NAME and (not self.device_phys or device.phys == self.device_phys)
+
+    # attach
+    # INFO:     Searches and opens the RFID reader, gets exclusive read on it and discards its pending input. Logs an error only the first time the reader is missing.
+    # ARGS:     /
+    # RETURNS:  True if the reader is attached, False otherwise
+    def attach(self):
+        self.last_scan = time.monotonic()
+        try:
+            device = self.discover()
+        except Exception as e:
+            self.logger.exception('Searching the RFID reader failed: {}'.format(e))
+            device = None
+        if device is None:
+            if not self.missing:
+                self.logger.error('RFID reader not found in devices. Try finding it with sudo and set up its permissions via udev rule. Searching again every {} s.'.format(self.RESCAN_INTERVAL))
+                self.missing = True
+            return False
+        try:
+            # get exclusive read on device via EVIOCGRAB
+            device.grab()
+            self.reader = device
+            self.flush()
+        except OSError as e:
+            self.logger.error('Could not grab RFID reader: {}'.format(e))
+            device.close()
+            self.reader = None
+            self.listing = None
+            return False
+        self.missing = False
+        self.logger.info('Successfully connected, grabbed and flushed the RFID reader. Listening.')
+        return True
+
+    # detach
+    # INFO:     Releases and closes the RFID reader, e.g. after it was unplugged.
+    # ARGS:     /
+    # RETURNS:  /
+    def detach(self):
+        if self.reader is None:
+            return
+        for release in (self.reader.ungrab, self.reader.close):
+            try:
+                release()
+            except OSError:
+                pass
+        self.reader = None
 
     # flush
     # INFO:     As long as there is data on the serial bus, discard it. Used to completely wipe the input.
@@ -139,16 +362,24 @@ class RFID_Reader(Thread):
         config.read(cfg_path)
         self.stamp = str(config['rfid']['stamp'])
         self.stamp_index = int(config['rfid']['index'])
+        # optional, e.g. /dev/input/by-id/usb-OEM_RFID_Device-event-kbd and usb-3f980000.usb-1.3/input0
+        self.device_path = config['rfid'].get('device', fallback='')
+        self.device_phys = config['rfid'].get('phys', fallback='')
 
     # exit
-    # INFO:     Shuts down this thread.
+    # INFO:     Shuts down this thread. A waiting read is woken up immediately, the reader is released by the thread itself. Can be called again after the thread ended.
     # ARGS:     /
     # RETURNS:  /
     def exit(self):
         self.logger.info("SHUTDOWN")
         self.is_running = False
-        self.reader.ungrab()
-        self.reader.close()
+        with self.wakeup_lock:
+            if self.wakeup_write_fd is None:
+                return
+            try:
+                os.write(self.wakeup_write_fd, b'x')
+            except OSError:
+                pass
 
 
 # FOR TESTING ONLY
@@ -4,7 +4,8 @@ import os.path
 import logging
 import time
 from threading import Thread
-import sqlite3
+import tempfile
+import io
 from functools import wraps
 import configparser
 import time
@@ -12,6 +13,10 @@ import re
 
 from modules import CFG, DB
 from connectors.vcs import VCS_ID
+from connectors.credit_cache import credit_cache
+from connectors.storage import storage
+from modules.inventory_ledger import Inventory_Ledger
+from modules import export
 
 
 
@@ -21,11 +26,9 @@ from connectors.vcs import VCS_ID
 # RETURNS:  /
 class Telegram_Bot(Thread):
 
-    # in order to prevent massive amounts of requests to the api server, cache results of previous api calls for maxage
+    # in order to prevent massive amounts of requests to the api server, cache results of previous api calls for maxage. Credits are cached in the shared credit cache
     api_information = {'last_reset': None, 'next_reset': None, 'standard_credits': None, 'reset_interval': None, 'last_update': 0}
     api_information_maxage = 60 #s
-    rfid_data = {'default': {'credits': 0, 'timestamp': 0}}
-    rfid_data_maxage = 60 #s
 
     # lists of telegram ids for admins and blocked users
     admin_user_id = []
@@ -33,8 +36,12 @@ class Telegram_Bot(Thread):
 
     # list of currently available contents in the maschine per slot and maximal loading per slot
     automat_content = {'slot': {'amount': 0, 'max_amount': 0, 'notification_level': 0}}
+    inventory = None
     max_content_per_slot = 50
 
+    # number of problem reports shown per page of a search
+    search_page_size = 10
+
     # at which remaining content levels to notify the admin group (relative to maximal amount). Note: at 0, there is always an automatic notification
     notification_content_levels = [0.10, 0.00] # at 10% and 0%
 
@@ -61,6 +68,8 @@ class Telegram_Bot(Thread):
         Thread.__init__(self, daemon=True)
         self.is_running = False
         self.shutdown = False
+        self.shutdown_callback = None
+        self.stats_callback = None
 
     # run
     # INFO:     Main loop of the telegram bot. All handlers for commands are registered here.
@@ -147,9 +156,12 @@ class Telegram_Bot(Thread):
         # admin only commands
         self.tbot_dp.add_handler(RegexHandler("(Administratives)", self.admin_panel))
         self.tbot_dp.add_handler(RegexHandler("(Datenbanken aktualisieren)", self.reload_databases))
+        self.tbot_dp.add_handler(RegexHandler("(Statistiken)", self.show_stats))
         self.tbot_dp.add_handler(RegexHandler("(Automat neustarten)", self.restart_service))
         self.tbot_dp.add_handler(RegexHandler("(Zurück zur Übersicht)", self.default_state))
         self.tbot_dp.add_handler(CommandHandler("send", self.answer_report, pass_args=True))
+        self.tbot_dp.add_handler(CommandHandler("export", self.export_entry, pass_args=True))
+        self.tbot_dp.add_handler(CommandHandler("search", self.search_reports, pass_args=True))
 
         # fallback command
         self.tbot_dp.add_handler(RegexHandler(".*", self.help))
@@ -178,6 +190,20 @@ class Telegram_Bot(Thread):
         self.logger.info("SHUTDOWN")
         self.is_running = False
 
+    # set_shutdown_callback
+    # INFO:     Is set by the main class to be notified when a restart of the whole program is requested via the bot.
+    # ARGS:     function (function) -> callback, called with the reason for the shutdown (str)
+    # RETURNS:  /
+    def set_shutdown_callback(self, function):
+        self.shutdown_callback = function
+
+    # set_stats_callback
+    # INFO:     Is set by the main class to provide the vend statistics shown in the admin panel.
+    # ARGS:     function (function) -> callback, called with the length of the interval in seconds, returns the vends per slot (see Vend_History.get_stats)
+    # RETURNS:  /
+    def set_stats_callback(self, function):
+        self.stats_callback = function
+
     # read_cfg
     # INFO:     Reads the configuration file for the telegram bot. Read values are the Telegram API key and the ID of the admin group.
     # ARGS:     /
@@ -194,53 +220,18 @@ class Telegram_Bot(Thread):
     # ARGS:     id -> (string) Telegram ID of user to register the RFID for, rfid -> (string) RFID of the identification card to save
     # RETURNS:  True
     def register_user_in_db(self, id, rfid):
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        db.execute("INSERT INTO users (ID, rfid) VALUES ('"+str(id)+"','"+str(rfid)+"')")
-        db_connector.commit()
-
-        db.execute('SELECT * FROM users')
-        self.users_rfid = {item[0]: item[1] for item in db.fetchall()}
-
-        db_connector.close()
+        storage.write(self.db_path, "INSERT INTO users (ID, rfid) VALUES (?, ?)", (str(id), str(rfid)))
+        self.users_rfid[str(id)] = str(rfid)
         self.logger.info('ID '+str(id)+ ' with RFID '+str(rfid)+' successfully registered in database.')
         return True
 
-    # set_amount_in_db
-    # INFO:     Assing a content amount or the maximum available content amount of a slot to save in the database. amount is expected to be within [0, max_amount]
-    # ARGS:     slot -> (int) Slot of the automat, amount -> (int) amount to set the slot to, max_amount -> (int) maximum amount to set the slot to
-    # RETURNS:  True
-    def set_amount_in_db(self, slot, amount = None, max_amount = None):
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        if amount is not None:
-            db.execute("UPDATE automat SET amount = '"+str(amount)+"' WHERE slot = '"+str(slot)+"'")
-            db_connector.commit()
-            self.logger.info('Amount in slot '+str(slot)+ ' updated to '+str(amount)+' successfully in database.')
-
-        if max_amount is not None:
-            db.execute("UPDATE automat SET max_amount = '"+str(max_amount)+"' WHERE slot = '"+str(slot)+"'")
-            db_connector.commit()
-            self.logger.info('Max amount in slot '+str(slot)+ ' updated to '+str(max_amount)+' successfully in database.')
-
-        db_connector.close()
-        return True
-
     # ban_user_in_db
     # INFO:
     # ARGS:
     # RETURNS:
     def ban_user_in_db(self, banned_id, id_of_admin = 000000):
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        db.execute("INSERT INTO blacklist (ID, timestamp, by) VALUES ('"+str(banned_id)+"', '"+str(int(time.time()))+"', '"+str(id_of_admin)+"')")
-        db_connector.commit()
+        storage.write(self.db_path, "INSERT INTO blacklist (ID, timestamp, by) VALUES (?, ?, ?)", (str(banned_id), str(int(time.time())), str(id_of_admin)))
         self.logger.info('Telegram ID '+str(banned_id)+ ' was banned by '+str(id_of_admin)+' successfully in database.')
-
-        db_connector.close()
         return True
 
     # add_admin_in_db
@@ -248,14 +239,8 @@ class Telegram_Bot(Thread):
     # ARGS:
     # RETURNS:
     def add_admin_in_db(self, new_id, id_of_admin = 000000):
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        db.execute("INSERT INTO admins (ID, name) VALUES ('"+str(new_id)+"', 'added by "+str(id_of_admin)+"')")
-        db_connector.commit()
+        storage.write(self.db_path, "INSERT INTO admins (ID, name) VALUES (?, ?)", (str(new_id), 'added by '+str(id_of_admin)))
         self.logger.info('Telegram ID '+str(new_id)+ ' was added to admins by '+str(id_of_admin)+' successfully in database.')
-
-        db_connector.close()
         return True
 
     # name
@@ -263,37 +248,58 @@ class Telegram_Bot(Thread):
     # ARGS:
     # RETURNS:
     def save_report_in_db(self, report_text, id_of_reporter):
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        db.execute("INSERT INTO reports (ID, timestamp, text) VALUES ('"+str(id_of_reporter)+"', '"+str(int(time.time()))+"', '"+str(report_text)+"')")
-        db_connector.commit()
+        storage.write(self.db_path, "INSERT INTO reports (ID, timestamp, text) VALUES (?, ?, ?)", (str(id_of_reporter), str(int(time.time())), str(report_text)))
         self.logger.info('Telegram ID '+str(id_of_reporter)+' and its report successfully saved in database.')
-
-        db_connector.close()
         return True
+
+    # search_reports_in_db
+    # INFO:     Searches the problem reports, newest first. Keywords are matched as word prefixes against the full-text index of the reports, the reporter and the date range against the indexed columns.
+    #           If SQLite has no full-text index (see modules/migrations.py), keywords are matched anywhere in the text of the reports instead.
+    # ARGS:     keywords (list) -> words which all have to occur in the report, id (str, optional) -> Telegram ID of the reporter, start (float, optional) -> first timestamp to include,
+    #           end (float, optional) -> first timestamp to exclude, page (int, optional) -> page of the results, starting at 1
+    # RETURNS:  list of (timestamp, ID, text) tuples, at most search_page_size
+    def search_reports_in_db(self, keywords, id = None, start = None, end = None, page = 1):
+        query = 'SELECT timestamp, ID, text FROM reports'
+        conditions = []
+        params = []
+        if keywords and self.full_text_search:
+            # the keys of the matching reports are collected from the full-text index first, so that the filters below can still use the indexes of reports
+            conditions.append('report_id IN (SELECT rowid FROM reports_fts WHERE reports_fts MATCH ?)')
+            # every keyword is quoted, so that the FTS query syntax cannot be injected
+            params.append(' '.join('"'+keyword.replace('"', '""')+'"*' for keyword in keywords))
+        elif keywords:
+            for keyword in keywords:
+                conditions.append("text LIKE ? ESCAPE '\\'")
+                params.append('%'+keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')+'%')
+        if id is not None:
+            conditions.append('ID = ?')
+            params.append(str(id))
+        if start is not None:
+            conditions.append('timestamp >= ?')
+            params.append(int(start))
+        if end is not None:
+            conditions.append('timestamp < ?')
+            params.append(int(end))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY timestamp DESC LIMIT ? OFFSET ?'
+        params += [self.search_page_size, (page - 1)*self.search_page_size]
+        return storage.query(self.db_path, query, params)
     
     # name
     # INFO:
     # ARGS:
     # RETURNS:
     def initialise_db(self):
-        db_connector = sqlite3.connect(self.db_path)
-        db = db_connector.cursor()
-
-        db.execute('SELECT * FROM admins')
-        self.admin_user_id = [item[0] for item in db.fetchall()]
-
-        db.execute('SELECT * FROM blacklist')
-        self.blacklist_user_id = [item[0] for item in db.fetchall()]
-
-        db.execute('SELECT * FROM users')
-        self.users_rfid = {item[0]: item[1] for item in db.fetchall()}
-
-        db.execute('SELECT * FROM automat')
-        self.automat_content = {item[0]: {'amount': item[1], 'max_amount': item[2], 'notification_level': 0} for item in db.fetchall()}
-
-        db_connector.close()
+        self.admin_user_id = [item[0] for item in storage.query(self.db_path, 'SELECT * FROM admins')]
+        self.blacklist_user_id = [item[0] for item in storage.query(self.db_path, 'SELECT * FROM blacklist')]
+        self.users_rfid = {item[0]: item[1] for item in storage.query(self.db_path, 'SELECT * FROM users')}
+        self.full_text_search = storage.query_one(self.db_path, "SELECT 1 FROM sqlite_master WHERE name = 'reports_fts'") is not None
+        if self.inventory is None:
+            self.inventory = Inventory_Ledger(self.db_path)
+        else:
+            self.inventory.load()
+        self.automat_content = {slot: {'amount': level['amount'], 'max_amount': level['max_amount'], 'notification_level': 0} for (slot, level) in self.inventory.get_levels().items()}
         self.logger.info('database loaded')
 
     # name
@@ -331,7 +337,7 @@ class Telegram_Bot(Thread):
     # ARGS:
     # RETURNS:
     def admin_keyboard(self):
-        keyboard = [['Füllstand ändern', 'Maximalmengen ändern'], ['User bannen', 'Admin ernennen'], ['Datenbanken aktualisieren', 'Automat neustarten'], ['Zurück zur Übersicht']]
+        keyboard = [['Füllstand ändern', 'Maximalmengen ändern'], ['User bannen', 'Admin ernennen'], ['Datenbanken aktualisieren', 'Automat neustarten'], ['Statistiken'], ['Zurück zur Übersicht']]
         return ReplyKeyboardMarkup(keyboard)
 
     # name
@@ -480,9 +486,8 @@ class Telegram_Bot(Thread):
             update.message.reply_text('Um dein Guthaben abzurufen muss deine Legi-Identifikationsnummer mit deinem Telegram-Account in Verbindung gebracht werden. Ich werde mir die Legi-Identifikationsnummer merken und künftig direkt mit deinem Guthaben antworten.\n\nBitte sende mir deine Legi-Identifikationsnummer als Nachricht oder breche den Vorgang mit /cancel ab:', reply_markup = ReplyKeyboardRemove())
             return 1
         rfid = self.users_rfid[str(update.effective_user.id)]
-        if rfid in self.rfid_data and time.time() < self.rfid_data[rfid]['timestamp'] + self.rfid_data_maxage:
-            remaining_credits = self.rfid_data[rfid]['credits']
-        else:
+        data = credit_cache.get(VCS_ID.orgname, rfid)
+        if data is None:
             conn = VCS_ID()
             data = conn.auth(rfid)
             if data is None:
@@ -490,9 +495,8 @@ class Telegram_Bot(Thread):
                 self.logger.error('RFID '+str(rfid)+' was either unknown or there was an error.')
                 self.default_state(bot, update)
                 return ConversationHandler.END
-            remaining_credits = data.credits
-        update.message.reply_text('Dein Guthaben beträgt '+str(remaining_credits)+' Freigetränk(e).')
-        self.rfid_data[rfid] = {'credits': remaining_credits, 'timestamp': time.time()}
+            credit_cache.put(VCS_ID.orgname, rfid, data)
+        update.message.reply_text('Dein Guthaben beträgt '+str(data.credits)+' Freigetränk(e).')
         self.default_state(bot, update)
         return ConversationHandler.END
 
@@ -511,8 +515,7 @@ class Telegram_Bot(Thread):
             update.message.reply_text('Die Identifikationsnummer besteht aus 6 Zahlen. Versuche es erneut:')
             return 1
 
-        self.users_rfid[update.effective_user.id] = raw_rfid
-        self.rfid_data[raw_rfid] = {'credits': 0, 'timestamp': 0}
+        credit_cache.invalidate(VCS_ID.orgname, raw_rfid)
         self.register_user_in_db(update.effective_user.id, raw_rfid)
         update.message.reply_text('Die Identifikationsnummer wurde erfolgreich gespeichert!')
         return self.credits_entry(bot, update)
@@ -561,7 +564,7 @@ class Telegram_Bot(Thread):
             return self.amount_cancel(bot, update)
         if slot == 'Alles gefüllt':
             update.message.reply_text('Alle Slots auf ihr Maximum aktualisiert.')
-            for slot_number in self.automat_content: self.update_fillstatus_callback(slot_number, amount = self.automat_content[slot_number]['max_amount'])
+            self.refill_callback(update.effective_user.id)
             self.admin_panel(bot, update)
             return ConversationHandler.END
 
@@ -604,7 +607,7 @@ class Telegram_Bot(Thread):
             update.message.reply_text('Ungültiger Wert.\nAuf welche Menge soll der Slot '+str(slot)+' aktualisiert werden?\nSende \'*\' für die Maximalmenge, also '+str(self.automat_content[slot]['max_amount'])+'.', reply_markup = ReplyKeyboardRemove())
             return 2
         user_data.pop('slot')
-        self.update_fillstatus_callback(slot, amount = amount)
+        self.update_fillstatus_callback(slot, amount = amount, by = update.effective_user.id)
         update.message.reply_text('Slot '+str(slot)+' erfolgreich auf '+str(amount)+' geändert.\nWelcher Slot soll aktualisiert werden?', reply_markup = self.slot_keyboard(with_complete=True))
         return 1
 
@@ -674,7 +677,7 @@ class Telegram_Bot(Thread):
             update.message.reply_text('Ungültiger Wert.\nAuf welche Maximalmenge soll der Slot '+str(slot)+' aktualisiert werden?', reply_markup = ReplyKeyboardRemove())
             return 2
         user_data.pop('slot')
-        self.update_maxfillstatus_callback(slot, amount)
+        self.update_maxfillstatus_callback(slot, amount, by = update.effective_user.id)
         update.message.reply_text('Slot '+str(slot)+' erfolgreich auf Maximalmenge '+str(amount)+' geändert.\nFür welchen Slot soll die Maximalmenge aktualisiert werden?', reply_markup = self.slot_keyboard(with_complete=False))
         return 1
 
@@ -761,6 +764,30 @@ class Telegram_Bot(Thread):
         update.message.reply_text('Datenbanken werden neu gelesen.')
         self.admin_panel(bot, update)
 
+    # show_stats
+    # INFO:     Shows the number of vends per slot in the last 24 hours and 7 days, along with the mean time from the RFID tap to the dispense.
+    # ARGS:     /
+    # RETURNS:  /
+    @admin_only
+    def show_stats(self, bot, update):
+        if self.stats_callback is None:
+            update.message.reply_text('Keine Statistiken verfügbar.')
+            self.admin_panel(bot, update)
+            return
+        string = 'Verkäufe pro Slot:\n'
+        for (title, duration) in (('Letzte 24 Stunden', 24*3600), ('Letzte 7 Tage', 7*24*3600)):
+            stats = self.stats_callback(duration)
+            string += '\n'+title+':\n'
+            for slot in self.active_slots:
+                if slot in stats:
+                    latency = stats[slot]['latency_mean']
+                    string += 'Slot '+str(slot-self.slot_offset)+': '+str(stats[slot]['count'])+(' (Ø '+'{:.1f}'.format(latency)+' s)' if latency is not None else '')+'\n'
+                else:
+                    string += 'Slot '+str(slot-self.slot_offset)+': 0\n'
+            string += 'Total: '+str(sum(slot_stats['count'] for slot_stats in stats.values()))+'\n'
+        update.message.reply_text(string)
+        self.admin_panel(bot, update)
+
     # restart_service
     # INFO:     Restarts the entire program by shutting down the telegram thread, which in turn causes the main thread to end. The system service manager will then restart the service after its timeout.
     # ARGS:     /
@@ -772,6 +799,8 @@ class Telegram_Bot(Thread):
         self.logger.warning('Restart was initiated. Will shut down process now.')
         self.shutdown = True
         self.is_running = False
+        if self.shutdown_callback is not None:
+            self.shutdown_callback('Internal Signal')
 
     # add_admin
     # INFO:     Adds an admin to the database.
@@ -844,11 +873,93 @@ class Telegram_Bot(Thread):
             return
         self.tbot_up.bot.send_message(chat_id=user_id, text='Antwort der Admins auf deine Meldung:\n\n'+message)
 
+    # search_reports
+    # INFO:     Searches the problem reports. Usage: /search [Stichworte] [id:Telegram-ID] [von:JJJJ-MM-TT] [bis:JJJJ-MM-TT] [seite:N]
+    # ARGS:     args (list) -> arguments of the command
+    # RETURNS:  /
+    @admin_only
+    def search_reports(self, bot, update, args):
+        usage = 'Verwendung: /search [Stichworte] [id:Telegram-ID] [von:JJJJ-MM-TT] [bis:JJJJ-MM-TT] [seite:N]'
+        keywords = []
+        filters = {'id': None, 'von': None, 'bis': None, 'seite': '1'}
+        for arg in args:
+            (name, separator, value) = arg.partition(':')
+            if separator and name.lower() in filters:
+                filters[name.lower()] = value
+            else:
+                keywords.append(arg)
+        try:
+            start = export.parse_date(filters['von'])
+            end = export.parse_date(filters['bis'], end=True)
+            page = int(filters['seite'])
+            if page < 1:
+                raise ValueError(page)
+        except ValueError:
+            update.message.reply_text(usage)
+            return
+        if not args:
+            update.message.reply_text(usage)
+            return
+
+        results = self.search_reports_in_db(keywords, id = filters['id'], start = start, end = end, page = page)
+        if not results:
+            update.message.reply_text('Keine Meldungen gefunden.')
+            return
+        string = 'Meldungen, Seite '+str(page)+':\n'
+        for (timestamp, id, text) in results:
+            string += '\n'+time.strftime('%Y-%m-%d %H:%M', time.localtime(int(timestamp)))+', ID '+str(id)+':\n'+str(text)[:300]+'\n'
+        if len(results) == self.search_page_size:
+            string += '\nWeitere Meldungen mit seite:'+str(page + 1)
+        update.message.reply_text(string)
+
+    # export_entry
+    # INFO:     Exports a history as a document, see modules/export.py. Usage: /export <vends|usage|reports> [csv|jsonl] [from YYYY-MM-DD] [to YYYY-MM-DD]. The export runs in its own thread,
+    #           so that neither the bot nor the MDB handler waits for it.
+    # ARGS:     args (list) -> arguments of the command
+    # RETURNS:  /
+    @admin_only
+    def export_entry(self, bot, update, args):
+        usage = 'Verwendung: /export <'+'|'.join(sorted(export.SOURCES))+'> ['+'|'.join(export.FORMATS)+'] [von JJJJ-MM-TT] [bis JJJJ-MM-TT]'
+        if not args or args[0] not in export.SOURCES:
+            update.message.reply_text(usage)
+            return
+        source = args[0]
+        format = args[1] if len(args) > 1 else 'csv'
+        try:
+            if format not in export.FORMATS:
+                raise ValueError(format)
+            start = export.parse_date(args[2] if len(args) > 2 else None)
+            end = export.parse_date(args[3] if len(args) > 3 else None, end=True)
+        except ValueError:
+            update.message.reply_text(usage)
+            return
+        update.message.reply_text('Export wird erstellt...')
+        Thread(target=self.export_worker, args=(update.message.chat_id, source, format, start, end), daemon=True).start()
+
+    # export_worker
+    # INFO:     Streams an export into a temporary file and sends it to the chat it was requested from.
+    # ARGS:     chat_id (int) -> chat to send the document to, source (str) -> exported source, format (str) -> 'csv' or 'jsonl', start (float) -> first timestamp, end (float) -> timestamp after the last one
+    # RETURNS:  /
+    def export_worker(self, chat_id, source, format, start, end):
+        try:
+            with tempfile.TemporaryFile(mode='w+b') as document:
+                output = io.TextIOWrapper(document, encoding='utf8', newline='')
+                count = export.export(source, format, output, start=start, end=end)
+                output.flush()
+                document.seek(0)
+                self.tbot_up.bot.send_document(chat_id=chat_id, document=document, filename='{}_{}.{}'.format(source, time.strftime('%Y%m%d-%H%M%S'), format), caption=str(count)+' Einträge')
+                output.detach()
+        except Exception as e:
+            self.logger.exception('export of {} failed: {}'.format(source, e))
+            self.tbot_up.bot.send_message(chat_id=chat_id, text='Export fehlgeschlagen.')
+        finally:
+            storage.close()
+
     # update_fillstatus_callback
-    # INFO:     Checks if slot to be changed is valid, then either decrements the amount in that slot by 1 if amount is None, otherwise update slot content to amount both locally in array as well as in database. Handles admin group notifications by comparing the new slot amount to the notification levels specified in the class. 
-    # ARGS:     slot (int) -> chosen slot to update, amount (int) -> amount to set slot to, will decrease amount by 1 if no amount specified
+    # INFO:     Checks if slot to be changed is valid, then either records a vend of that slot if amount is None, otherwise sets the slot content to amount, both locally in array as well as in the inventory ledger. Handles admin group notifications by comparing the new slot amount to the notification levels specified in the class. 
+    # ARGS:     slot (int) -> chosen slot to update, amount (int) -> amount to set slot to, will decrease amount by 1 if no amount specified, by (str, optional) -> Telegram ID of the admin setting the amount
     # RETURNS:  /
-    def update_fillstatus_callback(self, slot, amount = None):
+    def update_fillstatus_callback(self, slot, amount = None, by = None):
         if slot not in self.automat_content:
             self.logger.error('Received content update for slot '+str(slot)+' which is unknown. Dismissing.')
             return
@@ -856,15 +967,14 @@ class Telegram_Bot(Thread):
         if amount is None:
             if old_amount <= 0:
                 self.logger.error('Received decrement content update for slot '+str(slot)+' which was assumed to be empty.')
-                new_amount = 0
             else:
                 self.logger.debug('Received decrement content update for slot '+str(slot)+', which had '+str(old_amount)+' in it.')
-                new_amount = old_amount - 1
+            self.inventory.record(Inventory_Ledger.VEND, slot)
         else:
             self.logger.debug('Received set content update for slot '+str(slot)+' with specified new amount '+str(amount))
-            new_amount = amount
+            self.inventory.record(Inventory_Ledger.SET, slot, amount, by)
+        new_amount = self.inventory.get(slot)['amount']
         self.automat_content[slot]['amount'] = new_amount
-        self.set_amount_in_db(slot, amount = new_amount)
 
         if new_amount is 0:
             self.tbot_up.bot.send_message(chat_id=self.admin_group_id, text='Slot '+str(slot)+' ist leer!', disable_notification=False)
@@ -877,11 +987,23 @@ class Telegram_Bot(Thread):
         elif old_amount < new_amount:
             self.automat_content[slot]['notification_level'] = 0
 
+    # refill_callback
+    # INFO:     Fills all slots to their maximum amount with a single REFILL event in the inventory ledger and resets the notification levels.
+    # ARGS:     by (str, optional) -> Telegram ID of the admin who refilled the automat
+    # RETURNS:  /
+    def refill_callback(self, by = None):
+        self.logger.debug('Received refill of all slots')
+        self.inventory.record(Inventory_Ledger.REFILL, by=by)
+        for (slot, level) in self.inventory.get_levels().items():
+            if slot in self.automat_content:
+                self.automat_content[slot]['amount'] = level['amount']
+                self.automat_content[slot]['notification_level'] = 0
+
     # uppdate_maxfillstatus_callback
-    # INFO:     Checks if slot to be changed is valid, then adjusts maximum amount to maxamount in local array and in database.
-    # ARGS:     slot (int) -> chosen slot to update, maxamount (int) -> maximum amount to set slot to
+    # INFO:     Checks if slot to be changed is valid, then adjusts maximum amount to maxamount in local array and in the inventory ledger.
+    # ARGS:     slot (int) -> chosen slot to update, maxamount (int) -> maximum amount to set slot to, by (str, optional) -> Telegram ID of the admin setting the maximum amount
     # RETURNS:  /
-    def update_maxfillstatus_callback(self, slot, maxamount):
+    def update_maxfillstatus_callback(self, slot, maxamount, by = None):
         if slot not in self.automat_content:
             self.logger.error('Received max-content update for slot '+str(slot)+' which is unknown. Dismissing.')
             return
@@ -889,9 +1011,8 @@ class Telegram_Bot(Thread):
             self.logger.error('Received max-content update for slot '+str(slot)+' which is negative. Dismissing.')
             return
         self.logger.debug('Received set max-content update for slot '+str(slot)+' with specified new max-amount '+str(maxamount))
+        self.inventory.record(Inventory_Ledger.MAX, slot, maxamount, by)
         self.automat_content[slot]['max_amount'] = maxamount
-        self.set_amount_in_db(slot, max_amount = maxamount)
-
 
 # main executable
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+import os.path
+import logging
+import time
+
+from modules import DB
+from connectors.storage import storage
+
+
+# Vend_History
+# INFO:     Local history of all dispensed vends (slot, organisation, timestamp and latency from the RFID tap to the dispense). Every vend is appended to the vends table, a trigger
+#           adds it to the hourly aggregate of its slot and organisation in the same transaction. Statistics are answered from the aggregates only, without scanning the vends. The tables are created by modules/migrations.py.
+# ARGS:     db_path (str, optional) -> path of the history database
+# RETURNS:  /
+class Vend_History(object):
+
+    db_path = os.path.join(DB, "history.db")
+
+    # length of an aggregation interval in seconds, as used by the trigger filling vends_hourly (see modules/migrations.py)
+    ROLLUP_INTERVAL = 3600
+
+    def __init__(self, db_path=None):
+        # set-up for logging of history. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'history'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        if db_path is not None:
+            self.db_path = db_path
+
+    # record
+    # INFO:     Appends a dispensed vend to the history without waiting for the disk.
+    # ARGS:     slot (int) -> vended slot, org (str) -> orgname of the ID provider of the user, latency (float, optional) -> seconds from the RFID tap to the dispense,
+    #           timestamp (float, optional) -> time of the dispense
+    # RETURNS:  concurrent.futures.Future of the write
+    def record(self, slot, org, latency=None, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        return storage.write(self.db_path, 'INSERT INTO vends (timestamp, slot, org, latency) VALUES (?, ?, ?, ?)', (timestamp, int(slot), str(org), latency))
+
+    # get_stats
+    # INFO:     Sums up the vends per slot from the hourly aggregates. The interval is rounded to whole hours, the current hour is included.
+    # ARGS:     duration (float) -> length of the interval up to now in seconds, now (float, optional) -> end of the interval
+    # RETURNS:  dict slot -> dict with 'count', 'latency_mean' (None if unknown) and 'latency_max'
+    def get_stats(self, duration, now=None):
+        if now is None:
+            now = time.time()
+        first_hour = int((now - duration) // self.ROLLUP_INTERVAL) + 1
+        rows = storage.query(self.db_path, 'SELECT slot, SUM(count), SUM(latency_count), SUM(latency_sum), MAX(latency_max) FROM vends_hourly WHERE hour >= ? GROUP BY slot ORDER BY slot', (first_hour,))
+        return {slot: {'count': count, 'latency_mean': latency_sum / latency_count if latency_count else None, 'latency_max': latency_max}
+                for (slot, count, latency_count, latency_sum, latency_max) in rows}
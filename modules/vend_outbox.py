@@ -0,0 +1,124 @@
+import os.path
+import logging
+import time
+
+from modules import DB
+from connectors.vcs import generate_nonce
+from connectors.storage import storage
+
+
+# Vend_Outbox
+# INFO:     Crash-safe record of all vends which are not yet reported. Every vend is written to the outbox before it is reported, and only removed after the report was successful.
+#           Each entry has an idempotency key (same format as the API nonces), which is sent along with every report attempt of the entry.
+#           Entries which were rejected by their organisation, or whose report kept failing (see MAX_ATTEMPTS), are moved to the dead letters, so that they do not block the others.
+# ARGS:     /
+# RETURNS:  /
+class Vend_Outbox(object):
+
+    db_path = os.path.join(DB, "outbox.db")
+
+    # an entry is given up once its report failed MAX_ATTEMPTS times and the vend is older than MAX_AGE seconds. Report_Worker only counts attempts which reached the
+    # ID provider, and only for the oldest failed entry of an organisation, so an outage of the API alone does not give up vends before they are a week old
+    MAX_ATTEMPTS = 100
+    MAX_AGE = 7*24*3600
+
+    # __init__
+    # INFO:     Sets up logging and the synchronous mode of the outbox database. Its table is created by modules/migrations.py.
+    # ARGS:     db_path (str, optional) -> path of the outbox database
+    # RETURNS:  /
+    def __init__(self, db_path=None):
+        # set-up for logging of outbox. Level options: DEBUG, INFO, WARNING, ERROR, CRITICAL
+        self.loglevel = logging.INFO
+        self.logtitle = 'outbox'
+        self.logger = logging.getLogger(self.logtitle)
+        self.logger.setLevel(self.loglevel)
+
+        if db_path is not None:
+            self.db_path = db_path
+
+        # a recorded vend must survive a power loss, every commit is synced
+        storage.configure(self.db_path, 'FULL')
+
+        pending = self.count()
+        if pending > 0:
+            self.logger.warning('{} vend(s) from a previous run are not yet reported'.format(pending))
+
+    # add
+    # INFO:     Records a vend in the outbox. Returns only after the entry is committed.
+    # ARGS:     slot (int) -> vended slot, rfid (str) -> RFID of the user, org (str) -> orgname of the ID provider of the user
+    # RETURNS:  idempotency key (str) of the new entry
+    def add(self, slot, rfid, org):
+        key = generate_nonce()
+        storage.write(self.db_path, 'INSERT INTO outbox (key, timestamp, slot, rfid, org) VALUES (?, ?, ?, ?, ?)', (key, int(time.time()), int(slot), str(rfid), str(org))).result()
+        self.logger.debug('vend of slot {} by {} from {} recorded with key {}'.format(slot, rfid, org, key))
+        return key
+
+    # pending
+    # INFO:     Returns the oldest entries of the outbox, in the order the vends happened.
+    # ARGS:     limit (int) -> maximum number of entries, exclude_orgs (iterable, optional) -> orgnames whose entries are skipped
+    # RETURNS:  list of dicts with the keys id, key, timestamp, slot, rfid, org, attempts
+    def pending(self, limit, exclude_orgs=()):
+        exclude_orgs = list(exclude_orgs)
+        query = 'SELECT id, key, timestamp, slot, rfid, org, attempts FROM outbox'
+        if exclude_orgs:
+            query += ' WHERE org NOT IN ({})'.format(', '.join('?'*len(exclude_orgs)))
+        query += ' ORDER BY id LIMIT ?'
+        rows = storage.query(self.db_path, query, exclude_orgs + [limit])
+        return [dict(zip(('id', 'key', 'timestamp', 'slot', 'rfid', 'org', 'attempts'), row)) for row in rows]
+
+    # remove
+    # INFO:     Removes successfully reported entries from the outbox. Returns after the removal is committed.
+    # ARGS:     ids (list) -> ids of the entries
+    # RETURNS:  /
+    def remove(self, ids):
+        if not ids:
+            return
+        storage.write(self.db_path, 'DELETE FROM outbox WHERE id = ?', [(id,) for id in ids], many=True).result()
+
+    # failed
+    # INFO:     Counts a failed report attempt for the given entries and moves the entries which failed MAX_ATTEMPTS times and are older than MAX_AGE to the dead letters.
+    #           Returns after the update is committed.
+    # ARGS:     ids (list) -> ids of the entries
+    # RETURNS:  /
+    def failed(self, ids):
+        if not ids:
+            return
+        storage.write(self.db_path, 'UPDATE outbox SET attempts = attempts + 1 WHERE id = ?', [(id,) for id in ids], many=True).result()
+        exhausted = storage.query(self.db_path, 'SELECT id FROM outbox WHERE attempts >= ? AND timestamp <= ? AND id IN ({})'.format(', '.join('?'*len(ids))),
+                                  [self.MAX_ATTEMPTS, int(time.time()) - self.MAX_AGE] + list(ids))
+        self.give_up([row[0] for row in exhausted], 'failed')
+
+    # rejected
+    # INFO:     Moves entries which were rejected by their organisation to the dead letters right away, as repeating their report cannot succeed. Returns after the move is committed.
+    # ARGS:     ids (list) -> ids of the entries
+    # RETURNS:  /
+    def rejected(self, ids):
+        self.give_up(ids, 'rejected')
+
+    # give_up
+    # INFO:     Moves entries from the outbox to the dead letters and logs each of them. The copy is committed before the entries are removed, so that no entry is lost on a crash.
+    # ARGS:     ids (list) -> ids of the entries, reason (str) -> why the entries are not reported
+    # RETURNS:  /
+    def give_up(self, ids, reason):
+        if not ids:
+            return
+        rows = storage.query(self.db_path, 'SELECT key, slot, rfid, org, attempts FROM outbox WHERE id IN ({})'.format(', '.join('?'*len(ids))), list(ids))
+        storage.write(self.db_path, 'INSERT OR IGNORE INTO dead_letters (key, timestamp, slot, rfid, org, attempts, reason, dropped) '
+                      'SELECT key, timestamp, slot, rfid, org, attempts, ?, ? FROM outbox WHERE id = ?', [(reason, int(time.time()), id) for id in ids], many=True).result()
+        self.remove(ids)
+        for (key, slot, rfid, org, attempts) in rows:
+            self.logger.error('vend of slot {} by {} from {} with key {} is not reported, {} after {} attempt(s)'.format(slot, rfid, org, key, reason, attempts))
+
+    # count
+    # INFO:     Returns the number of entries which are not yet reported.
+    # ARGS:     /
+    # RETURNS:  number of entries (int)
+    def count(self):
+        return storage.query_one(self.db_path, 'SELECT COUNT(*) FROM outbox')[0]
+
+    # close
+    # INFO:     Closes the connections of the calling thread to the outbox database.
+    # ARGS:     /
+    # RETURNS:  /
+    def close(self):
+        storage.close()
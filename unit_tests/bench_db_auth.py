@@ -0,0 +1,65 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from connectors.database import DB_ID
+
+
+# Microbenchmark of DB_ID.auth with a growing number of special-access users.
+# Compares the former full table scan per tap with the in-memory set of DB_ID, which is only reloaded if the database changes.
+
+USERS = [100, 1000, 10000, 50000]
+LOOKUPS = 1000
+
+
+# scan_auth
+# INFO:     Former DB_ID.auth: reads all users and checks the rfid against the list
+# ARGS:     db_path (str) -> path of the users database, rfid (str) -> RFID to look up
+# RETURNS:  True if the rfid is known
+def scan_auth(db_path, rfid):
+    db_connector = sqlite3.connect(db_path)
+    db = db_connector.cursor()
+    db.execute('SELECT * FROM users')
+    users = [item[0] for item in db.fetchall()]
+    db_connector.close()
+    return str(rfid) in users
+
+
+# measure
+# INFO:     Looks up LOOKUPS rfids (half of them unknown) and returns the mean duration per lookup
+# ARGS:     auth (function) -> looks up one rfid
+# RETURNS:  mean duration in seconds
+def measure(auth):
+    started = time.perf_counter()
+    for i in range(LOOKUPS):
+        auth(str(100000 + 2*i))
+    return (time.perf_counter() - started) / LOOKUPS
+
+
+directory = tempfile.mkdtemp()
+for users in USERS:
+    db_path = os.path.join(directory, 'users_{}.db'.format(users))
+    shutil.copy(os.path.join(parent_dir, 'database', 'users.db_default'), db_path)
+    db_connector = sqlite3.connect(db_path)
+    db_connector.executemany('INSERT INTO users (rfid, name) VALUES (?, ?)', ((str(100000 + 4*i), 'user') for i in range(users)))
+    db_connector.commit()
+    db_connector.close()
+
+    provider = DB_ID()
+    provider.logger.disabled = True
+    provider.db_path = db_path
+
+    scan = measure(lambda rfid: scan_auth(db_path, rfid))
+    # the first lookup loads the rfids into memory
+    started = time.perf_counter()
+    provider.auth('0')
+    load = time.perf_counter() - started
+    cached = measure(provider.auth)
+    print('{:>6} users   scan {:10.3f} us   cached {:10.3f} us   (initial load {:8.3f} ms)'.format(users, scan * 1e6, cached * 1e6, load * 1e3))
+
+shutil.rmtree(directory)
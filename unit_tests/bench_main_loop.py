@@ -0,0 +1,69 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import random
+import queue
+from threading import Thread
+
+
+# Benchmark of the latency between an RFID tap and the main loop picking it up.
+# Compares the former sleep-polling loop (0.2 s interval) with the event-driven loop blocking on the event queue.
+# The lookup itself is left out, as it is identical for both loops.
+
+TAPS = 50
+POLL_INTERVAL = 0.2
+
+
+# polling_loop
+# INFO:     Former main loop: checks the queue and sleeps 0.2 s
+# ARGS:     taps (queue.Queue) -> queue of tap timestamps, latencies (list) -> output list
+# RETURNS:  /
+def polling_loop(taps, latencies):
+    while len(latencies) < TAPS:
+        if not taps.empty():
+            tapped = taps.get()
+            latencies.append(time.perf_counter() - tapped)
+        time.sleep(POLL_INTERVAL)
+
+
+# event_loop
+# INFO:     Event-driven main loop: blocks on the queue until the next event arrives
+# ARGS:     taps (queue.Queue) -> queue of tap timestamps, latencies (list) -> output list
+# RETURNS:  /
+def event_loop(taps, latencies):
+    while len(latencies) < TAPS:
+        tapped = taps.get()
+        latencies.append(time.perf_counter() - tapped)
+
+
+# measure
+# INFO:     Runs a loop in its own thread and feeds it with taps at random intervals
+# ARGS:     loop (function) -> loop to measure
+# RETURNS:  list of latencies in seconds
+def measure(loop):
+    taps = queue.Queue()
+    latencies = []
+    worker = Thread(target=loop, args=(taps, latencies), daemon=True)
+    worker.start()
+    for i in range(TAPS):
+        time.sleep(random.uniform(0.25, 0.5))
+        taps.put(time.perf_counter())
+    worker.join()
+    return latencies
+
+
+# report
+# INFO:     Prints the latency distribution
+# ARGS:     title (str) -> name of the loop, latencies (list) -> latencies in seconds
+# RETURNS:  /
+def report(title, latencies):
+    latencies = sorted(latencies)
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    print('{:<10} min {:8.3f} ms   p50 {:8.3f} ms   p90 {:8.3f} ms   p99 {:8.3f} ms   max {:8.3f} ms'.format(
+        title, latencies[0] * 1000, percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1] * 1000))
+
+
+report('polling', measure(polling_loop))
+report('event', measure(event_loop))
@@ -0,0 +1,195 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import itertools
+import logging
+
+import modules.mdb_handler
+from modules.mdb_handler import MDB_Handler, MDB_State, MDB_Substate, MDB_Display
+
+
+# Benchmark of the per-frame dispatch of MDB_Handler.
+# Replays the frames of a complete vend cycle (setup of the reader, session, vend, end of the session) through the former if/elif chains on state strings and through
+# the transition table of MDB_Handler.dispatch, and checks that both send the same replies. Then measures the worst case of the chains: unhandled frames in the last
+# substate of the session, which walk every comparison. The serial port is replaced by an in-memory port, logging is disabled and both send the display texts through
+# MDB_Handler.send_display, so only the dispatch is measured.
+
+CYCLES = 5000
+REPEATS = 5
+
+
+# measure
+# INFO:     Dispatches the frames REPEATS times and returns the fastest mean duration per frame
+# ARGS:     dispatch (function) -> dispatch to measure, frames (list) -> frames to dispatch
+# RETURNS:  duration per frame in seconds
+def measure(dispatch, frames):
+    durations = []
+    for repeat in range(REPEATS):
+        started = time.perf_counter()
+        for data in frames:
+            dispatch(mdbh, data)
+        durations.append((time.perf_counter() - started) / len(frames))
+    return min(durations)
+
+
+# Fake_Serial
+# INFO:     In-memory serial port: records the written frames and endlessly returns polls when read
+class Fake_Serial(object):
+
+    in_waiting = 0
+
+    def __init__(self, *args, **kwargs):
+        self.written = []
+        self.incoming = itertools.cycle(MDB_Handler.MDB2PC_FRAME_BEGIN + MDB_Handler.MDB_POLL + MDB_Handler.MDB2PC_FRAME_STOP)
+
+    def read(self, size=1):
+        return bytes(itertools.islice(self.incoming, size))
+
+    def write(self, data):
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+    def isOpen(self):
+        return False
+
+
+# frames of one vend cycle, sent by the vending machine
+CYCLE = [MDB_Handler.MDB_RESET, MDB_Handler.MDB_POLL, MDB_Handler.MDB_READER_SETUP_CONFIG, MDB_Handler.MDB_READER_MINMAX_PRICES, MDB_Handler.MBD_READER_EXT_FEATURES,
+         MDB_Handler.MDB_POLL, MDB_Handler.MDB_READER_ENABLE, MDB_Handler.MDB_POLL, MDB_Handler.MDB_POLL, MDB_Handler.MDB_POLL,
+         MDB_Handler.MDB_VEND_REQUEST + b'\x00\x64\x00\x03', MDB_Handler.MDB_POLL, MDB_Handler.MDB_VEND_SUCCESFUL + b'\x00\x03', MDB_Handler.MDB_POLL,
+         MDB_Handler.MDB_SESSION_COMPLETE, MDB_Handler.MDB_POLL, b'\x42', MDB_Handler.MDB_RESET]
+
+
+# chained_dispatch
+# INFO:     Former MDB_Handler.run and handle_data_*: compares the state and substate strings and walks the byte comparisons of the current state (same replies, state changes and logging)
+# ARGS:     mdbh (MDB_Handler) -> handler to send the replies, data (bytes) -> frame
+# RETURNS:  -
+def chained_dispatch(mdbh, data):
+    def reply(response, state=None, substate=False):
+        mdbh.send_data(response)
+        mdbh.logger.debug("OUT")
+        if state is not None:
+            mdbh.legacy_state = state
+            mdbh.logger.info("PROCEED TO: " + state)
+        if substate is not False:
+            mdbh.legacy_substate = substate
+
+    def unhandled():
+        mdbh.logger.info("IN: Unhandled Frame " + str(modules.mdb_handler.binascii.hexlify(data)))
+        reply(mdbh.MDB_OUT_OF_SEQUENCE)
+
+    state = mdbh.legacy_state
+    substate = mdbh.legacy_substate
+    mdbh.logger.debug("STATE: " + str(state))
+    if state == "RESET":
+        if data == mdbh.MDB_POLL: reply(mdbh.MDB_JUST_RESET, "DISABLED")
+        elif data == mdbh.MDB_RESET: reply(mdbh.MDB_ACK)
+        else: unhandled()
+    elif state == "DISABLED":
+        if data == mdbh.MDB_POLL: reply(mdbh.MDB_ACK)
+        elif data == mdbh.MDB_RESET: reply(mdbh.MDB_ACK, "RESET")
+        elif data == mdbh.MDB_READER_SETUP_CONFIG: reply(mdbh.MDB_READER_CONFIG_RESPONSE)
+        elif data == mdbh.MDB_READER_MINMAX_PRICES: reply(mdbh.MDB_ACK)
+        elif data == mdbh.MDB_READER_ENABLE: reply(mdbh.MDB_ACK, "ENABLED")
+        elif data == mdbh.MBD_READER_EXT_FEATURES: reply(mdbh.MDB_EXT_FEATURES_RESPONSE)
+        else: unhandled()
+    elif state == "ENABLED":
+        if data == mdbh.MDB_POLL:
+            if mdbh.open_session:
+                mdbh.open_session = False
+                mdbh.timer = time.time()
+                mdbh.last_amount = mdbh.available_callback(0)
+                reply(mdbh.MDB_OPEN_SESSION, "SESSION", None)
+            else:
+                mdbh.send_display(*mdbh.default_display, priority=MDB_Display.DEFAULT)
+        elif data == mdbh.MDB_READER_ENABLE: reply(mdbh.MDB_ACK)
+        elif data == mdbh.MDB_RESET: reply(mdbh.MDB_ACK, "RESET")
+        else: unhandled()
+    elif state == "SESSION":
+        if substate == None:
+            if data == mdbh.MDB_POLL:
+                if time.time() - mdbh.timer > mdbh.TIMEOUT: mdbh.legacy_substate = "SESSION CANCEL"
+                else: mdbh.send_display('Slot aussuchen', 'Guthaben: ' + str(mdbh.last_amount), 5, priority=MDB_Display.SESSION)
+            elif data[0:2] == mdbh.MDB_VEND_REQUEST:
+                mdbh.slot = modules.mdb_handler.struct.unpack('>H', data[4:6])[0]
+                mdbh.last_amount = mdbh.available_callback(mdbh.slot)
+                reply(mdbh.MDB_VEND_APPROVED, substate="VEND APPROVED")
+            elif data[0:2] == mdbh.MDB_VEND_CANCEL: reply(mdbh.MDB_CANCEL_REQUEST, substate="SESSION END")
+            elif data == mdbh.MDB_RESET: reply(mdbh.MDB_ACK, "RESET")
+            elif data == mdbh.MDB_SESSION_COMPLETE: reply(mdbh.MDB_ACK, substate="SESSION END")
+            else: unhandled()
+        elif substate == "VEND CANCEL":
+            if data == mdbh.MDB_POLL: reply(mdbh.MDB_ACK)
+            elif data[0:2] == mdbh.MDB_VEND_CANCEL: reply(mdbh.MDB_CANCEL_REQUEST, substate="SESSION END")
+            elif data == mdbh.MDB_RESET: reply(mdbh.MDB_ACK, "RESET", None)
+            elif data == mdbh.MDB_SESSION_COMPLETE: reply(mdbh.MDB_ACK, substate="SESSION END")
+            else: unhandled()
+        elif substate == "VEND APPROVED":
+            if data == mdbh.MDB_POLL: reply(mdbh.MDB_ACK)
+            elif data[0:2] == mdbh.MDB_VEND_SUCCESFUL:
+                dispensed(mdbh.slot)
+                reply(mdbh.MDB_ACK, substate="SESSION CANCEL")
+            elif data[0:2] == mdbh.MDB_VEND_CANCEL: reply(mdbh.MDB_CANCEL_REQUEST, substate="SESSION END")
+            elif data == mdbh.MDB_RESET: reply(mdbh.MDB_ACK, "RESET", None)
+            elif data == mdbh.MDB_SESSION_COMPLETE: reply(mdbh.MDB_ACK, substate="SESSION END")
+            else: unhandled()
+        elif substate == "SESSION CANCEL":
+            if data == mdbh.MDB_POLL: reply(mdbh.MDB_CANCEL_REQUEST, substate="SESSION END")
+            elif data == mdbh.MDB_SESSION_COMPLETE: reply(mdbh.MDB_ACK)
+            else: unhandled()
+        elif substate == "SESSION END":
+            if data == mdbh.MDB_POLL:
+                reply(mdbh.MDB_END_SESSION, "ENABLED", None)
+                mdbh.display.show('VCS', '<3', 3)
+            elif data == mdbh.MDB_SESSION_COMPLETE: reply(mdbh.MDB_ACK)
+            else: unhandled()
+
+
+# available
+# INFO:     Callback for the available credits, allows the next session, so that each cycle opens a session
+# ARGS:     slot (int) -> requested slot
+# RETURNS:  credits (int)
+def available(slot):
+    mdbh.open_session = True
+    return 10
+
+
+# dispensed
+# INFO:     Former synchronous dispensed callback, the transition table publishes the vend on the event bus instead
+# ARGS:     slot (int) -> vended slot
+# RETURNS:  -
+def dispensed(slot):
+    pass
+
+
+logging.disable(logging.CRITICAL)
+modules.mdb_handler.serial.Serial = Fake_Serial
+mdbh = MDB_Handler()
+mdbh.legacy_state = "RESET"
+mdbh.legacy_substate = None
+mdbh.set_available_callback(available)
+
+results = {}
+for (name, dispatch) in [('if/elif chains', chained_dispatch), ('transition table', MDB_Handler.dispatch)]:
+    mdbh.ser.written = []
+    mdbh.display = MDB_Display()
+    mdbh.open_session = True
+    for data in CYCLE:
+        dispatch(mdbh, data)
+    results[name] = list(mdbh.ser.written)
+    assert mdbh.legacy_state == "RESET" or mdbh.state == MDB_State.RESET
+
+    duration = measure(dispatch, CYCLE * CYCLES)
+    print('{:<18} {:7.2f} us/frame (vend cycle)'.format(name, duration * 1e6))
+
+assert results['if/elif chains'] == results['transition table']
+
+for (name, dispatch) in [('if/elif chains', chained_dispatch), ('transition table', MDB_Handler.dispatch)]:
+    (mdbh.legacy_state, mdbh.legacy_substate) = ("SESSION", "SESSION END")
+    mdbh.proceed(MDB_State.SESSION, MDB_Substate.SESSION_END)
+    duration = measure(dispatch, [b'\x42'] * (CYCLES * len(CYCLE)))
+    print('{:<18} {:7.2f} us/frame (unhandled frames in SESSION END)'.format(name, duration * 1e6))
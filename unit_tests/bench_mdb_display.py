@@ -0,0 +1,114 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+
+from modules.mdb_handler import MDB_Handler, MDB_Display
+
+
+# Benchmark of the display texts sent to the vending machine.
+# Simulates one hour of polls (every POLL_INTERVAL seconds) with a vending session every SESSION_INTERVAL seconds and an unknown card every NOTICE_INTERVAL seconds.
+# Every poll that may show a text is answered by the former MDB_Handler.send_display_order (with the former display_queue and a default display of 1 s) and by
+# MDB_Display (with a default display of 25 s). Reports the number of display requests and written bytes and the time per poll.
+
+DURATION = 3600
+POLL_INTERVAL = 0.2
+SESSION_INTERVAL = 120
+SESSION_LENGTH = 8
+NOTICE_INTERVAL = 300
+
+
+# Former_Display
+# INFO:     Former display handling of MDB_Handler: display_queue, display_timeout and send_display_order, which builds the frame on every call
+class Former_Display(object):
+
+    def __init__(self):
+        self.display_queue = []
+        self.display_timeout = 0
+
+    # send_display_order
+    # INFO:     Former MDB_Handler.send_display_order, returns the written frame instead of sending it
+    # ARGS:     request (dict) -> top line, bottom line and duration; priority (bool, optional) whether to overwrite existing text; now (float) -> current time
+    # RETURNS:  written frame (bytes)
+    def send_display_order(self, request, priority = False, now = None):
+        if priority is False and self.display_timeout > now:
+            return MDB_Handler.MDB2PC_FRAME_BEGIN + MDB_Handler.MDB_ACK + MDB_Handler.MDB2PC_FRAME_STOP
+        lines = [str(request['top']), str(request['bot'])]
+        duration = int(request['duration'])
+        if duration > 25: duration = 25
+        if duration < 0.1: duration = 0.1
+        self.display_timeout = now + duration - 0.9
+        for line in range(0,len(lines)):
+            if len(lines[line]) < 16:
+                missing = 16 - len(lines[line])
+                added_in_front = int(missing/2)
+                added_in_back = missing - added_in_front
+                lines[line] = added_in_front*' '+lines[line]+added_in_back*' '
+            if len(lines[line]) > 16:
+                lines[line] = lines[line][0:16]
+        duration_byte = bytearray(1)
+        duration_byte[0] = int(duration*10)
+        duration_byte = bytes(duration_byte)
+        line1 = bytes(lines[0].encode('utf8'))
+        line2 = bytes(lines[1].encode('utf8'))
+        return MDB_Handler.MDB2PC_FRAME_BEGIN + MDB_Handler.MDB_DISPLAY_REQUEST + duration_byte + line1 + line2 + MDB_Handler.MDB2PC_FRAME_STOP
+
+    # poll
+    # INFO:     Former answer of a poll: queued texts first, then the text of the current state
+    def poll(self, session, notice, now):
+        if notice is not None:
+            self.display_queue.append({'top': notice[0], 'bot': notice[1], 'duration': notice[2]})
+        if self.display_queue:
+            return self.send_display_order(self.display_queue.pop(0), priority = True, now = now)
+        if session is None:
+            return self.send_display_order({'top': 'VCS-Bierautomat', 'bot': 'Legi einscannen', 'duration': 1}, now = now)
+        return self.send_display_order({'top': 'Slot aussuchen', 'bot': 'Guthaben: ' + str(session), 'duration': 5}, now = now)
+
+
+# Scheduled_Display
+# INFO:     Answer of a poll by MDB_Display, as in MDB_Handler.send_display
+class Scheduled_Display(object):
+
+    def __init__(self):
+        self.display = MDB_Display()
+
+    def poll(self, session, notice, now):
+        if notice is not None:
+            self.display.show(*notice, now = now)
+        if session is None:
+            frame = self.display.next_frame('VCS-Bierautomat', 'Legi einscannen', 25, MDB_Display.DEFAULT, now = now)
+        else:
+            frame = self.display.next_frame('Slot aussuchen', 'Guthaben: ' + str(session), 5, MDB_Display.SESSION, now = now)
+        if frame is None:
+            return MDB_Handler.MDB2PC_FRAME_BEGIN + MDB_Handler.MDB_ACK + MDB_Handler.MDB2PC_FRAME_STOP
+        return frame
+
+
+# polls
+# INFO:     Builds the simulated polls: (time, credits of the session or None, notice or None)
+def polls():
+    started = time.time()
+    result = []
+    for i in range(int(DURATION / POLL_INTERVAL)):
+        offset = i * POLL_INTERVAL
+        session = 10 - int(offset / SESSION_INTERVAL) % 10 if offset % SESSION_INTERVAL < SESSION_LENGTH else None
+        notice = None
+        if abs(offset % SESSION_INTERVAL - SESSION_LENGTH) < POLL_INTERVAL / 2:
+            notice = ('VCS', '<3', 3)
+        elif abs(offset % NOTICE_INTERVAL - NOTICE_INTERVAL / 2) < POLL_INTERVAL / 2:
+            notice = ('Legi/Benutzer', 'unbekannt', 3)
+        result.append((started + offset, session, notice))
+    return result
+
+
+simulated = polls()
+for (name, display_class) in [('send_display_order', Former_Display), ('MDB_Display', Scheduled_Display)]:
+    display = display_class()
+    written = []
+    started = time.perf_counter()
+    for (now, session, notice) in simulated:
+        written.append(display.poll(session, notice, now))
+    duration = (time.perf_counter() - started) / len(simulated)
+    requests = [frame for frame in written if frame[2:3] == MDB_Handler.MDB_DISPLAY_REQUEST]
+    print('{:<20} {:6} display requests   {:8} bytes written   {:5.2f} us/poll'.format(name, len(requests), sum(len(frame) for frame in written), duration * 1e6))
@@ -0,0 +1,70 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import logging
+import select
+import tty
+
+import serial
+import modules.mdb_handler
+from modules.mdb_handler import MDB_Handler
+
+
+# Benchmark of the response time of MDB_Handler.
+# Plays the vending machine on a pseudo terminal: sends a poll every POLL_INTERVAL and measures the time until the reply frame arrives. Compares the former run loop
+# (sleep of 0.1 s before every read, serial timeout of 0.1 s) with the current one, and prints the received-to-written latency measured by MDB_Handler itself.
+
+POLLS = 50
+POLL_INTERVAL = 0.033
+
+
+# Sleeping_Handler
+# INFO:     MDB_Handler with the former run loop: sleeps 0.1 s before every read
+class Sleeping_Handler(MDB_Handler):
+
+    def poll_frames(self):
+        time.sleep(0.1)
+        return MDB_Handler.poll_frames(self)
+
+
+# exchange
+# INFO:     Sends a frame to the handler and waits for its reply frame
+# ARGS:     vmc (int) -> master fd of the pseudo terminal, data (bytes) -> payload
+# RETURNS:  seconds until the reply was received
+def exchange(vmc, data):
+    started = time.perf_counter()
+    os.write(vmc, MDB_Handler.MDB2PC_FRAME_BEGIN + data + MDB_Handler.MDB2PC_FRAME_STOP)
+    received = b''
+    while not received.endswith(MDB_Handler.MDB2PC_FRAME_STOP):
+        select.select([vmc], [], [], 1.0)
+        received += os.read(vmc, 256)
+    return time.perf_counter() - started
+
+
+logging.disable(logging.CRITICAL)
+Serial = serial.Serial
+for (name, handler_class, timeout) in [('former loop', Sleeping_Handler, 0.1), ('blocking read', MDB_Handler, MDB_Handler.READ_TIMEOUT)]:
+    (vmc, port) = os.openpty()
+    tty.setraw(vmc)
+    modules.mdb_handler.serial.Serial = lambda *args, **kwargs: Serial(os.ttyname(port), 115200, timeout=timeout)
+    mdbh = handler_class()
+    mdbh.READ_TIMEOUT = timeout
+    mdbh.start()
+
+    round_trips = []
+    for i in range(POLLS):
+        round_trips.append(exchange(vmc, MDB_Handler.MDB_POLL))
+        time.sleep(POLL_INTERVAL)
+    round_trips.sort()
+    metrics = mdbh.get_metrics()
+    print('{:<14} round trip mean {:7.2f} ms  max {:7.2f} ms   received to written mean {:6.3f} ms  p99 {:6.3f} ms'.format(
+        name, sum(round_trips) / POLLS * 1e3, round_trips[-1] * 1e3, metrics['latency_mean'] * 1e3, metrics['latency_p99'] * 1e3))
+
+    # the handler answers the poll of its shutdown with Just Reset
+    mdbh.exit()
+    os.write(vmc, MDB_Handler.MDB2PC_FRAME_BEGIN + MDB_Handler.MDB_POLL + MDB_Handler.MDB2PC_FRAME_STOP)
+    mdbh.join(5.0)
+    os.close(vmc)
+    os.close(port)
@@ -0,0 +1,94 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import random
+
+from modules.mdb_handler import MDB_Handler, MDB2PC_Parser
+
+
+# Benchmark of the parsing of the frames received from the MDB2PC interface.
+# Builds a stream of frames as sent by the vending machine (polls, vend requests, setup frames with escaped DLE bytes, long frames, ACKs between frames), splits it
+# into chunks as delivered by the serial port and parses it with the former MDB_Handler.poll_data (read 1 byte, then 10 bytes, slice between the delimiters) and with
+# MDB2PC_Parser. Reports how many frames each recovers intact (the former in escaped wire form, the parser unescaped) and the time per frame.
+
+FRAMES = 20000
+CHUNK = 32 # maximum number of bytes available on the port at once
+
+PAYLOADS = [MDB_Handler.MDB_POLL, MDB_Handler.MDB_RESET, MDB_Handler.MDB_READER_SETUP_CONFIG, MDB_Handler.MDB_READER_MINMAX_PRICES, MDB_Handler.MBD_READER_EXT_FEATURES,
+            MDB_Handler.MDB_VEND_REQUEST + b'\x00\x64\x00\x03', MDB_Handler.MDB_VEND_REQUEST + b'\x00\x10\x00\x10', MDB_Handler.MDB_VEND_SUCCESFUL + b'\x00\x03', MDB_Handler.MDB_SESSION_COMPLETE,
+            b'\x17\x01' + bytes(range(32, 60))]
+
+# payloads as sent on the wire, with escaped DLE bytes
+WIRE = {payload: payload.replace(MDB2PC_Parser.DLE, MDB2PC_Parser.ESCAPED_DLE) for payload in PAYLOADS}
+
+
+# Fake_Serial
+# INFO:     In-memory serial port delivering a stream in chunks of random size
+class Fake_Serial(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.available = 0
+
+    @property
+    def in_waiting(self):
+        if self.available == 0:
+            self.available = min(random.randint(1, CHUNK), len(self.stream) - self.position)
+        return self.available
+
+    def read(self, size=1):
+        size = min(size, max(self.in_waiting, 0))
+        data = self.stream[self.position:self.position + size]
+        self.position += len(data)
+        self.available -= len(data)
+        return data
+
+    def done(self):
+        return self.position >= len(self.stream)
+
+
+# former_poll_data
+# INFO:     Former MDB_Handler.poll_data, without logging and acknowledging
+# ARGS:     ser (Fake_Serial) -> port
+# RETURNS:  data (bytes) if a frame was read, None otherwise
+def former_poll_data(ser):
+    s = ser.read(1)
+    if s == b'\x02':
+        s = s + ser.read(10)
+        start = s.find(MDB_Handler.MDB2PC_FRAME_BEGIN) + 2
+        end = s.find(MDB_Handler.MDB2PC_FRAME_STOP, start)
+        return s[start:end]
+    return None
+
+
+random.seed(1)
+sent = [random.choice(PAYLOADS) for i in range(FRAMES)]
+stream = b''.join(MDB_Handler.MDB2PC_FRAME_BEGIN + WIRE[payload] + MDB_Handler.MDB2PC_FRAME_STOP + (b'\x06' if random.random() < 0.2 else b'') for payload in sent)
+
+random.seed(2)
+ser = Fake_Serial(stream)
+received = []
+started = time.perf_counter()
+while not ser.done():
+    data = former_poll_data(ser)
+    if data is not None:
+        received.append(data)
+former = time.perf_counter() - started
+intact = sum(1 for data in received if data in WIRE.values())
+print('former poll_data   {:6} of {} frames intact   {:6.2f} us/frame'.format(intact, FRAMES, former / FRAMES * 1e6))
+
+random.seed(2)
+ser = Fake_Serial(stream)
+parser = MDB2PC_Parser()
+received = []
+started = time.perf_counter()
+while not ser.done():
+    parser.feed(ser.read(ser.in_waiting or 1))
+    for data in parser.frames():
+        received.append(data)
+parsing = time.perf_counter() - started
+assert received == sent and parser.dropped == 0 and len(parser.buffer) == 0
+print('MDB2PC_Parser      {:6} of {} frames intact   {:6.2f} us/frame   {} ACKs'.format(len(received), FRAMES, parsing / FRAMES * 1e6, parser.acks))
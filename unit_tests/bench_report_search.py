@@ -0,0 +1,46 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import random
+import shutil
+import tempfile
+
+from connectors.storage import storage
+from modules.migrations import migrate
+
+
+# Benchmark of the search of problem reports with a growing number of reports.
+# Compares a LIKE scan over the reports table with the full-text index (as used by Telegram_Bot.search_reports_in_db), for a keyword search and for a keyword search of one reporter.
+
+REPORTS = [1000, 10000, 50000]
+SEARCHES = 20
+WORDS = ['wort{}'.format(i) for i in range(3000)]
+
+
+# measure
+# INFO:     Runs SEARCHES searches for random keywords (which are not the prefix of another keyword) and returns the mean duration per search
+# ARGS:     db_path (str) -> path of the database, query (str) -> search query, params (function) -> returns the parameters for a keyword
+# RETURNS:  mean duration in seconds
+def measure(db_path, query, params):
+    started = time.perf_counter()
+    for i in range(SEARCHES):
+        storage.query(db_path, query, params(random.choice(WORDS[1000:])))
+    return (time.perf_counter() - started) / SEARCHES
+
+
+directory = tempfile.mkdtemp()
+for reports in REPORTS:
+    db_path = os.path.join(directory, 'tbot_{}.db'.format(reports))
+    migrate(db_path, 'tbot.db')
+    storage.executemany(db_path, 'INSERT INTO reports (ID, timestamp, text) VALUES (?, ?, ?)',
+                        ((str(i % 100), 1500000000 + 60*i, ' '.join(random.choice(WORDS) for j in range(12))) for i in range(reports)))
+
+    like = measure(db_path, 'SELECT timestamp, ID, text FROM reports WHERE text LIKE ? ORDER BY timestamp DESC LIMIT 10', lambda word: ('%'+word+'%',))
+    fts = measure(db_path, 'SELECT timestamp, ID, text FROM reports WHERE report_id IN (SELECT rowid FROM reports_fts WHERE reports_fts MATCH ?) ORDER BY timestamp DESC LIMIT 10', lambda word: ('"'+word+'"*',))
+    fts_id = measure(db_path, 'SELECT timestamp, ID, text FROM reports WHERE report_id IN (SELECT rowid FROM reports_fts WHERE reports_fts MATCH ?) AND ID = ? ORDER BY timestamp DESC LIMIT 10', lambda word: ('"'+word+'"*', '7'))
+    print('{:>6} reports   like {:9.3f} ms   fts {:9.3f} ms   fts + id {:9.3f} ms'.format(reports, like * 1e3, fts * 1e3, fts_id * 1e3))
+
+storage.close()
+shutil.rmtree(directory)
@@ -0,0 +1,88 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import random
+from collections import namedtuple
+
+import evdev
+
+from modules.rfid_reader import Keystroke_Decoder
+
+
+# Benchmark of the decoding of the keystrokes of the RFID reader.
+# Replays event streams as emitted by the reader (key down and key up of every character, shift before letters, output terminated by "\nEND\n") through the former
+# string concatenation of RFID_Reader.poll and through the Keystroke_Decoder, and checks that both decode the same output.
+
+Event = namedtuple('Event', ('type', 'code', 'value'))
+
+READS = 2000
+LENGTHS = [60, 250, 1000] # characters of reader output per read
+CHARACTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 '
+
+
+# record
+# INFO:     Builds the event stream of one read of the reader
+# ARGS:     text (str) -> output of the reader, without terminator
+# RETURNS:  list of events
+def record(text):
+    events = []
+    for character in text + '\nEND\n':
+        name = {'\n': 'KEY_ENTER', ' ': 'KEY_SPACE'}.get(character, 'KEY_' + character)
+        if character.isalpha():
+            events.append(Event(evdev.ecodes.EV_KEY, evdev.ecodes.KEY_LEFTSHIFT, 1))
+        events.append(Event(evdev.ecodes.EV_KEY, evdev.ecodes.ecodes[name], 1))
+        events.append(Event(evdev.ecodes.EV_KEY, evdev.ecodes.ecodes[name], 0))
+        if character.isalpha():
+            events.append(Event(evdev.ecodes.EV_KEY, evdev.ecodes.KEY_LEFTSHIFT, 0))
+    return events
+
+
+# concatenating_poll
+# INFO:     Former RFID_Reader.poll: concatenates the key names and checks the end of the string on every event
+# ARGS:     events (list) -> event stream of one read
+# RETURNS:  decoded output (str)
+def concatenating_poll(events):
+    data = ''
+    for event in events:
+        if event.type is evdev.ecodes.EV_KEY and event.value is 1 and event.code is not evdev.ecodes.ecodes['KEY_LEFTSHIFT']:
+            data += evdev.ecodes.keys[event.code]
+        if data.endswith('KEY_ENTERKEY_EKEY_NKEY_DKEY_ENTER'):
+            data = data.replace('KEY_ENTER', '\n')
+            data = data.replace('KEY_SPACE', ' ')
+            data = data.replace('KEY_', '')
+            return data
+
+
+# decoding_poll
+# INFO:     New RFID_Reader.poll: feeds the key presses into the keystroke decoder
+# ARGS:     events (list) -> event stream of one read, decoder (Keystroke_Decoder) -> decoder to use
+# RETURNS:  decoded output (str)
+def decoding_poll(events, decoder):
+    decoder.reset()
+    for event in events:
+        if event.type == evdev.ecodes.EV_KEY and event.value == 1 and event.code != evdev.ecodes.KEY_LEFTSHIFT:
+            data = decoder.feed(event.code)
+            if data is not None:
+                return data
+
+
+decoder = Keystroke_Decoder()
+for length in LENGTHS:
+    streams = [record('LEGIC' + ''.join(random.choice(CHARACTERS) for i in range(length - 5))) for j in range(20)]
+    for events in streams:
+        assert concatenating_poll(events) == decoding_poll(events, decoder)
+
+    started = time.perf_counter()
+    for i in range(READS):
+        concatenating_poll(streams[i % len(streams)])
+    concatenating = (time.perf_counter() - started) / READS
+
+    started = time.perf_counter()
+    for i in range(READS):
+        decoding_poll(streams[i % len(streams)], decoder)
+    decoding = (time.perf_counter() - started) / READS
+
+    events = sum(len(events) for events in streams) / len(streams)
+    print('{:>5} chars ({:>5.0f} events)   concatenating {:9.1f} us/read   decoder {:9.1f} us/read'.format(length, events, concatenating * 1e6, decoding * 1e6))
@@ -0,0 +1,64 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from connectors.storage import Storage
+
+
+# Benchmark of the per-operation cost of the SQLite access patterns.
+# Compares a connection opened, committed and closed per statement (former behaviour of all modules) with the long-lived WAL connections of Storage.
+# Pass a directory as first argument to run it on the SD card of the machine, the temporary directory is used otherwise.
+
+OPERATIONS = 500
+
+
+# per_call
+# INFO:     Former access pattern: new connection, statement, commit and close per operation
+# ARGS:     db_path (str) -> path of the database, sql (str) -> statement, params (tuple) -> values of the placeholders
+# RETURNS:  fetched rows
+def per_call(db_path, sql, params):
+    db_connector = sqlite3.connect(db_path)
+    db = db_connector.cursor()
+    db.execute(sql, params)
+    rows = db.fetchall()
+    db_connector.commit()
+    db_connector.close()
+    return rows
+
+
+# measure
+# INFO:     Runs OPERATIONS operations and returns the mean duration per operation
+# ARGS:     operation (function) -> runs one operation with its number as argument
+# RETURNS:  mean duration in seconds
+def measure(operation):
+    started = time.perf_counter()
+    for i in range(OPERATIONS):
+        operation(i)
+    return (time.perf_counter() - started) / OPERATIONS
+
+
+directory = tempfile.mkdtemp(dir=sys.argv[1] if len(sys.argv) > 1 else None)
+insert = 'INSERT INTO reports (ID, timestamp, text) VALUES (?, ?, ?)'
+select = 'SELECT * FROM users WHERE ID = ?'
+
+for synchronous in ('NORMAL', 'FULL'):
+    db_path = os.path.join(directory, 'tbot_{}.db'.format(synchronous))
+    shutil.copy(os.path.join(parent_dir, 'database', 'tbot.db_default'), db_path)
+    storage = Storage()
+    storage.configure(db_path, synchronous)
+
+    print('synchronous={}'.format(synchronous))
+    print('  insert   per call {:10.3f} us   storage {:10.3f} us'.format(
+        measure(lambda i: per_call(db_path, insert, ('1', i, 'report'))) * 1e6,
+        measure(lambda i: storage.execute(db_path, insert, ('1', i, 'report'))) * 1e6))
+    print('  select   per call {:10.3f} us   storage {:10.3f} us'.format(
+        measure(lambda i: per_call(db_path, select, (str(i),))) * 1e6,
+        measure(lambda i: storage.query(db_path, select, (str(i),))) * 1e6))
+    storage.close()
+
+shutil.rmtree(directory)
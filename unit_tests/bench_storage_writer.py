@@ -0,0 +1,65 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import shutil
+import tempfile
+from threading import Thread
+
+from connectors.storage import Storage
+
+
+# Benchmark of concurrent writes from several threads, as done by the MDB thread, the report worker and the telegram bot.
+# Compares a commit per write (Storage.execute) with the batching writer thread (Storage.write), counting commits and the time the writing threads are blocked.
+# Pass a directory as first argument to run it on the SD card of the machine, the temporary directory is used otherwise.
+
+THREADS = 4
+WRITES = 200 # per thread
+PAUSE = 0.002 # s between two writes of a thread
+
+
+# measure
+# INFO:     Runs THREADS threads which write WRITES rows each and returns the mean time a thread is blocked per write
+# ARGS:     write (function) -> writes one row
+# RETURNS:  mean blocked time in seconds, total duration in seconds
+def measure(write):
+    blocked = []
+    def writer():
+        for i in range(WRITES):
+            started = time.perf_counter()
+            write(i)
+            blocked.append(time.perf_counter() - started)
+            time.sleep(PAUSE)
+    started = time.perf_counter()
+    threads = [Thread(target=writer) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(blocked) / len(blocked), time.perf_counter() - started
+
+
+directory = tempfile.mkdtemp(dir=sys.argv[1] if len(sys.argv) > 1 else None)
+insert = 'INSERT INTO reports (ID, timestamp, text) VALUES (?, ?, ?)'
+
+for synchronous in ('NORMAL', 'FULL'):
+    db_path = os.path.join(directory, 'tbot_{}.db'.format(synchronous))
+    shutil.copy(os.path.join(parent_dir, 'database', 'tbot.db_default'), db_path)
+    storage = Storage()
+    storage.configure(db_path, synchronous)
+
+    print('synchronous={}'.format(synchronous))
+    (blocked, duration) = measure(lambda i: storage.execute(db_path, insert, ('1', i, 'report')))
+    print('  execute          blocked {:10.3f} us/write   commits {:6}   total {:7.3f} s'.format(blocked * 1e6, THREADS * WRITES, duration))
+    (blocked, duration) = measure(lambda i: storage.write(db_path, insert, ('1', i, 'report')))
+    storage.writer.exit()
+    storage.writer.join()
+    print('  write            blocked {:10.3f} us/write   commits {:6}   total {:7.3f} s'.format(blocked * 1e6, storage.writer.commits, duration))
+    (blocked, duration) = measure(lambda i: storage.write(db_path, insert, ('1', i, 'report')).result())
+    storage.writer.exit()
+    storage.writer.join()
+    print('  write + result   blocked {:10.3f} us/write   commits {:6}   total {:7.3f} s'.format(blocked * 1e6, storage.writer.commits, duration))
+    storage.close()
+
+shutil.rmtree(directory)
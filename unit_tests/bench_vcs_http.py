@@ -0,0 +1,80 @@
+import os,sys,inspect
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import time
+import json
+import socket
+import urllib.request
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from connectors.vcs import ConnectionPool
+
+
+# Benchmark of the per-request latency of POST requests against a local stub of the API.
+# Compares a new urlopen connection per request (former behaviour of VCS_ID.send_post_request) with the kept connections of ConnectionPool.
+# Optionally, a round trip time can be simulated on every new connection to approximate the slow uplink of the machine.
+
+REQUESTS = 200
+CONNECT_DELAY = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0 # s, simulated handshake round trip
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        time.sleep(CONNECT_DELAY)
+        # headers and body are written separately, avoid the delayed ACK stall of Nagle's algorithm
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'rfid': '123456', 'credits': 2, 'uid': 'stub', 'timestamp': int(time.time()), 'nonce': 'stub'}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# measure
+# INFO:     Sends REQUESTS requests with the given function and measures each of them
+# ARGS:     send (function) -> sends one request
+# RETURNS:  list of latencies in seconds
+def measure(send):
+    latencies = []
+    for i in range(REQUESTS):
+        started = time.perf_counter()
+        send()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+# report
+# INFO:     Prints the latency distribution
+# ARGS:     title (str) -> name of the client, latencies (list) -> latencies in seconds
+# RETURNS:  /
+def report(title, latencies):
+    latencies = sorted(latencies)
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    print('{:<10} mean {:8.3f} ms   p50 {:8.3f} ms   p90 {:8.3f} ms   p99 {:8.3f} ms'.format(
+        title, sum(latencies) / len(latencies) * 1000, percentile(0.5), percentile(0.9), percentile(0.99)))
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+Thread(target=server.serve_forever, daemon=True).start()
+url = 'http://127.0.0.1:{}/endpoints/auth.php'.format(server.server_address[1])
+body = json.dumps({'rfid': '123456', 'timestamp': int(time.time()), 'nonce': 'x'}).encode('utf8')
+headers = {'Content-Type': 'application/json'}
+
+pool = ConnectionPool()
+report('urlopen', measure(lambda: urllib.request.urlopen(urllib.request.Request(url, data=body, headers=headers)).read()))
+report('pool', measure(lambda: pool.request('POST', url, body=body, headers=headers)))
+
+pool.close()
+server.shutdown()